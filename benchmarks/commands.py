@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# commands.py
+#
+# Measure how many commands per second FTPHandler dispatches, in
+# process: no client, no polling loop, just found_terminator().
+import sys
+import os
+import getopt
+import shutil
+import socket
+import tempfile
+import time
+
+def usage():
+    print 'Usage: commands.py [-n COMMANDS] [-r REPEAT] [COMMAND ...]'
+    print
+    print 'Log a session in to a home holding the file a.txt and feed'
+    print 'each COMMAND (default: "NOOP" and "SIZE a.txt") COMMANDS times'
+    print '(default 50000) to its found_terminator(), the responses being'
+    print 'thrown away. Print the commands per second of every COMMAND,'
+    print 'the best of REPEAT runs (default 5).'
+
+def session(ftpserver, home):
+    authorizer = ftpserver.DummyAuthorizer()
+    authorizer.add_user('bench', 'bench', home, perm=('r', 'w'))
+
+    class Handler(ftpserver.FTPHandler):
+        def push(self, data):
+            pass
+
+    Handler.authorizer = authorizer
+    server = ftpserver.FTPServer(('127.0.0.1', 0), Handler)
+    peer = socket.create_connection(server.socket.getsockname())
+    sock, addr = server.socket.accept()
+    handler = Handler(sock, server)
+    for line in ('USER bench', 'PASS bench'):
+        handler.in_buffer = [line]
+        handler.found_terminator()
+    if not handler.authenticated:
+        raise RuntimeError('login failed')
+    return handler, (server, peer)
+
+def run(handler, line, count):
+    start = time.time()
+    for i in xrange(count):
+        handler.in_buffer = [line]
+        handler.found_terminator()
+    return time.time() - start
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "hn:r:")
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    count, repeat = 50000, 5
+    for o, a in opts:
+        if o == "-h":
+            usage()
+            sys.exit()
+        else:
+            try:
+                a = int(a)
+            except ValueError:
+                usage()
+                sys.exit(2)
+            if o == "-n":
+                count = a
+            else:
+                repeat = a
+
+    topdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, topdir)
+    import easy_ftpd.lib.ftpserver as ftpserver
+    ftpserver.log = ftpserver.logline = lambda msg: None
+
+    home = tempfile.mkdtemp(prefix='commands-bench.')
+    try:
+        f = open(os.path.join(home, 'a.txt'), 'w')
+        f.write('hello\n')
+        f.close()
+        handler, keep = session(ftpserver, home)
+        for line in args or ('NOOP', 'SIZE a.txt'):
+            elapsed = min([run(handler, line, count)
+                           for i in range(repeat)])
+            print '%-12s %8.0f commands/s' % (line, count / elapsed)
+    finally:
+        shutil.rmtree(home)
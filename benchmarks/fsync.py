@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# fsync.py
+#
+# Measure how many uploads per second easyftpd completes with every
+# fsync_policy.
+import sys
+import os
+import getopt
+import ftplib
+import shutil
+import socket
+import StringIO
+import subprocess
+import tempfile
+import threading
+import time
+
+POLICIES = ('none', 'file', 'group')
+
+def usage():
+    print 'Usage: fsync.py [-d DIR] [-p PORT] [-c CLIENTS] [-n FILES]'
+    print '                [-s SIZE] [POLICY ...]'
+    print
+    print 'Start easyftpd on PORT (default 2121) once for every POLICY'
+    print '(default: none, file and group), storing the uploads in a'
+    print 'temporary directory of DIR (default: the current one, so that'
+    print 'the disk measured is the one of DIR). CLIENTS connections'
+    print '(default 8) upload FILES files (default 40) of SIZE bytes'
+    print '(default 4096) each, at the same time. Print the files per'
+    print 'second of every policy.'
+
+def start_server(tmpdir, policy, port):
+    home = os.path.join(tmpdir, 'home')
+    if os.path.isdir(home):
+        shutil.rmtree(home)
+    os.mkdir(home)
+    users = os.path.join(tmpdir, 'users')
+    f = open(users, 'w')
+    f.write('bench:bench:rw:%s\n' % home)
+    f.close()
+    config = os.path.join(tmpdir, 'config')
+    f = open(config, 'w')
+    f.write('default_port: %d\n' % port)
+    f.write('anonymous: no\n')
+    f.write('disable_logging: yes\n')
+    f.write('banner: fsync.py\n')
+    f.write('welcome_msg: Welcome!\n')
+    f.write('goodbye_msg: Goodbye!\n')
+    f.write('max_login_attempts: 3\n')
+    f.write('max_connections: 256\n')
+    f.write('max_connections_per_ip: 256\n')
+    f.write('user_file: %s\n' % users)
+    f.write('fsync_policy: %s\n' % policy)
+    f.close()
+
+    topdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = os.environ.copy()
+    env['PYTHONPATH'] = os.pathsep.join(
+        [topdir] + filter(None, [env.get('PYTHONPATH')]))
+    server = subprocess.Popen([sys.executable,
+                               os.path.join(topdir, 'easyftpd'),
+                               '-c', config, '-s'], env=env)
+    deadline = time.time() + 10
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+        except socket.error:
+            if server.poll() is not None or time.time() > deadline:
+                server.wait()
+                raise RuntimeError('easyftpd did not start')
+            time.sleep(0.1)
+        else:
+            return server
+
+def client(port, i, files, data, errors):
+    try:
+        ftp = ftplib.FTP()
+        ftp.connect('127.0.0.1', port, 30)
+        ftp.login('bench', 'bench')
+        for j in range(files):
+            ftp.storbinary('STOR f%d_%d' % (i, j), StringIO.StringIO(data))
+        ftp.quit()
+    except ftplib.all_errors, err:
+        errors.append(err)
+
+def run(port, clients, files, size):
+    data = 'x' * size
+    errors = []
+    threads = [threading.Thread(target=client,
+                                args=(port, i, files, data, errors))
+               for i in range(clients)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.time() - start, errors
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "hd:p:c:n:s:")
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for policy in args:
+        if policy not in POLICIES:
+            usage()
+            sys.exit(2)
+
+    directory, port, clients, files, size = '.', 2121, 8, 40, 4096
+    for o, a in opts:
+        if o == "-h":
+            usage()
+            sys.exit()
+        elif o == "-d":
+            directory = a
+        else:
+            try:
+                a = int(a)
+            except ValueError:
+                usage()
+                sys.exit(2)
+            if o == "-p":
+                port = a
+            elif o == "-c":
+                clients = a
+            elif o == "-n":
+                files = a
+            else:
+                size = a
+
+    tmpdir = tempfile.mkdtemp(prefix='fsync-bench.', dir=directory)
+    try:
+        for policy in args or POLICIES:
+            server = start_server(tmpdir, policy, port)
+            try:
+                elapsed, errors = run(port, clients, files, size)
+            finally:
+                server.terminate()
+                server.wait()
+            total = clients * files
+            print '%-5s: %d uploads in %.2f s: %.0f files/s, %d failed' \
+                  % (policy, total, elapsed, total / elapsed, len(errors))
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# listing.py
+#
+# Measure how long AbstractedFS takes to format the listings (LIST,
+# MLSD) of large directories.
+import sys
+import os
+import getopt
+import shutil
+import tempfile
+import time
+
+def usage():
+    print 'Usage: listing.py [-d DIR] [-r REPEAT] [ENTRIES ...]'
+    print
+    print 'Build a directory of ENTRIES empty files for every ENTRIES'
+    print '(default: 1000, 100000 and 1000000) and time format_list()'
+    print 'and format_mlsx() on it, in process, the names sorted. Print'
+    print 'the best of REPEAT runs (default 3; a single run from 1000000'
+    print 'entries on). The directories are built in a temporary'
+    print 'directory removed at exit, or in DIR as DIR/<ENTRIES> and kept'
+    print 'for the next runs.'
+
+def build(dirname, entries):
+    """Fill dirname with entries empty files, unless already done."""
+    if not os.path.isdir(dirname):
+        os.mkdir(dirname)
+    elif len(os.listdir(dirname)) == entries:
+        return
+    for i in xrange(entries):
+        open(os.path.join(dirname, 'file%07d' % i), 'w').close()
+
+def best(function, args, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        function(*args)
+        times.append(time.time() - start)
+    return min(times)
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "hd:r:")
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    try:
+        sizes = [int(a) for a in args] or [1000, 100000, 1000000]
+    except ValueError:
+        usage()
+        sys.exit(2)
+
+    directory, repeat = None, 3
+    for o, a in opts:
+        if o == "-h":
+            usage()
+            sys.exit()
+        elif o == "-d":
+            directory = a
+        else:
+            try:
+                repeat = int(a)
+            except ValueError:
+                usage()
+                sys.exit(2)
+
+    topdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, topdir)
+    import easy_ftpd.lib.ftpserver as ftpserver
+
+    tmpdir = None
+    if directory is None:
+        directory = tmpdir = tempfile.mkdtemp(prefix='listing-bench.')
+    try:
+        fs = ftpserver.AbstractedFS()
+        print '%-9s %-12s %9s %12s' % ('entries', 'method', 'seconds',
+                                       'us/entry')
+        for entries in sizes:
+            dirname = os.path.join(directory, str(entries))
+            build(dirname, entries)
+            names = os.listdir(dirname)
+            names.sort()
+            runs = repeat
+            if entries >= 1000000:
+                runs = 1
+            for method in (fs.format_list, fs.format_mlsx):
+                elapsed = best(method, (dirname, names), runs)
+                print '%-9d %-12s %9.3f %12.2f' \
+                      % (entries, method.__name__, elapsed,
+                         elapsed / entries * 1e6)
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
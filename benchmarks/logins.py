@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# logins.py
+#
+# Measure how many logins per second an easyftpd server handles, and
+# how long the other sessions wait meanwhile.
+import sys
+import getopt
+import ftplib
+import threading
+import time
+
+def usage():
+    print 'Usage: logins.py [-H HOST] [-p PORT] [-c CLIENTS] [-n LOGINS]'
+    print '                 USER PASSWORD [IDLE_USER IDLE_PASSWORD]'
+    print
+    print 'CLIENTS (default 6) connections log in as USER LOGINS times'
+    print 'each (default 3), at the same time. Meanwhile a session of'
+    print 'IDLE_USER (default USER) sends a NOOP every 10 ms. Print the'
+    print 'logins per second and the NOOP latencies.'
+
+def connect(host, port, user, password):
+    ftp = ftplib.FTP()
+    ftp.connect(host, port)
+    ftp.login(user, password)
+    return ftp
+
+def pinger(host, port, user, password, latencies, stop):
+    ftp = connect(host, port, user, password)
+    while not stop:
+        start = time.time()
+        ftp.voidcmd('NOOP')
+        latencies.append(time.time() - start)
+        time.sleep(0.01)
+    ftp.quit()
+
+def client(host, port, user, password, logins, errors):
+    for i in range(logins):
+        try:
+            connect(host, port, user, password).quit()
+        except ftplib.all_errors, err:
+            errors.append(err)
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "hH:p:c:n:")
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    if len(args) not in (2, 4):
+        usage()
+        sys.exit(2)
+
+    host, port, clients, logins = '127.0.0.1', 21, 6, 3
+    for o, a in opts:
+        if o == "-h":
+            usage()
+            sys.exit()
+        elif o == "-H":
+            host = a
+        else:
+            try:
+                a = int(a)
+            except ValueError:
+                usage()
+                sys.exit(2)
+            if o == "-p":
+                port = a
+            elif o == "-c":
+                clients = a
+            else:
+                logins = a
+    user, password = args[:2]
+    idle_user, idle_password = (args + args)[2:4]
+
+    latencies, stop, errors = [], [], []
+    thread = threading.Thread(target=pinger, args=(host, port, idle_user,
+                                                   idle_password, latencies,
+                                                   stop))
+    thread.start()
+    while not latencies:
+        time.sleep(0.01)
+
+    start = time.time()
+    threads = [threading.Thread(target=client, args=(host, port, user,
+                                                     password, logins,
+                                                     errors))
+               for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    stop.append(True)
+    thread.join()
+
+    total = clients * logins
+    latencies.sort()
+    print '%d logins in %.2f s: %.1f logins/s, %d failed' \
+          % (total, elapsed, total / elapsed, len(errors))
+    print 'NOOP latency: median %.1f ms, worst %.1f ms' \
+          % (latencies[len(latencies) / 2] * 1000, latencies[-1] * 1000)
@@ -0,0 +1,571 @@
+#!/usr/bin/env python
+# archivefs.py
+
+"""A file system serving the members of zip and uncompressed tar files
+as read-only directory trees, without extracting them.
+
+    [ArchiveIndex] - an in-memory index of the members of an archive
+    (type, size, time, offset of the data), built once when the server
+    starts and mounted on a directory.
+
+    [ArchiveFS] - an AbstractedFS answering for the directories listed
+    in its archives attribute from their ArchiveIndex: LIST, MLSD,
+    NLST, SIZE, MDTM and STAT come from the index and RETR reads the
+    member's byte range out of the archive (zip members compressed
+    with deflate are inflated on the fly).
+
+The mount point is a directory of the user's tree (normally empty)
+whose content is replaced by the archive's.  Nothing can be written
+below it: such commands fail with EROFS ("Read-only file system").
+"""
+
+import errno
+import os
+import posixpath
+import stat
+import struct
+import tarfile
+import time
+import zipfile
+import zlib
+
+from easy_ftpd.lib.ftpserver import AbstractedFS
+
+__all__ = ['ArchiveIndex', 'ArchiveFS']
+
+
+# index entries: (mode, size, mtime, ino, offset, compressed size,
+# compression method, symbolic link target); offset is that of the
+# data for tar members, of the local file header for zip members
+_MODE, _SIZE, _MTIME, _INO, _OFFSET, _CSIZE, _METHOD, _TARGET = range(8)
+
+# struct of the local file header of zip members
+_ZIP_HEADER = struct.Struct(zipfile.structFileHeader)
+
+# struct of ustar headers: name, mode, uid, gid, size, mtime, checksum,
+# type, link target, magic, version, user, group, device major and
+# minor numbers, prefix of the name
+_TAR_HEADER = struct.Struct('100s8s8s8s12s12s8sc100s6s2s32s32s8s8s155s12x')
+_TAR_TYPES = {'0': 'reg', '\0': 'reg', '1': 'lnk', '2': 'sym', '5': 'dir'}
+_TAR_EOF = '\0' * 512
+
+
+def _error(err, path):
+    return OSError(err, os.strerror(err), path)
+
+def _tar_number(field):
+    """Decode an octal number field of a tar header."""
+    field = field.split('\0', 1)[0].strip()
+    if not field:
+        return 0
+    return int(field, 8)
+
+
+class _MemberFile:
+    """A read-only file object over the data of an archive member,
+    read from its own handle of the archive.
+    """
+
+    chunk_size = 65536
+
+    def __init__(self, archive, entry, name):
+        self.name = name
+        self.closed = False
+        self.file = open(archive, 'rb')
+        offset = entry[_OFFSET]
+        if entry[_METHOD] is not None:
+            # skip the local header of zip members; its extra field
+            # may differ from the one of the central directory
+            self.file.seek(offset)
+            header = _ZIP_HEADER.unpack(self.file.read(_ZIP_HEADER.size))
+            offset = offset + _ZIP_HEADER.size + \
+                     header[zipfile._FH_FILENAME_LENGTH] + \
+                     header[zipfile._FH_EXTRA_FIELD_LENGTH]
+        self.start = offset
+        self.end = offset + entry[_CSIZE]
+        self.deflated = entry[_METHOD] == zipfile.ZIP_DEFLATED
+        self.seek(0)
+
+    def _rewind(self):
+        self.file.seek(self.start)
+        self.remaining = self.end - self.start
+        self.pos = 0
+        if self.deflated:
+            self.inflater = zlib.decompressobj(-15)
+            self.pending = ''
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.end - self.start + (1 << 30)
+        if not self.deflated:
+            data = self.file.read(min(size, self.remaining))
+            self.remaining -= len(data)
+            self.pos += len(data)
+            return data
+        while len(self.pending) < size and self.remaining:
+            raw = self.file.read(min(self.chunk_size, self.remaining))
+            if not raw:
+                break
+            self.remaining -= len(raw)
+            self.pending += self.inflater.decompress(raw)
+            if not self.remaining:
+                self.pending += self.inflater.flush()
+        data = self.pending[:size]
+        self.pending = self.pending[size:]
+        self.pos += len(data)
+        return data
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos = self.pos + pos
+        elif whence == 2:
+            raise IOError(errno.EINVAL, os.strerror(errno.EINVAL), self.name)
+        if not self.deflated:
+            pos = min(pos, self.end - self.start)
+            self.file.seek(self.start + pos)
+            self.remaining = self.end - self.start - pos
+            self.pos = pos
+            return
+        # inflate up to pos
+        if not hasattr(self, 'inflater') or pos < self.pos:
+            self._rewind()
+        while self.pos < pos:
+            if not self.read(min(self.chunk_size, pos - self.pos)):
+                break
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.file.close()
+
+
+class ArchiveIndex:
+    """An in-memory index of the members of the zip or uncompressed tar
+    file archive, mounted on directory root.
+
+    Paths are handled relative to root, with "/" separators, "" being
+    root itself.  Members whose path would climb above the root (".."),
+    special files and sparse tar members are left out.
+    """
+
+    def __init__(self, archive, root):
+        self.archive = archive
+        self.root = os.path.normpath(root)
+        st = os.stat(archive)
+        self.uid, self.gid, self.mtime = st.st_uid, st.st_gid, st.st_mtime
+        # directory -> {name: entry}
+        self.dirs = {'': {}}
+        self.members = 0
+        self._ino = 0
+        self.root_entry = self._entry(stat.S_IFDIR | 0755, 0, self.mtime)
+        if zipfile.is_zipfile(archive):
+            self._read_zip()
+        else:
+            self._read_tar()
+
+    def _entry(self, mode, size, mtime, offset=0, csize=0, method=None,
+               target=None):
+        self._ino += 1
+        return (mode, size, mtime, self._ino, offset, csize, method, target)
+
+    def _add(self, path, entry):
+        parts = [x for x in path.split('/') if x not in ('', '.')]
+        if not parts or '..' in parts:
+            return
+        dirname = ''
+        for name in parts[:-1]:
+            entries = self.dirs[dirname]
+            dirname = posixpath.join(dirname, name)
+            if name not in entries:
+                entries[name] = self._entry(stat.S_IFDIR | 0755, 0,
+                                            entry[_MTIME])
+                self.dirs[dirname] = {}
+            elif not stat.S_ISDIR(entries[name][_MODE]):
+                return
+        path = '/'.join(parts)
+        if stat.S_ISDIR(entry[_MODE]):
+            if path in self.dirs:
+                # implicitly created by a previous member
+                self.dirs[dirname][parts[-1]] = entry
+                return
+            self.dirs[path] = {}
+        elif path in self.dirs:
+            return
+        self.dirs[dirname][parts[-1]] = entry
+        self.members += 1
+
+    def _read_zip(self):
+        archive = zipfile.ZipFile(self.archive)
+        try:
+            for info in archive.infolist():
+                mode = info.external_attr >> 16
+                if info.create_system != 3 or not stat.S_IFMT(mode):
+                    # not made on UNIX
+                    if info.filename.endswith('/'):
+                        mode = stat.S_IFDIR | 0755
+                    else:
+                        mode = stat.S_IFREG | 0644
+                try:
+                    mtime = time.mktime(info.date_time + (0, 0, -1))
+                except (ValueError, OverflowError):
+                    mtime = self.mtime
+                if stat.S_ISDIR(mode):
+                    self._add(info.filename, self._entry(mode, 0, mtime))
+                elif stat.S_ISLNK(mode):
+                    self._add(info.filename,
+                              self._entry(mode, info.file_size, mtime,
+                                          target=archive.read(info)))
+                elif stat.S_ISREG(mode):
+                    # encrypted members can't be served
+                    method = info.compress_type
+                    if info.flag_bits & 0x1:
+                        method = -1
+                    self._add(info.filename,
+                              self._entry(mode, info.file_size, mtime,
+                                          info.header_offset,
+                                          info.compress_size, method))
+        finally:
+            archive.close()
+
+    def _tar_members(self, archive):
+        """Yield the (name, type, mode, size, mtime, offset of the data,
+        link target) of the members of the TarFile archive, type being
+        "reg", "dir", "sym", "lnk" or None (anything else).
+
+        Plain ustar headers are decoded here, several times faster than
+        tarfile does; the others (GNU and pax extensions, old formats)
+        are left to archive.next().
+        """
+        while True:
+            # the first member has already been read by tarfile.open()
+            info = archive.next()
+            # members are not kept
+            archive.members = []
+            if info is None:
+                return
+            if info.isreg() and not info.issparse():
+                type = 'reg'
+            elif info.isdir():
+                type = 'dir'
+            elif info.issym():
+                type = 'sym'
+            elif info.islnk():
+                type = 'lnk'
+            else:
+                type = None
+            yield (info.name, type, info.mode, info.size, info.mtime,
+                   info.offset_data, info.linkname)
+            offset = archive.offset
+            file = archive.fileobj
+            while True:
+                file.seek(offset)
+                buf = file.read(512)
+                if len(buf) < 512 or buf == _TAR_EOF:
+                    return
+                fields = _TAR_HEADER.unpack(buf)
+                type = _TAR_TYPES.get(fields[7])
+                if type is None or fields[9][:5] != 'ustar' or \
+                ord(buf[124]) & 0x80 or _tar_number(fields[6]) != \
+                sum(bytearray(buf)) - sum(bytearray(fields[6])) + 256:
+                    archive.offset = offset
+                    break
+                name = fields[0].split('\0', 1)[0]
+                prefix = fields[15].split('\0', 1)[0]
+                if prefix:
+                    name = prefix + '/' + name
+                size = _tar_number(fields[4])
+                yield (name, type, _tar_number(fields[1]), size,
+                       _tar_number(fields[5]), offset + 512,
+                       fields[8].split('\0', 1)[0])
+                offset = offset + 512
+                if type == 'reg':
+                    offset = offset + (size + 511) // 512 * 512
+
+    def _read_tar(self):
+        archive = tarfile.open(self.archive, 'r:')
+        try:
+            for name, type, mode, size, mtime, offset, linkname in \
+            self._tar_members(archive):
+                mode = mode & 07777
+                if type == 'dir':
+                    entry = self._entry(stat.S_IFDIR | mode, 0, mtime)
+                elif type == 'sym':
+                    entry = self._entry(stat.S_IFLNK | 0777, len(linkname),
+                                        mtime, target=linkname)
+                elif type == 'lnk':
+                    entry = self.resolve(linkname)[1]
+                    if entry is None or not stat.S_ISREG(entry[_MODE]):
+                        continue
+                elif type == 'reg':
+                    entry = self._entry(stat.S_IFREG | mode, size, mtime,
+                                        offset, size)
+                else:
+                    continue
+                self._add(name, entry)
+        finally:
+            archive.close()
+
+    def relpath(self, path):
+        """Return path relative to root, or None if not below it."""
+        path = os.path.normpath(path)
+        if path == self.root:
+            return ''
+        if not path.startswith(self.root + os.sep):
+            return None
+        return path[len(self.root) + 1:].replace(os.sep, '/')
+
+    def lookup(self, relpath):
+        """Return the entry of relpath, None if missing."""
+        if not relpath:
+            return self.root_entry
+        dirname, name = posixpath.split(relpath)
+        entries = self.dirs.get(dirname)
+        if entries is None:
+            return None
+        return entries.get(name)
+
+    def resolve(self, relpath, follow=True):
+        """Return the (relpath, entry) couple of relpath once the
+        symbolic links of the archive it goes through are resolved (the
+        last one too if follow is true); entry is None if missing.
+        Links can't lead outside the archive: absolute targets are
+        relative to the archive's root and ".." stops there.
+        """
+        parts = relpath.split('/')
+        resolved = []
+        links = 0
+        while parts:
+            name = parts.pop(0)
+            if name in ('', '.'):
+                continue
+            if name == '..':
+                if resolved:
+                    resolved.pop()
+                continue
+            entry = self.dirs.get('/'.join(resolved), {}).get(name)
+            if entry is None:
+                return '/'.join(resolved + [name] + parts), None
+            if entry[_TARGET] is None or not (parts or follow):
+                resolved.append(name)
+                continue
+            links += 1
+            if links > 40:
+                raise _error(errno.ELOOP, relpath)
+            if entry[_TARGET].startswith('/'):
+                resolved = []
+            parts = entry[_TARGET].split('/') + parts
+        relpath = '/'.join(resolved)
+        return relpath, self.lookup(relpath)
+
+    def stat(self, entry):
+        """Return the os.stat_result of entry."""
+        return os.stat_result((entry[_MODE], entry[_INO], 0, 1, self.uid,
+                               self.gid, entry[_SIZE], entry[_MTIME],
+                               entry[_MTIME], entry[_MTIME]))
+
+    def open(self, entry, name):
+        """Return a file object reading the data of entry."""
+        if entry[_METHOD] not in (None, zipfile.ZIP_STORED,
+                                  zipfile.ZIP_DEFLATED):
+            raise IOError(errno.EOPNOTSUPP,
+                          "Compression method not supported", name)
+        return _MemberFile(self.archive, entry, name)
+
+
+class ArchiveFS(AbstractedFS):
+    """An AbstractedFS serving the directories on which the
+    ArchiveIndex objects of archives are mounted out of the archives.
+    """
+
+    # ArchiveIndex objects shared by all instances
+    archives = []
+
+    def __init__(self):
+        AbstractedFS.__init__(self)
+        # (path prefix, archive, entries) of the directory listed last:
+        # listing commands lstat() every entry right after listdir()
+        self._listed = (None, None, None)
+
+    def get_archive(self, path):
+        """Return the (archive, relpath) couple of path, (None, None)
+        if not below a mount point."""
+        for archive in self.archives:
+            relpath = archive.relpath(path)
+            if relpath is not None:
+                return archive, relpath
+        return None, None
+
+    def _resolve(self, path, follow=True):
+        """Return the (archive, entry) couple of path, raising OSError
+        if missing; archive is None if not below a mount point."""
+        prefix, archive, entries = self._listed
+        if prefix is not None and path.startswith(prefix):
+            entry = entries.get(path[len(prefix):])
+            if entry is not None and (entry[_TARGET] is None or not follow):
+                return archive, entry
+        archive, relpath = self.get_archive(path)
+        if archive is None:
+            return None, None
+        relpath, entry = archive.resolve(relpath, follow)
+        if entry is None:
+            raise _error(errno.ENOENT, path)
+        return archive, entry
+
+    def _check_writable(self, path):
+        if self.get_archive(path)[0] is not None:
+            raise _error(errno.EROFS, path)
+
+    # --- Wrapper methods around open() and tempfile.mkstemp
+
+    def open(self, filename, mode):
+        if self.get_archive(filename)[0] is None:
+            return AbstractedFS.open(self, filename, mode)
+        if mode[0] != 'r' or '+' in mode:
+            raise IOError(errno.EROFS, os.strerror(errno.EROFS), filename)
+        try:
+            archive, entry = self._resolve(filename)
+        except OSError, err:
+            raise IOError(err.errno, err.strerror, filename)
+        if stat.S_ISDIR(entry[_MODE]):
+            raise IOError(errno.EISDIR, os.strerror(errno.EISDIR), filename)
+        return archive.open(entry, filename)
+
+    def mkstemp(self, suffix='', prefix='', dir=None, mode='wb'):
+        if self.get_archive(dir)[0] is not None:
+            raise IOError(errno.EROFS, os.strerror(errno.EROFS), dir)
+        return AbstractedFS.mkstemp(self, suffix, prefix, dir, mode)
+
+    # --- Wrapper methods around os.*
+
+    def chdir(self, path):
+        if self.get_archive(path)[0] is None:
+            return AbstractedFS.chdir(self, path)
+        if not stat.S_ISDIR(self._resolve(path)[1][_MODE]):
+            raise _error(errno.ENOTDIR, path)
+        self.cwd = self.fs2ftp(path)
+
+    def mkdir(self, path):
+        self._check_writable(path)
+        AbstractedFS.mkdir(self, path)
+
+    def listdir(self, path):
+        archive, relpath = self.get_archive(path)
+        if archive is None:
+            return AbstractedFS.listdir(self, path)
+        relpath, entry = archive.resolve(relpath)
+        if entry is None:
+            raise _error(errno.ENOENT, path)
+        if not stat.S_ISDIR(entry[_MODE]):
+            raise _error(errno.ENOTDIR, path)
+        entries = archive.dirs[relpath]
+        self._listed = (os.path.join(os.path.normpath(path), ''), archive,
+                        entries)
+        return entries.keys()
+
+    def rmdir(self, path):
+        self._check_writable(path)
+        AbstractedFS.rmdir(self, path)
+
+    def remove(self, path):
+        self._check_writable(path)
+        AbstractedFS.remove(self, path)
+
+    def rename(self, src, dst):
+        self._check_writable(src)
+        self._check_writable(dst)
+        AbstractedFS.rename(self, src, dst)
+
+    def stat(self, path):
+        archive, entry = self._resolve(path)
+        if archive is None:
+            return AbstractedFS.stat(self, path)
+        return archive.stat(entry)
+
+    def lstat(self, path):
+        archive, entry = self._resolve(path, follow=False)
+        if archive is None:
+            return AbstractedFS.lstat(self, path)
+        return archive.stat(entry)
+
+    def readlink(self, path):
+        archive, entry = self._resolve(path, follow=False)
+        if archive is None:
+            return AbstractedFS.readlink(self, path)
+        if entry[_TARGET] is None:
+            raise _error(errno.EINVAL, path)
+        return entry[_TARGET]
+
+    # --- Wrapper methods around os.path.*
+
+    def _test(self, path, follow, test):
+        try:
+            archive, entry = self._resolve(path, follow)
+        except OSError:
+            return False
+        if archive is None:
+            return None
+        return test(entry[_MODE])
+
+    def isfile(self, path):
+        result = self._test(path, True, stat.S_ISREG)
+        if result is None:
+            return AbstractedFS.isfile(self, path)
+        return result
+
+    def isdir(self, path):
+        result = self._test(path, True, stat.S_ISDIR)
+        if result is None:
+            return AbstractedFS.isdir(self, path)
+        return result
+
+    def islink(self, path):
+        result = self._test(path, False, stat.S_ISLNK)
+        if result is None:
+            return AbstractedFS.islink(self, path)
+        return result
+
+    def lexists(self, path):
+        result = self._test(path, False, lambda mode: True)
+        if result is None:
+            return AbstractedFS.lexists(self, path)
+        return result
+
+    exists = lexists
+
+    def getsize(self, path):
+        return self.stat(path).st_size
+
+    def getmtime(self, path):
+        return self.stat(path).st_mtime
+
+    def realpath(self, path):
+        """Like AbstractedFS.realpath() but resolving the symbolic
+        links of the archives through their index."""
+        archive, relpath = self.get_archive(path)
+        if archive is None:
+            return AbstractedFS.realpath(self, path)
+        relpath = archive.resolve(relpath)[0]
+        root = AbstractedFS.realpath(self, archive.root)
+        if not relpath:
+            return root
+        return os.path.join(root, relpath.replace('/', os.sep))
+
+    # --- Listing utilities
+
+    def get_dir_types(self, path):
+        archive, relpath = self.get_archive(path)
+        if archive is None:
+            return AbstractedFS.get_dir_types(self, path)
+        relpath, entry = archive.resolve(relpath)
+        if entry is None or not stat.S_ISDIR(entry[_MODE]):
+            return None
+        types = {}
+        for name, entry in archive.dirs[relpath].items():
+            if entry[_TARGET] is not None:
+                # a symbolic link: known by stat()
+                return None
+            types[name] = stat.S_ISDIR(entry[_MODE])
+        return types
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# dedupfs.py
+
+"""A file system storing the content of the uploaded files once, however
+many times and under whatever names they're uploaded.
+
+    [BlobStore] - a directory of blobs named after the SHA-256 hash of
+    their content, kept apart for every home; the files of the users
+    are hard links to them, so the number of links of a blob is its
+    reference count.
+
+    [DedupFS] - an AbstractedFS whose uploads (STOR, STOU) are hashed
+    while they're received and end up as a link to the blob with the
+    same content, created if needed.  Downloads read the blob through
+    the link, as any file.
+
+Files modified in place (APPE, STOR after REST) are first copied if
+they share their blob, which they then stop doing.  The paths sharing a
+blob share its metadata too: permissions, owner, modification time (the
+one of the latest upload), link count and inode, the last two shown by
+LIST and MLSD.  That's why content is only shared within a home: users
+with different homes never share a blob, so they can't learn from a
+listing what the others uploaded.
+
+The blob store must be on the same file system as the users' trees
+(hard links can't cross file systems); uploads which can't be linked
+are stored as plain files.  Blobs no longer linked by any user file are
+removed by the easyftpd-blobgc script.
+
+hashlib is needed (Python 2.5 or later); importing this module raises
+ImportError if it's missing.
+"""
+
+import errno
+import os
+import tempfile
+import time
+
+import hashlib
+
+from easy_ftpd.lib.ftpserver import AbstractedFS
+
+__all__ = ['BlobStore', 'DedupFS']
+
+
+def _umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+class _BlobFile:
+    """A file object receiving an upload to path in a temporary file of
+    the store, hashing the data as it's written; the temporary file is
+    turned into a blob and linked to path when closed.
+    """
+
+    def __init__(self, store, path, mode, scope):
+        self.store = store
+        self.name = path
+        self.scope = scope
+        fd, self.tmpname = tempfile.mkstemp(dir=store.tmpdir)
+        self.file = os.fdopen(fd, mode)
+        self.hash = hashlib.sha256()
+        self.closed = False
+
+    def write(self, data):
+        self.file.write(data)
+        self.hash.update(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def tell(self):
+        return self.file.tell()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.file.close()
+        except EnvironmentError:
+            os.remove(self.tmpname)
+            raise
+        self.store.commit(self.tmpname, self.hash.hexdigest(), self.name,
+                          self.scope)
+
+
+class BlobStore:
+    """The directory root, holding the blobs in objects/ (as
+    objects/<scope>/<first 2 hex digits>/<SHA-256 hex digest>, scope
+    naming the group of files which may share them) and the uploads
+    being received in tmp/.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.objdir = os.path.join(root, 'objects')
+        self.tmpdir = os.path.join(root, 'tmp')
+        for path in (self.objdir, self.tmpdir):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        self.mode = 0666 & ~_umask()
+
+    def blob_path(self, digest, scope=None):
+        if scope is None:
+            return os.path.join(self.objdir, digest[:2], digest)
+        return os.path.join(self.objdir, scope, digest[:2], digest)
+
+    def create(self, path, mode='wb', scope=None):
+        """Return a file object whose content replaces the one of path
+        once closed, sharing it only with the files of the same scope.
+        Like open() raise IOError if path can't be written."""
+        dirname = os.path.dirname(path)
+        if os.path.isdir(path):
+            raise IOError(errno.EISDIR, os.strerror(errno.EISDIR), path)
+        if not os.path.isdir(dirname):
+            raise IOError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        if not os.access(dirname, os.W_OK | os.X_OK):
+            raise IOError(errno.EACCES, os.strerror(errno.EACCES), path)
+        return _BlobFile(self, path, mode, scope)
+
+    def commit(self, tmpname, digest, path, scope=None):
+        """Replace path by a link to the blob digest of scope, the
+        content of temporary file tmpname becoming the blob if missing."""
+        blob = self.blob_path(digest, scope)
+        linkname = os.path.join(os.path.dirname(path),
+                                '.%s.%s' % (os.path.basename(path), digest[:8]))
+        try:
+            try:
+                try:
+                    os.link(blob, linkname)
+                except OSError, err:
+                    if err.errno != errno.ENOENT:
+                        raise
+                    # a new content (or a blob just garbage collected)
+                    if not os.path.isdir(os.path.dirname(blob)):
+                        os.makedirs(os.path.dirname(blob))
+                    os.chmod(tmpname, self.mode)
+                    os.rename(tmpname, blob)
+                    os.link(blob, linkname)
+                else:
+                    # the latest upload dates the content
+                    os.utime(blob, None)
+                os.rename(linkname, path)
+            except EnvironmentError:
+                # e.g. another file system: keep a plain file
+                if os.path.exists(linkname):
+                    os.remove(linkname)
+                if os.path.exists(tmpname):
+                    os.chmod(tmpname, self.mode)
+                    os.rename(tmpname, path)
+                else:
+                    raise
+        finally:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+
+    def unshare(self, path):
+        """Give path a copy of its content of its own if it shares it
+        with other paths (it's about to be modified in place)."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        if st.st_nlink <= 1:
+            return
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(path),
+                                       prefix='.easyftpd')
+        try:
+            dst = os.fdopen(fd, 'wb')
+            src = open(path, 'rb')
+            try:
+                while True:
+                    chunk = src.read(65536)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+            finally:
+                src.close()
+                dst.close()
+            os.chmod(tmpname, st.st_mode & 07777)
+            os.rename(tmpname, path)
+        except EnvironmentError:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            raise
+
+    def blobs(self):
+        """Yield the (path, st_nlink, size) of every blob."""
+        for dirname, dirs, files in os.walk(self.objdir):
+            for name in files:
+                path = os.path.join(dirname, name)
+                st = os.lstat(path)
+                yield path, st.st_nlink, st.st_size
+
+    def collect(self, dry_run=False, tmp_age=86400):
+        """Remove the blobs no longer linked by any file and the
+        temporary files older than tmp_age seconds (uploads which were
+        interrupted by a crash); return the number of files and bytes
+        freed."""
+        files = size = 0
+        for path, nlink, blob_size in self.blobs():
+            if nlink == 1:
+                if not dry_run:
+                    os.remove(path)
+                files += 1
+                size += blob_size
+        limit = time.time() - tmp_age
+        for name in os.listdir(self.tmpdir):
+            path = os.path.join(self.tmpdir, name)
+            st = os.lstat(path)
+            if st.st_mtime < limit:
+                if not dry_run:
+                    os.remove(path)
+                files += 1
+                size += st.st_size
+        return files, size
+
+
+class DedupFS(AbstractedFS):
+    """An AbstractedFS storing the uploaded files in the BlobStore
+    store, shared by all instances; the files of a home only share
+    their content with the files of the same home.
+    """
+
+    store = None
+
+    def scope(self):
+        """Return the name of the blobs' scope of the home."""
+        root = os.path.realpath(self.root)
+        return hashlib.sha256(root).hexdigest()[:16]
+
+    def open(self, filename, mode):
+        if self.store is not None:
+            if mode[0] == 'w' and '+' not in mode:
+                return self.store.create(filename, mode, self.scope())
+            if mode[0] == 'a' or '+' in mode:
+                try:
+                    self.store.unshare(filename)
+                except OSError, err:
+                    raise IOError(err.errno, err.strerror, filename)
+        return AbstractedFS.open(self, filename, mode)
+
+    def mkstemp(self, suffix='', prefix='', dir=None, mode='wb'):
+        file = AbstractedFS.mkstemp(self, suffix, prefix, dir, mode)
+        if self.store is None:
+            return file
+        # the unique name is kept by the empty file until replaced
+        file.close()
+        return self.store.create(file.name, mode, self.scope())
@@ -58,6 +58,27 @@ the backend functionality for the FTPd:
 
     [AuthorizerError] - base class for authorizers exceptions.
 
+    [CallLater] - calls a function at a later time from within the
+    polling loop, without blocking it.
+
+    [GroupCommitFlusher] - batches fsync() calls of completed uploads
+    and runs them in a background thread (group commit).
+
+    [TransferScheduler] - shares the bandwidth available in every
+    iteration of the polling loop among data channels (fair-share).
+
+    [AdmissionQueue] - limits the number of concurrent disk-heavy
+    operations per storage root.
+
+    [ChangeJournal] - records the changes made to the file system so
+    that clients can list the changes occurred since a given token.
+
+    [MetadataCache] - caches stat() results and directory listings,
+    optionally invalidated through inotify.
+
+New commands can be plugged into FTPHandler subclasses with
+register_command(), register_site_command() and register_opts_command().
+
 
 pyftpdlib also provides 3 different logging streams through 3 functions
 which can be overridden to allow for custom logging.
@@ -111,7 +132,9 @@ Serving FTP on 127.0.0.1:21
 import asyncore
 import asynchat
 import socket
+import select
 import os
+import posixpath
 import sys
 import traceback
 import errno
@@ -122,6 +145,10 @@ import tempfile
 import warnings
 import random
 import stat
+import heapq
+import shlex
+import struct
+import urllib
 from tarfile import filemode
 
 try:
@@ -129,11 +156,43 @@ try:
     import grp
 except ImportError:
     pwd = grp = None
+
+try:
+    import threading
+    import Queue
+except ImportError:
+    threading = Queue = None
+
+# the number of bytes in a socket's send queue (not sent or not
+# acknowledged yet) is only available on Linux, as SIOCOUTQ
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+if fcntl is not None and sys.platform.startswith('linux'):
+    SIOCOUTQ = 0x5411
+else:
+    SIOCOUTQ = None
+
+# scandir() returns the type of the entries along with their names
+# (Python 3.5 or the scandir module)
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
     
 
 __all__ = ['proto_cmds', 'Error', 'log', 'logline', 'debug', 'DummyAuthorizer',
            'FTPHandler', 'FTPServer', 'PassiveDTP', 'ActiveDTP', 'DTPHandler',
-           'FileProducer', 'AbstractedFS',]
+           'FileProducer', 'AbstractedFS', 'CallLater', 'GroupCommitFlusher',
+           'TokenBucket', 'TransferScheduler', 'AdmissionQueue',
+           'DecayingCounter', 'ChangeJournal', 'MetadataCache', 'ResolvedPath',
+           'cmd_attrs', 'site_cmds', 'opts_cmds', 'fs_backends',
+           'register_command', 'register_site_command',
+           'register_opts_command', 'register_fs_backend', 'get_fs_backend',]
 
 
 __pname__   = 'Python FTP server library (pyftpdlib)'
@@ -160,6 +219,7 @@ proto_cmds = {
     'MKD' : 'Syntax: MDK <SP> dir-name (create directory).',
     'NLST': 'Syntax: NLST [<SP> path-name] (list files in a compact form).',
     'NOOP': 'Syntax: NOOP (just do nothing).',
+    'OPTS': 'Syntax: OPTS <SP> cmd [<SP> options] (set command options).',
     'PASS': 'Syntax: PASS <SP> user-name (set user password).',
     'PASV': 'Syntax: PASV (set server in passive mode).',
     'PORT': 'Syntax: PORT <sp> h1,h2,h3,h4,p1,p2 (set server in active mode).',
@@ -171,6 +231,7 @@ proto_cmds = {
     'RMD' : 'Syntax: RMD <SP> dir-name (remove directory).',
     'RNFR': 'Syntax: RNFR <SP> file-name (file renaming (source name)).',
     'RNTO': 'Syntax: RNTO <SP> file-name (file renaming (destination name)).',
+    'SITE': 'Syntax: SITE <SP> site-cmd (site specific server services).',
     'SIZE': 'Syntax: HELP <SP> file-name (get file size).',
     'STAT': 'Syntax: STAT [<SP> path name] (status information [list files]).',
     'STOR': 'Syntax: STOR <SP> file-name (store a file).',
@@ -195,10 +256,139 @@ proto_cmds.update(deprecated_cmds)
 # are also not implemented by many other FTP servers
 not_implemented_cmds = {
     'ACCT': 'Syntax: ACCT account-info (specify account information).',
-    'SITE': 'Syntax: SITE [<SP> site-cmd] (site specific server services).',
     'SMNT': 'Syntax: SMNT <SP> path-name (mount file-system structure).'
     }
 
+# Attributes of the commands dispatched by FTPHandler:
+#  - arg:  True if the command needs an argument, False if it accepts
+#          no argument, None if the argument is optional
+#  - auth: whether the user has to be logged in
+#  - path: whether the argument is a pathname which must belong to the
+#          user's home directory (symbolic links are followed)
+#  - perm: the permission ("r" or "w") needed on the pathname itself,
+#          if any (commands checking permissions on a different
+#          object, e.g. the parent directory, do it on their own)
+#  - io:   whether the command is a disk-heavy one, subject to
+#          admission control
+cmd_attrs = {
+    #        arg    auth   path   perm  io
+    'ABOR': (False, True,  False, None, False),
+    'ALLO': (True,  True,  False, None, False),
+    'APPE': (True,  True,  True,  None, True),
+    'CDUP': (False, True,  False, None, False),
+    'CWD' : (None,  True,  True,  None, False),
+    'DELE': (True,  True,  True,  'w',  False),
+    'FEAT': (False, False, False, None, False),
+    'HELP': (None,  False, False, None, False),
+    'LIST': (None,  True,  False, None, True),
+    'MDTM': (True,  True,  True,  None, False),
+    'MLSD': (None,  True,  True,  None, True),
+    'MLST': (None,  True,  True,  None, False),
+    'MODE': (True,  True,  False, None, False),
+    'MKD' : (True,  True,  False, None, False),
+    'NLST': (None,  True,  True,  None, True),
+    'NOOP': (False, False, False, None, False),
+    'OPTS': (True,  False, False, None, False),
+    'PASS': (None,  False, False, None, False),
+    'PASV': (False, True,  False, None, False),
+    'PORT': (True,  True,  False, None, False),
+    'PWD' : (False, True,  False, None, False),
+    'QUIT': (False, False, False, None, False),
+    'REIN': (False, True,  False, None, False),
+    'REST': (True,  True,  False, None, False),
+    'RETR': (True,  True,  True,  'r',  True),
+    'RMD' : (True,  True,  True,  'w',  False),
+    'RNFR': (True,  True,  False, 'w',  False),
+    'RNTO': (True,  True,  False, None, False),
+    'SITE': (True,  True,  False, None, False),
+    'SIZE': (True,  True,  True,  None, False),
+    'STAT': (None,  False, False, None, False),
+    'STOR': (True,  True,  True,  None, True),
+    'STOU': (None,  True,  False, None, True),
+    'STRU': (True,  True,  False, None, False),
+    'SYST': (False, False, False, None, False),
+    'TYPE': (True,  True,  False, None, False),
+    'USER': (True,  False, False, None, False),
+    'XCUP': (False, True,  False, None, False),
+    'XCWD': (None,  True,  True,  None, False),
+    'XMKD': (True,  True,  False, None, False),
+    'XPWD': (False, True,  False, None, False),
+    'XRMD': (True,  True,  True,  'w',  False),
+    }
+
+# SITE commands (help strings and attributes, as above)
+site_cmds = {}
+site_attrs = {}
+
+# commands whose options can be set by using OPTS
+opts_cmds = {}
+
+# cache of the dispatch tables built for every handler class
+_cmd_tables = {}
+
+# AbstractedFS classes serving the home directories written as
+# "<scheme>:<name>" (e.g. "mem:dropbox") instead of a directory
+fs_backends = {}
+
+def register_command(cmd, help, arg=None, auth=True, path=False,
+                     perm=None, io=False):
+    """Register a command implemented by the ftp_<cmd> method of the
+    handler.  The keyword arguments are the command attributes
+    described in cmd_attrs.
+    """
+    cmd = cmd.upper()
+    proto_cmds[cmd] = help
+    cmd_attrs[cmd] = (arg, auth, path, perm, io)
+    _cmd_tables.clear()
+
+def register_site_command(cmd, help, arg=None, path=False, perm=None,
+                          io=False):
+    """Register a "SITE <cmd>" command implemented by the site_<cmd>
+    method of the handler.  SITE commands always need the user to be
+    logged in.
+    """
+    cmd = cmd.upper()
+    site_cmds[cmd] = help
+    site_attrs[cmd] = (arg, True, path, perm, io)
+    _cmd_tables.clear()
+
+def register_opts_command(cmd, help):
+    """Register a command whose options can be set by using
+    "OPTS <cmd> <options>", implemented by the opts_<cmd> method of
+    the handler.
+    """
+    cmd = cmd.upper()
+    opts_cmds[cmd] = help
+    _cmd_tables.clear()
+
+def register_fs_backend(scheme, fs_class):
+    """Serve the home directories written as "<scheme>:<name>" with
+    fs_class, an AbstractedFS subclass, rather than with the handler's
+    abstracted_fs.  The root directory of the instances is the whole
+    home directory string.
+    """
+    fs_backends[scheme] = fs_class
+
+def get_fs_backend(homedir):
+    """Return the AbstractedFS class registered for the scheme of
+    homedir, or None.
+    """
+    if ':' not in homedir:
+        return None
+    return fs_backends.get(homedir.split(':', 1)[0])
+
+register_opts_command('MLST', 'Syntax: OPTS MLST <SP> [fact;]... '
+                      '(select the facts returned by MLST and MLSD).')
+register_site_command('HELP', 'Syntax: SITE HELP [<SP> site-cmd] '
+                      '(show SITE commands help).')
+register_site_command('CHANGES', 'Syntax: SITE CHANGES [<SP> token] '
+                      '(list changes occurred since token).')
+register_site_command('MSTAT', 'Syntax: SITE MSTAT [<SP> pathname '
+                      '[<SP> pathname ...]] (MLST of many pathnames).')
+register_site_command('FIND', 'Syntax: SITE FIND <SP> pattern [<SP> pathname] '
+                      '(search file names in an indexed directory).',
+                      arg=True)
+
 
 # hack around format_exc function of traceback module to grant
 # backward compatibility with python < 2.4
@@ -276,8 +466,13 @@ class DummyAuthorizer:
 
     user_table = {}
 
+    def __init__(self):
+        # every authorizer has users of its own
+        self.user_table = {}
+
     def add_user(self, username, password, homedir, perm=('r'),
-                    msg_login="Login successful.", msg_quit="Goodbye."):
+                    msg_login="Login successful.", msg_quit="Goodbye.",
+                    read_limit=0, write_limit=0):
         """Add a user to the virtual users table.  AuthorizerError
         exceptions raised on error conditions such as invalid
         permissions, missing home directory or duplicate usernames.
@@ -288,10 +483,14 @@ class DummyAuthorizer:
 
         Optional msg_login and msg_quit arguments can be specified to
         provide customized response strings when user log-in and quit.
+
+        Optional read_limit and write_limit arguments limit the
+        bandwidth (in bytes per second) used by all the sessions of
+        the user for receiving and sending data (0 == unlimited).
         """
         if self.has_user(username):
             raise AuthorizerError('User "%s" already exists' %username)
-        if not os.path.isdir(homedir):
+        if not os.path.isdir(homedir) and get_fs_backend(homedir) is None:
             raise AuthorizerError('No such directory: "%s"' %homedir)
         for p in perm:
             if p not in ('', 'r', 'w'):
@@ -303,7 +502,9 @@ class DummyAuthorizer:
                'home': str(homedir),
                'perm': perm,
                'msg_login': str(msg_login),
-               'msg_quit': str(msg_quit)
+               'msg_quit': str(msg_quit),
+               'read_limit': int(read_limit),
+               'write_limit': int(write_limit)
                }
         self.user_table[username] = dic
 
@@ -314,7 +515,8 @@ class DummyAuthorizer:
         anonymous users.
 
         The keyword arguments in kwargs are the same expected by
-        add_user method: "perm", "msg_login" and "msg_quit".
+        add_user method: "perm", "msg_login", "msg_quit", "read_limit"
+        and "write_limit".
         The optional "perm" keyword argument is a tuple defaulting to
         ("r") referencing "read-only" anonymous user's permission.
         Using a "w" (write access) value results in a warning message
@@ -331,6 +533,36 @@ class DummyAuthorizer:
         stored credentials."""
         return self.user_table[username]['pwd'] == password
 
+    def validate_authentication_async(self, username, password, callback):
+        """Call callback with the result of validate_authentication().
+        Authorizers whose verification is slow (e.g. key derivation)
+        may call it later instead, from within the polling loop, so
+        that the other sessions are served meanwhile.  They may also
+        call it with None when they can't tell (e.g. the user service
+        they ask is unreachable): the client is then told to retry
+        later and the attempt doesn't count as a failed login."""
+        callback(self.validate_authentication(username, password))
+
+    def reject_unknown_async(self, username, password, callback):
+        """Call callback, with no argument, once a password given for
+        username, which doesn't exist, has been dismissed.  Authorizers
+        whose verification is slow should take as long as a failed one
+        would, so that response times don't tell which usernames
+        exist."""
+        callback()
+
+    def on_login(self, username):
+        """Called when a session of username logs in; the user's
+        record is needed until the matching on_logout() call."""
+        if hasattr(self.user_table, 'pin'):
+            # e.g. userdb.UserTable
+            self.user_table.pin(username)
+
+    def on_logout(self, username):
+        """Called when a session of username logs out or ends."""
+        if hasattr(self.user_table, 'unpin'):
+            self.user_table.unpin(username)
+
     def has_user(self, username):
         """Whether the username exists in the virtual users table."""
         return username in self.user_table
@@ -347,6 +579,16 @@ class DummyAuthorizer:
         """Return the user's quitting message."""
         return self.user_table[username]['msg_quit']
 
+    def get_read_limit(self, username):
+        """Return the user's bandwidth limit for receiving data, in
+        bytes per second (0 == unlimited)."""
+        return self.user_table[username]['read_limit']
+
+    def get_write_limit(self, username):
+        """Return the user's bandwidth limit for sending data, in
+        bytes per second (0 == unlimited)."""
+        return self.user_table[username]['write_limit']
+
     def r_perm(self, username, obj=None):
         """Whether the user has read permissions for obj (an absolute
         pathname of a file or a directory)"""
@@ -481,12 +723,16 @@ class ActiveDTP(asyncore.dispatcher):
     def __init__(self, ip, port, cmd_channel):
         asyncore.dispatcher.__init__(self)
         self.cmd_channel = cmd_channel       
+        self.address = (ip, port)
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
             self.connect((ip, port))
         except socket.error:
             self.cmd_channel.respond("425 Can't connect to %s:%s." %(ip, port))
-            self.close()     
+            self.close()
+        else:
+            # until connected (or failed)
+            self.cmd_channel.data_connector = self
 
     def __del__(self):
         self.cmd_channel.debug("ActiveDTP.__del__()")
@@ -501,6 +747,7 @@ class ActiveDTP(asyncore.dispatcher):
     def handle_connect(self):
         """Called when connection is established."""
         self.cmd_channel.debug("ActiveDTP.handle_connect()")
+        self.cmd_channel.data_connector = None
         self.cmd_channel.respond('200 PORT command successful.')
         # delegate such connection to DTP handler
         handler = self.cmd_channel.dtp_handler(self.socket, self.cmd_channel)
@@ -523,6 +770,11 @@ class ActiveDTP(asyncore.dispatcher):
         """Close the dispatcher socket."""
         self.cmd_channel.debug("ActiveDTP.close()")
         asyncore.dispatcher.close(self)
+        if self.cmd_channel.data_connector is self:
+            # closed before connecting
+            self.cmd_channel.data_connector = None
+            self.cmd_channel.on_dtp_failure("425 Can't connect to %s:%s."
+                                            %self.address)
 
 
 try:
@@ -532,6 +784,935 @@ except ImportError:
     class deque(list):
         def appendleft(self, obj):
             list.insert(self, 0, obj)
+        def popleft(self):
+            return list.pop(self, 0)
+        def clear(self):
+            del self[:]
+
+
+# --- scheduler
+
+# heap of CallLater instances ordered by expiration time
+_tasks = []
+
+class CallLater:
+    """Calls a function at a later time.
+
+    It can be used to asynchronously schedule a call within the polling
+    loop without blocking it.  The instance returned is an object that
+    can be used to cancel the call.
+    """
+
+    def __init__(self, seconds, target, *args, **kwargs):
+        """
+         - seconds: the number of seconds to wait
+         - target: the callable object to call later
+         - args: the arguments to call it with
+         - kwargs: the keyword arguments to call it with
+        """
+        assert callable(target), "%s is not callable" %target
+        assert seconds >= 0, "%s is not greater than or equal to 0 " \
+                             "seconds" %seconds
+        self._target = target
+        self._args = args
+        self._kwargs = kwargs
+        # seconds from the epoch at which to call the function
+        self.timeout = time.time() + seconds
+        self.cancelled = False
+        heapq.heappush(_tasks, self)
+
+    def __lt__(self, other):
+        return self.timeout < other.timeout
+
+    def __le__(self, other):
+        return self.timeout <= other.timeout
+
+    def call(self):
+        """Call this scheduled function."""
+        assert not self.cancelled, "Already cancelled"
+        self._target(*self._args, **self._kwargs)
+
+    def cancel(self):
+        """Unschedule this call."""
+        assert not self.cancelled, "Already cancelled"
+        self.cancelled = True
+        # the instance is lazily removed from the heap by _scheduler();
+        # just drop references to the target in the meantime
+        del self._target, self._args, self._kwargs
+
+
+def _scheduler():
+    """Run the scheduled functions due to expire soonest (if any)."""
+    now = time.time()
+    while _tasks and now >= _tasks[0].timeout:
+        call = heapq.heappop(_tasks)
+        if call.cancelled:
+            continue
+        call.cancelled = True
+        try:
+            call._target(*call._args, **call._kwargs)
+        except (KeyboardInterrupt, SystemExit, asyncore.ExitNow):
+            raise
+        except:
+            logerror(traceback.format_exc())
+
+def _exception(obj):
+    """Dispatch an "exceptional" condition event to obj."""
+    try:
+        obj.handle_expt_event()
+    except (asyncore.ExitNow, KeyboardInterrupt, SystemExit):
+        raise
+    except:
+        obj.handle_error()
+
+def _poll(timeout=0.0, map=None):
+    """Like asyncore.poll() but events of control channels are
+    dispatched before the ones of data channels (strict priority) so
+    that commands such as ABOR, STAT and NOOP are served promptly
+    even during bulk transfers.
+    """
+    if map is None:
+        map = asyncore.socket_map
+    r = []; w = []; e = []
+    for fd, obj in map.items():
+        is_r = obj.readable()
+        is_w = obj.writable()
+        if is_r:
+            r.append(fd)
+        if is_w:
+            w.append(fd)
+        if is_r or is_w:
+            e.append(fd)
+    if not (r or w or e):
+        time.sleep(timeout)
+        return
+    try:
+        r, w, e = select.select(r, w, e, timeout)
+    except select.error, err:
+        if err[0] != errno.EINTR:
+            raise
+        return
+
+    control = []
+    data = []
+    for fds, handler in ((r, asyncore.read), (w, asyncore.write),
+                         (e, _exception)):
+        for fd in fds:
+            obj = map.get(fd)
+            if obj is None:
+                continue
+            if isinstance(obj, DTPHandler):
+                data.append((fd, obj, handler))
+            else:
+                control.append((fd, obj, handler))
+    for fd, obj, handler in control + data:
+        # a previous event could have closed the channel (e.g. ABOR)
+        if map.get(fd) is obj:
+            handler(obj)
+
+def _next_timeout(timeout):
+    """Return how many seconds the polling loop may block waiting for
+    I/O without delaying the first scheduled function.
+    """
+    while _tasks and _tasks[0].cancelled:
+        heapq.heappop(_tasks)
+    if _tasks:
+        timeout = max(0, min(timeout, _tasks[0].timeout - time.time()))
+    return timeout
+
+# control channels having replies buffered during the current iteration
+# of the polling loop
+_replies = []
+
+def _flush_replies():
+    """Send the replies buffered by control channels during the
+    current iteration of the polling loop, one send() per channel.
+    """
+    global _replies
+    channels = _replies
+    _replies = []
+    for channel in channels:
+        channel.flush_replies()
+
+
+# --- throttling
+
+class TokenBucket:
+    """A token bucket used for bandwidth throttling.
+
+    rate is expressed in bytes per second (0 == unlimited).  Up to
+    burst bytes (by default one second worth of data) can be
+    transmitted at once before the bucket runs out of tokens.
+    """
+
+    def __init__(self, rate=0, burst=None):
+        self.tokens = 0
+        self._stamp = time.time()
+        self.set_rate(rate, burst)
+        self.tokens = self.burst
+
+    def set_rate(self, rate, burst=None):
+        """Change the rate of the bucket; it can be used at runtime."""
+        self.rate = int(rate)
+        self.burst = burst or self.rate
+        self.tokens = min(self.tokens, self.burst)
+        if not self.rate:
+            self.tokens = 0
+
+    def consume(self, nbytes):
+        """Charge nbytes to the bucket.  Return the number of seconds
+        to wait before the bucket has tokens again (0 if it still has).
+        """
+        if not self.rate:
+            return 0
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+        self.tokens -= nbytes
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / float(self.rate)
+
+
+# --- fair-share scheduling
+
+class TransferScheduler:
+    """Fair-share scheduler for data channels based on deficit round
+    robin.
+
+    Every iteration of the polling loop is a round in which each
+    data channel having data to transfer is granted a quantum, that
+    is an equal share of round_budget bytes.  Unused quanta carry over
+    to the next round (up to two quanta) so that channels on slow
+    links are not starved by channels on fast links, while the amount
+    of work done by a single iteration of the loop stays bounded.
+    """
+
+    # bytes which all data channels together can transfer in a single
+    # iteration of the polling loop
+    round_budget = 524288
+
+    # minimum number of bytes granted to a data channel per round
+    min_quantum = 4096
+
+    def __init__(self):
+        self.round = 0
+        self.quantum = self.round_budget
+        self._active = 0
+
+    def new_round(self):
+        """Start a new round; called before every poll."""
+        self.round += 1
+        self.quantum = max(self.min_quantum,
+                           self.round_budget / max(self._active, 1))
+        self._active = 0
+
+    def quota(self, channel):
+        """Return the number of bytes channel can transfer in the
+        current round.
+        """
+        if channel.drr_round != self.round:
+            channel.drr_round = self.round
+            channel.deficit = min(channel.deficit + self.quantum,
+                                  self.quantum * 2)
+            self._active += 1
+        return channel.deficit
+
+    def charge(self, channel, nbytes):
+        """Account nbytes transferred by channel."""
+        channel.deficit -= nbytes
+
+
+# --- admission control
+
+class AdmissionQueue:
+    """Limits the number of concurrent disk-heavy operations (data
+    transfers and directory listings) per storage root, in order to
+    prevent many concurrent operations from thrashing the disks.
+
+    Operations exceeding the limit wait in a FIFO queue and are
+    started as soon as a slot of their storage root frees up.
+
+    A storage root is the longest of the roots configured by using
+    set_limit() containing the path an operation refers to, or the
+    user's home directory if none of them does.
+    """
+
+    # default maximum number of concurrent operations per storage
+    # root (0 == unlimited)
+    limit = 0
+
+    def __init__(self):
+        # root -> limit overriding the default
+        self.limits = {}
+        # root -> number of slots in use
+        self._active = {}
+        # root -> deque of [callback, args, enqueuing time] lists
+        self._waiting = {}
+        # statistics
+        self.admitted = 0
+        self.queued = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def set_limit(self, root, limit):
+        """Configure root as a storage root having its own limit."""
+        self.limits[os.path.normpath(root)] = limit
+
+    def get_root(self, path, default):
+        """Return the storage root path belongs to."""
+        root = default
+        longest = 0
+        for r in self.limits:
+            if (path == r or path.startswith(r.rstrip(os.sep) + os.sep)) \
+            and len(r) > longest:
+                root = r
+                longest = len(r)
+        return root
+
+    def acquire(self, root, callback, *args):
+        """Request a slot for root.  Return a ticket which can be
+        passed to cancel() and granted().
+
+        If a slot is available the ticket is granted immediately,
+        else callback(*args) is called from the polling loop as soon
+        as the ticket is granted.
+        """
+        ticket = [callback, args, time.time()]
+        if self._has_slot(root) and root not in self._waiting:
+            self._grant(root, ticket, notify=False)
+        else:
+            self.queued += 1
+            self._waiting.setdefault(root, deque()).append(ticket)
+        return ticket
+
+    def cancel(self, root, ticket):
+        """Remove a ticket from the queue of root."""
+        queue = self._waiting.get(root)
+        if queue and ticket in queue:
+            queue.remove(ticket)
+            if not queue:
+                del self._waiting[root]
+
+    def release(self, root):
+        """Free a slot of root, starting the next waiting operation."""
+        self._active[root] -= 1
+        if not self._active[root]:
+            del self._active[root]
+        if root in self._waiting:
+            # start the next operation from the polling loop rather
+            # than from within the one releasing the slot
+            CallLater(0, self._admit_waiting, root)
+
+    def _has_slot(self, root):
+        limit = self.limits.get(root, self.limit)
+        return not limit or self._active.get(root, 0) < limit
+
+    def _admit_waiting(self, root):
+        while root in self._waiting and self._has_slot(root):
+            queue = self._waiting[root]
+            ticket = queue.popleft()
+            if not queue:
+                del self._waiting[root]
+            self._grant(root, ticket, notify=True)
+
+    def granted(self, ticket):
+        """Whether ticket has been granted a slot."""
+        return ticket[0] is None
+
+    def _grant(self, root, ticket, notify):
+        self._active[root] = self._active.get(root, 0) + 1
+        wait = time.time() - ticket[2]
+        self.admitted += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        callback, args = ticket[0], ticket[1]
+        ticket[0] = ticket[1] = None
+        if notify:
+            callback(*args)
+
+    def queue_depth(self, root=None):
+        """Return the number of operations waiting for root or, if
+        root is None, for all storage roots.
+        """
+        if root is not None:
+            return len(self._waiting.get(root, ()))
+        depth = 0
+        for queue in self._waiting.values():
+            depth += len(queue)
+        return depth
+
+    def stats(self):
+        """Return a dictionary of statistics about the queue."""
+        if self.admitted:
+            avg_wait = self.total_wait / self.admitted
+        else:
+            avg_wait = 0.0
+        active = 0
+        for n in self._active.values():
+            active += n
+        return {'active': active,
+                'queue_depth': self.queue_depth(),
+                'admitted': self.admitted,
+                'queued': self.queued,
+                'avg_wait': avg_wait,
+                'max_wait': self.max_wait}
+
+
+# --- brute-force throttling
+
+class DecayingCounter:
+    """Counts of events by key (e.g. failed logins by IP address) which
+    fade away over time, halving every half_life seconds.
+
+    At most max_entries keys are kept: when more are needed the
+    counts which have faded below 1 are dropped first, then the
+    lowest half, so that memory stays bounded whatever the number of
+    keys thrown at it.
+    """
+
+    max_entries = 10000
+
+    def __init__(self, half_life=300.0):
+        self.half_life = half_life
+        # key -> (count, time of the count)
+        self.counts = {}
+
+    def _decayed(self, entry, now):
+        count, stamp = entry
+        return count * 0.5 ** ((now - stamp) / self.half_life)
+
+    def get(self, key):
+        """Return the current count of key."""
+        entry = self.counts.get(key)
+        if entry is None:
+            return 0.0
+        return self._decayed(entry, time.time())
+
+    def add(self, key, n=1):
+        """Add n to the count of key; return the new count."""
+        now = time.time()
+        entry = self.counts.get(key)
+        if entry is None:
+            if len(self.counts) >= self.max_entries:
+                self.evict(now)
+            count = n
+        else:
+            count = self._decayed(entry, now) + n
+        self.counts[key] = (count, now)
+        return count
+
+    def reset(self, key):
+        self.counts.pop(key, None)
+
+    def evict(self, now=None):
+        """Drop the faded counts, or the lowest half if none has."""
+        if now is None:
+            now = time.time()
+        counts = [(self._decayed(entry, now), key) for key, entry
+                  in self.counts.items()]
+        faded = [key for count, key in counts if count < 1]
+        if not faded:
+            counts.sort()
+            faded = [key for count, key in counts[:len(counts) / 2 + 1]]
+        for key in faded:
+            del self.counts[key]
+
+
+# --- durability
+
+def _close_file(file_obj):
+    """Close a file object.  Return None on success or the
+    EnvironmentError instance describing the failure.
+    """
+    try:
+        file_obj.close()
+    except EnvironmentError, err:
+        return err
+    return None
+
+class GroupCommitFlusher:
+    """Implements group commit for uploaded files.
+
+    Files completed within the same "window" are collected into a
+    batch which is then fsync()ed by a background thread, so that
+    neither the polling loop is blocked nor every single upload pays
+    for its own disk flush.  Once the batch is durable the callbacks
+    are invoked from within the polling loop.
+
+    The batches are queued to a single long-lived thread, started by
+    the first one; a disk slower than the uploads makes the queue grow,
+    not the number of threads.  If the threading module is not
+    available the batch is fsync()ed synchronously.
+    """
+
+    # seconds during which completed uploads are collected before
+    # being fsync()ed as a single batch
+    window = 0.01
+
+    # how often the polling loop checks for batches completed by
+    # background threads
+    reap_interval = 0.005
+
+    def __init__(self):
+        self._batch = []
+        self._results = deque()
+        self._in_flight = 0
+        self._commit_call = None
+        self._reap_call = None
+        self._queue = None
+        self._thread = None
+        # statistics
+        self.batches = 0
+        self.files = 0
+
+    def add(self, file_obj, callback, group=True):
+        """Make file_obj durable and close it.  callback is called with
+        None on success or with the EnvironmentError instance which
+        occurred.  If group is false file_obj is fsync()ed on its own,
+        without waiting for the window to end.
+        """
+        # user-space buffers are flushed here since file objects are
+        # not meant to be shared between threads; the background
+        # thread only operates on the file descriptor
+        try:
+            file_obj.flush()
+        except EnvironmentError, err:
+            _close_file(file_obj)
+            callback(err)
+            return
+        if not group:
+            self._submit([(file_obj, callback)])
+            return
+        self._batch.append((file_obj, callback))
+        if self._commit_call is None:
+            self._commit_call = CallLater(self.window, self._commit)
+
+    def _commit(self):
+        """Hand the current batch to the background thread."""
+        self._commit_call = None
+        batch = self._batch
+        self._batch = []
+        self._submit(batch)
+
+    def _submit(self, batch):
+        self.batches += 1
+        self.files += len(batch)
+        self._in_flight += 1
+        if threading is None:
+            self._sync(batch)
+        else:
+            if self._thread is None or not self._thread.isAlive():
+                # started lazily, i.e. after easyftpd has forked
+                self._queue = Queue.Queue()
+                self._thread = threading.Thread(target=self._run)
+                self._thread.setDaemon(True)
+                self._thread.start()
+            self._queue.put(batch)
+        if self._reap_call is None:
+            self._reap_call = CallLater(self.reap_interval, self._reap)
+
+    def _run(self):
+        """Body of the background thread; fsync() the queued batches."""
+        while True:
+            self._sync(self._queue.get())
+
+    def _sync(self, batch):
+        """Called in a background thread; fsync() every file of batch."""
+        results = []
+        for file_obj, callback in batch:
+            try:
+                os.fsync(file_obj.fileno())
+            except EnvironmentError, err:
+                results.append((file_obj, callback, err))
+            else:
+                results.append((file_obj, callback, None))
+        self._results.append(results)
+
+    def _reap(self):
+        """Called in the polling loop; run callbacks of durable batches."""
+        self._reap_call = None
+        while self._results:
+            results = self._results.popleft()
+            self._in_flight -= 1
+            for file_obj, callback, err in results:
+                err = _close_file(file_obj) or err
+                try:
+                    callback(err)
+                except (KeyboardInterrupt, SystemExit, asyncore.ExitNow):
+                    raise
+                except:
+                    logerror(traceback.format_exc())
+        if self._in_flight:
+            self._reap_call = CallLater(self.reap_interval, self._reap)
+
+
+# --- change journal
+
+class ChangeJournal:
+    """Records the changes made to the file system so that clients
+    can ask for the changes occurred since a given point in time
+    instead of listing whole trees again (see SITE CHANGES).
+
+    Every change is an ("change" | "delete", path) pair where path is
+    an absolute filesystem pathname:
+
+     - "change": path has been created or modified; if it's a
+       directory its whole content may have changed (e.g. renaming)
+     - "delete": path, and anything below it, no longer exists
+
+    and gets a sequence number.  Clients refer to the state of the
+    journal through tokens ("<epoch>-<sequence number>"); the epoch
+    changes whenever the journal can no longer tell what happened
+    (e.g. it's been created anew or events have been lost), which
+    invalidates older tokens.
+
+    If path is not None the journal is also appended to that file and
+    reloaded from it at startup.  Once more than max_entries entries
+    are kept, the journal is compacted: only the latest entry of every
+    pathname is kept and, if that's still too much, the oldest ones
+    are dropped (tokens referring to them expire).
+    """
+
+    max_entries = 10000
+
+    def __init__(self, path=None):
+        self.path = path
+        self.file = None
+        self.entries = []
+        self.seq = 0
+        # the oldest sequence number tokens may refer to
+        self.floor = 0
+        self.epoch = self._new_epoch()
+        if path is not None:
+            self.load()
+            self.file = open(path, 'a')
+
+    def _new_epoch(self):
+        return '%x' %random.randint(0, 0xffffffff)
+
+    def load(self):
+        """Load the journal from self.path, if it exists."""
+        try:
+            f = open(self.path, 'r')
+        except IOError, err:
+            if err.errno != errno.ENOENT:
+                raise
+            self._rewrite()
+            return
+        try:
+            header = f.readline().split()
+            if len(header) != 3 or header[0] != 'journal':
+                raise Error('%s is not a change journal' %self.path)
+            self.epoch = header[1]
+            self.seq = self.floor = int(header[2])
+            torn = False
+            for line in f:
+                fields = line.rstrip('\n').split(' ', 2)
+                if not line.endswith('\n') or len(fields) != 3 or \
+                not fields[0].isdigit():
+                    # truncated by a crash
+                    torn = True
+                    continue
+                self.seq = int(fields[0])
+                self.entries.append((self.seq, fields[1],
+                                     urllib.unquote(fields[2])))
+        finally:
+            f.close()
+        if torn:
+            # a change may have been lost
+            self.seq += 1
+            self.epoch = self._new_epoch()
+            self.entries = []
+            self.floor = self.seq
+        self._rewrite()
+
+    def _rewrite(self):
+        """Atomically replace the journal file with the entries kept
+        in memory."""
+        tmp = self.path + '.tmp'
+        f = open(tmp, 'w')
+        try:
+            f.write('journal %s %d\n' %(self.epoch, self.floor))
+            for seq, op, path in self.entries:
+                f.write('%d %s %s\n' %(seq, op, urllib.quote(path)))
+        finally:
+            f.close()
+        os.rename(tmp, self.path)
+
+    def token(self):
+        """Return the token referring to the current state."""
+        return '%s-%d' %(self.epoch, self.seq)
+
+    def record(self, op, path):
+        """Record a change of path; op is "change" or "delete"."""
+        self.seq += 1
+        self.entries.append((self.seq, op, path))
+        if self.file is not None:
+            self.file.write('%d %s %s\n' %(self.seq, op, urllib.quote(path)))
+            self.file.flush()
+        if len(self.entries) > self.max_entries:
+            self.compact()
+
+    def reset(self):
+        """Forget everything, invalidating all tokens (e.g. because
+        changes have been missed)."""
+        self.epoch = self._new_epoch()
+        self.entries = []
+        self.floor = self.seq
+        self._reopen()
+
+    def compact(self):
+        """Keep only the latest entry of every pathname and, if still
+        too many, the newest max_entries / 2 entries."""
+        latest = {}
+        for seq, op, path in self.entries:
+            latest[path] = seq
+        self.entries = [entry for entry in self.entries
+                        if latest[entry[2]] == entry[0]]
+        keep = self.max_entries / 2
+        if len(self.entries) > keep:
+            self.floor = self.entries[-keep - 1][0]
+            self.entries = self.entries[-keep:]
+        self._reopen()
+
+    def _reopen(self):
+        if self.file is not None:
+            self.file.close()
+            self._rewrite()
+            self.file = open(self.path, 'a')
+
+    def changes_since(self, token):
+        """Return the changes occurred since token as a list of
+        (op, path) pairs, the latest change of every pathname only, in
+        the order they occurred.  Return None if token is invalid or
+        expired.
+        """
+        try:
+            epoch, seq = token.split('-')
+            seq = int(seq)
+        except ValueError:
+            return None
+        if epoch != self.epoch or seq < self.floor or seq > self.seq:
+            return None
+        i = len(self.entries)
+        while i and self.entries[i - 1][0] > seq:
+            i -= 1
+        latest = {}
+        entries = self.entries[i:]
+        for seq, op, path in entries:
+            latest[path] = seq
+        return [(op, path) for seq, op, path in entries
+                if latest[path] == seq]
+
+    def on_event(self, op, path):
+        """Callback for inotify.TreeWatcher, recording changes made
+        outside of the FTP server."""
+        if op == 'overflow':
+            self.reset()
+        else:
+            self.record(op, path)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+# --- metadata cache
+
+class MetadataCache:
+    """A cache of stat() results, directory contents and rendered
+    listings shared by all the AbstractedFS instances (see
+    AbstractedFS.cache).
+
+    Entries expire after ttl seconds.  Changes made through the FTP
+    server invalidate them right away (see FTPHandler.record_change);
+    to notice changes made by other processes too, an
+    inotify.TreeWatcher can be attached as watcher: entries then live
+    for watched_ttl seconds instead, unless the watcher ran out of
+    watches (overflowed) in which case the cache falls back on ttl.
+
+    Entries are looked up by the path they were asked for but indexed
+    by the real path of their directory, so that a change made through
+    a symbolic link invalidates the entries of the real path and vice
+    versa; invalidating a directory with its content walks the index
+    of the directories below it rather than every entry.
+    """
+
+    ttl = 2.0
+    watched_ttl = 60.0
+    max_entries = 10000
+
+    def __init__(self, watcher=None):
+        # (kind, path) -> (expiration time, value, directory, name),
+        # see _locate()
+        self.entries = {}
+        # real path of a directory -> {name: {key: None}} of the
+        # entries about its files (name being None for its listings)
+        self.dirs = {}
+        # real path of a directory -> {subdirectory: None}, linking
+        # the directories of dirs to the root
+        self.subdirs = {}
+        self.watcher = watcher
+        if watcher is not None:
+            watcher.callbacks.append(self.on_event)
+        # statistics
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get_ttl(self):
+        """Return the lifetime of new entries."""
+        if self.watcher is not None and not self.watcher.overflowed:
+            return self.watched_ttl
+        return self.ttl
+
+    def get(self, kind, path):
+        """Return the cached value or None if missing or expired."""
+        entry = self.entries.get((kind, path))
+        if entry is not None:
+            if entry[0] > time.time():
+                self.hits += 1
+                return entry[1]
+            self._drop((kind, path))
+        self.misses += 1
+        return None
+
+    def put(self, kind, path, value):
+        if len(self.entries) >= self.max_entries:
+            self.expire()
+        key = (kind, path)
+        if key in self.entries:
+            self._drop(key)
+        dir, name = self._locate(kind, path)
+        self.entries[key] = (time.time() + self.get_ttl(), value, dir, name)
+        self._index(key, dir, name)
+
+    def _locate(self, kind, path):
+        """Return the (real directory, name) couple under which the
+        entry (kind, path) is indexed: that of the file stat() found,
+        that of the link itself for lstat(), (path, None) for
+        listings."""
+        if kind == 'stat':
+            return os.path.split(os.path.realpath(path))
+        if kind == 'lstat':
+            dirname, name = os.path.split(path)
+            return os.path.realpath(dirname), name
+        return os.path.realpath(path), None
+
+    def _index(self, key, dir, name):
+        names = self.dirs.get(dir)
+        if names is None:
+            names = self.dirs[dir] = {}
+            self._link(dir)
+        keys = names.get(name)
+        if keys is None:
+            keys = names[name] = {}
+        keys[key] = None
+
+    def _link(self, dir):
+        """Link dir to its ancestors in subdirs."""
+        parent = os.path.dirname(dir)
+        while parent != dir:
+            children = self.subdirs.get(parent)
+            if children is not None:
+                children[dir] = None
+                return
+            self.subdirs[parent] = {dir: None}
+            dir, parent = parent, os.path.dirname(parent)
+
+    def _drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        dir, name = entry[2:]
+        names = self.dirs.get(dir)
+        if names is not None and name in names:
+            keys = names[name]
+            keys.pop(key, None)
+            if not keys:
+                del names[name]
+                if not names:
+                    del self.dirs[dir]
+
+    def _drop_all(self, names, name):
+        keys = names.get(name)
+        if keys is not None:
+            for key in keys.keys():
+                self._drop(key)
+
+    def clear(self):
+        self.entries.clear()
+        self.dirs.clear()
+        self.subdirs.clear()
+
+    def expire(self):
+        """Drop expired entries or, if none, everything."""
+        now = time.time()
+        for key, entry in self.entries.items():
+            if entry[0] <= now:
+                self._drop(key)
+        if len(self.entries) >= self.max_entries:
+            self.clear()
+        else:
+            # forget the directories left without entries
+            self.subdirs.clear()
+            for dir in self.dirs.keys():
+                self._link(dir)
+
+    def invalidate(self, path, recursive=False):
+        """Drop the entries about path and its parent directory; if
+        recursive also those about anything below path."""
+        self.invalidations += 1
+        dirname, name = os.path.split(path)
+        real = os.path.realpath(path)
+        # path itself (and, if a symbolic link, what it leads to)
+        # along with the listings of its directory
+        for dir, name in (os.path.realpath(dirname), name), \
+                         os.path.split(real):
+            names = self.dirs.get(dir)
+            if names is not None:
+                self._drop_all(names, name)
+                self._drop_all(names, None)
+        # the listings of path, or everything below it
+        dirs = [real]
+        while dirs:
+            dir = dirs.pop()
+            names = self.dirs.get(dir)
+            if names is not None:
+                if recursive:
+                    for name in names.keys():
+                        self._drop_all(names, name)
+                else:
+                    self._drop_all(names, None)
+            if recursive:
+                dirs.extend(self.subdirs.get(dir, {}).keys())
+
+    def on_event(self, op, path):
+        """Callback for inotify.TreeWatcher and ChangeJournal-like
+        notifications (see FTPHandler.record_change)."""
+        if op == 'overflow':
+            self.invalidations += 1
+            self.clear()
+        else:
+            # a deleted or renamed directory takes its content along;
+            # the same goes for a directory moved in place of another
+            self.invalidate(path, recursive=True)
+
+    def stats(self):
+        """Return a dictionary of statistics about the cache and its
+        watcher, if any."""
+        stats = {'entries': len(self.entries), 'hits': self.hits,
+                 'misses': self.misses,
+                 'invalidations': self.invalidations,
+                 'ttl': self.get_ttl()}
+        if self.watcher is not None:
+            stats['watches'] = self.watcher.watch_count()
+            stats['event_rate'] = self.watcher.event_rate()
+            stats['overflowed'] = self.watcher.overflowed
+        return stats
 
 
 class DTPHandler(asyncore.dispatcher):
@@ -562,6 +1743,16 @@ class DTPHandler(asyncore.dispatcher):
     ac_in_buffer_size = 8192
     ac_out_buffer_size  = 8192
 
+    # Durability policy applied to uploaded files before responding
+    # with "226 Transfer complete.":
+    #  - "none": rely on the operating system for flushing data
+    #  - "file": fsync() every file as soon as its upload completes
+    #    (in the background thread of fsync_flusher)
+    #  - "group": group commit; fsync() uploads completed within the
+    #    same window together by using fsync_flusher
+    fsync_policy = 'none'
+    fsync_flusher = GroupCommitFlusher()
+
     def __init__(self, sock_obj, cmd_channel):        
         """Initialize the DTPHandler instance, replacing asynchat's
         "simple producer" deque wrapper with a pure deque object.
@@ -574,10 +1765,19 @@ class DTPHandler(asyncore.dispatcher):
 
         self.cmd_channel = cmd_channel
         self.file_obj = None
+        # callable replacing the "226 Transfer complete." response
+        # once all data has been received; it's passed file_obj
+        self.on_complete = None
         self.receive = False
         self.transfer_finished = False
         self.tot_bytes_sent = 0
-        self.tot_bytes_received = 0        
+        self.tot_bytes_received = 0
+        self._closed = False
+        self._throttled = False
+        self._throttle_call = None
+        self.scheduler = cmd_channel.ftpd_instance.transfer_scheduler
+        self.drr_round = 0
+        self.deficit = 0
 
     def __del__(self):
         self.cmd_channel.debug("DTPHandler.__del__()")
@@ -603,12 +1803,51 @@ class DTPHandler(asyncore.dispatcher):
         "Return True if a transfer is in progress, else False."
         return self.get_transmitted_bytes() != 0
 
+    def get_buffered_bytes(self):
+        """Return the number of bytes waiting to be sent: those pushed
+        or produced (e.g. by a FileProducer) but not handed to the
+        kernel yet, plus those in the socket's send queue where it can
+        be told (Linux)."""
+        size = 0
+        for chunk in self.producer_fifo:
+            if isinstance(chunk, str):
+                size += len(chunk)
+        if SIOCOUTQ is not None and self.connected:
+            try:
+                size += struct.unpack('i', fcntl.ioctl(self.socket.fileno(),
+                                                       SIOCOUTQ,
+                                                       '\0' * 4))[0]
+            except (IOError, socket.error):
+                pass
+        return size
+
+    def throttle(self, buckets, nbytes):
+        """Charge nbytes to the token buckets.  If any of them ran out
+        of tokens the channel is removed from the readable and writable
+        sets until a timer re-arms it.
+        """
+        delay = 0
+        for bucket in buckets:
+            delay = max(delay, bucket.consume(nbytes))
+        if delay:
+            self._throttled = True
+            if self._throttle_call is not None and \
+            not self._throttle_call.cancelled:
+                self._throttle_call.cancel()
+            self._throttle_call = CallLater(delay, self.unthrottle)
+
+    def unthrottle(self):
+        """Called when the throttling delay expired."""
+        self._throttle_call = None
+        self._throttled = False
+
     # --- connection
 
     def handle_read(self):
         """Called when there is data waiting to be read."""
         try:
-            chunk = self.recv(self.ac_in_buffer_size)
+            chunk = self.recv(min(self.ac_in_buffer_size,
+                                  self.scheduler.quota(self)))
         except socket.error:
             self.handle_error()
         else:
@@ -617,6 +1856,8 @@ class DTPHandler(asyncore.dispatcher):
                 self.transfer_finished = True
                 #self.close()  # <-- asyncore.recv() already do that...
                 return
+            self.scheduler.charge(self, len(chunk))
+            self.throttle(self.cmd_channel.read_buckets, len(chunk))
             # while we're writing on the file an exception could occur
             # in case  that filesystem gets full;  if this happens we
             # let handle_error() method handle this exception, providing
@@ -647,18 +1888,27 @@ class DTPHandler(asyncore.dispatcher):
         # cannot use the old predicate, it violates the claim of the
         # set_terminator method.
         #return (len(self.ac_in_buffer) <= self.ac_in_buffer_size)
-        return self.receive
+        return self.receive and not self._throttled \
+               and self.scheduler.quota(self) > 0
 
     def writable(self):
         """Predicate for inclusion in the writable for select()."""
-        return self.producer_fifo or (not self.connected)
+        if self._throttled:
+            return False
+        if self.producer_fifo:
+            return self.scheduler.quota(self) > 0
+        return not self.connected
 
     def close_when_done(self):
         """Automatically close this channel once the outgoing queue is empty."""
         self.producer_fifo.append(None)
 
     def initiate_send(self):
-        """Attempt to send data in fifo order."""
+        """Attempt to send data in fifo order, up to the quota granted
+        by the transfer scheduler for the current round.
+        """
+        if self._throttled:
+            return
         while self.producer_fifo and self.connected:
             first = self.producer_fifo[0]
             # handle empty string/buffer or None entry
@@ -669,12 +1919,21 @@ class DTPHandler(asyncore.dispatcher):
                     self.handle_close()
                     return
 
+            quota = self.scheduler.quota(self)
+            if quota <= 0:
+                return
+
             # handle classic producer behavior
-            obs = self.ac_out_buffer_size
+            obs = min(self.ac_out_buffer_size, quota)
             try:
                 data = buffer(first, 0, obs)
             except TypeError:
-                self.producer_fifo.appendleft(first.more())
+                data = first.more()
+                if data:
+                    self.producer_fifo.appendleft(data)
+                else:
+                    # exhausted producer
+                    del self.producer_fifo[0]
                 continue
 
             # send the data
@@ -690,8 +1949,11 @@ class DTPHandler(asyncore.dispatcher):
                     self.producer_fifo[0] = first[num_sent:]
                 else:
                     del self.producer_fifo[0]
-            # we tried to send some actual data
-            return
+                self.scheduler.charge(self, num_sent)
+                self.throttle(self.cmd_channel.write_buckets, num_sent)
+            # keep sending only if the kernel accepted the whole chunk
+            if num_sent < len(data) or self._throttled:
+                return
 
     def handle_expt(self):
         """Called on "exceptional" data events."""
@@ -734,8 +1996,17 @@ class DTPHandler(asyncore.dispatcher):
         # (responding with 226) or not (responding with 426).
         if self.receive:
             self.transfer_finished = True
+            # files without a descriptor (e.g. in memory) have nothing
+            # to make durable
+            if self.file_obj is not None and self.fsync_policy != 'none' \
+            and self.on_complete is None and hasattr(self.file_obj, 'fileno'):
+                self.wait_durable()
+                return
         if self.transfer_finished:
-            self.cmd_channel.respond("226 Transfer complete.")
+            if self.on_complete is not None:
+                self.on_complete(self.file_obj)
+            else:
+                self.cmd_channel.respond("226 Transfer complete.")
             self.cmd_channel.log("Transfer complete; "
                                  "%d bytes transmitted." %tot_bytes)
         else:
@@ -744,10 +2015,44 @@ class DTPHandler(asyncore.dispatcher):
                                  "%d bytes transmitted." %tot_bytes)
         self.close()
 
+    def wait_durable(self):
+        """Make the uploaded file durable according to fsync_policy,
+        postponing the "226 Transfer complete." response until it is.
+        """
+        self.cmd_channel.debug("DTPHandler.wait_durable()")
+        # the file object is handed over to the flusher which will
+        # close it; stop reading from socket in the meantime
+        file_obj = self.file_obj
+        self.file_obj = None
+        self.receive = False
+        self.fsync_flusher.add(file_obj, self.on_durable,
+                               self.fsync_policy == 'group')
+
+    def on_durable(self, err):
+        """Called when the uploaded file has been made durable; err is
+        the EnvironmentError instance which occurred, if any.
+        """
+        self.cmd_channel.debug("DTPHandler.on_durable()")
+        if self._closed:
+            # channel closed in the meantime (e.g. ABOR)
+            return
+        if err is not None:
+            self.cmd_channel.respond("426 %s; transfer aborted."
+                                     %_strerror(err))
+            self.cmd_channel.log("Transfer aborted; %d bytes transmitted."
+                                 %self.get_transmitted_bytes())
+            self.close()
+        else:
+            self.handle_close()
+
     def close(self):
         """Close the data channel, first attempting to close any remaining
         file handles."""
         self.cmd_channel.debug("DTPHandler.close()")
+        self._closed = True
+        if self._throttle_call is not None:
+            self._throttle_call.cancel()
+            self._throttle_call = None
         if self.file_obj:
             if not self.file_obj.closed:
                 self.file_obj.close()
@@ -803,8 +2108,330 @@ class FileProducer:
             self.file.close()
 
 
+class _Collector:
+    """A file-like object keeping in memory the data received over
+    the data channel (e.g. the pathnames sent along SITE MSTAT), up to
+    limit bytes.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+        self.data = []
+        self.closed = False
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.limit:
+            raise IOError(errno.E2BIG, os.strerror(errno.E2BIG))
+        self.data.append(data)
+
+    def getvalue(self):
+        return ''.join(self.data)
+
+    def close(self):
+        self.closed = True
+
+
+class _MstatProducer:
+    """Producer returning the facts of many pathnames in the format
+    of MLST replies, a few pathnames per call so that stat()s are
+    interleaved with the rest of the polling loop's work.  Errors are
+    reported inline by using an "error" fact.
+
+    paths is a list of (file system path, virtual path) couples,
+    resolved beforehand since the commands pipelined after SITE MSTAT
+    (e.g. CWD) may be processed while it is being produced.
+    """
+
+    paths_per_call = 64
+
+    def __init__(self, cmd_channel, paths):
+        self.cmd_channel = cmd_channel
+        self.fs = cmd_channel.fs
+        self.paths = paths
+        self.index = 0
+
+    def more(self):
+        if self.index > len(self.paths):
+            return ''
+        fs = self.fs
+        result = []
+        for path, line in self.paths[self.index:
+                                     self.index + self.paths_per_call]:
+            if not fs.validpath(path):
+                result.append(" error=Not in the user's root directory; "
+                              "%s\r\n" %line)
+                continue
+            basedir, basename = os.path.split(path)
+            try:
+                data = fs.format_mlsx(basedir, [basename], ignore_err=False)
+            except OSError, err:
+                result.append(' error=%s; %s\r\n' %(_strerror(err), line))
+            else:
+                # where TVFS is supported, a fully qualified pathname
+                # should be returned
+                result.append(' %s %s\r\n' %(data.split(' ')[0], line))
+        self.index += self.paths_per_call
+        if self.index >= len(self.paths):
+            self.index = len(self.paths) + 1
+            result.append('250 End MSTAT.\r\n')
+            self.cmd_channel.logline('==> 250 End MSTAT.')
+        return ''.join(result)
+
+
+class _ChangesProducer:
+    """Producer returning the changes listed by SITE CHANGES which
+    concern the user's tree, a chunk at a time, followed by trailer.
+    """
+
+    changes_per_call = 256
+
+    def __init__(self, cmd_channel, changes, trailer):
+        self.changes = changes
+        self.trailer = trailer
+        self.root = cmd_channel.fs.root
+        self.index = 0
+
+    def more(self):
+        root = self.root.rstrip(os.sep)
+        result = []
+        # changes concerning other users' trees are skipped; keep
+        # going until there's something to return
+        while not result and self.index <= len(self.changes):
+            for op, path in self.changes[self.index:
+                                         self.index + self.changes_per_call]:
+                if path == root:
+                    result.append(' %s /\r\n' %op)
+                elif path.startswith(root + os.sep):
+                    path = path[len(root):].replace(os.sep, '/')
+                    result.append(' %s %s\r\n' %(op, path))
+            self.index += self.changes_per_call
+            if self.index >= len(self.changes):
+                self.index = len(self.changes) + 1
+                result.append(self.trailer)
+        return ''.join(result)
+
+
+class _TreeProducer:
+    """Producer listing the directories in dirs and, down to maxdepth
+    levels, their subdirectories (LIST -R, MLSD -R, STAT -R and STAT
+    with wildcards in the directory part).  Directories are listed one
+    per call, in the order used by "ls -R", so that a large tree is
+    walked incrementally rather than blocking the polling loop.
+
+     - format: the AbstractedFS method formatting entries
+       (format_list or format_mlsx)
+     - pattern: if not None only entries matching it are listed
+     - maxdepth: how many levels of subdirectories to descend
+     - maxentries: the maximum number of entries listed (0 means
+       unlimited)
+     - headers: if True each directory is preceded by a "dirname:"
+       line as "ls -R" does, else entries are named after their path
+       relative to the first directory (MLSD) and dirs is expected to
+       contain that directory only
+     - trailer: string returned once the walk is over
+
+    Subdirectories are descended only if the user has read permission
+    on them and they don't point outside the user's root directory;
+    each directory is listed once, even if symbolic links lead to it
+    more than once (loops).
+    """
+
+    def __init__(self, cmd_channel, dirs, format, pattern=None, maxdepth=0,
+                 maxentries=0, headers=True, trailer=''):
+        self.cmd_channel = cmd_channel
+        self.fs = cmd_channel.fs
+        self.format = format
+        self.pattern = pattern
+        self.maxdepth = maxdepth
+        self.maxentries = maxentries
+        self.headers = headers
+        self.trailer = trailer
+        self.entries = 0
+        self.truncated = False
+        self.done = False
+        self.visited = {}
+        self.stack = []
+        self.top = dirs[0]
+        for path in dirs:
+            self.visited[self.fs.realpath(path)] = None
+            self.stack.insert(0, (path, '', 0))
+
+    def more(self):
+        while self.stack:
+            data = self.list_dir(*self.stack.pop())
+            if data:
+                return data
+        if self.done:
+            return ''
+        self.done = True
+        if self.truncated and self.headers:
+            return 'Listing truncated after %d entries.\r\n%s' \
+                   %(self.entries, self.trailer)
+        return self.trailer
+
+    def list_dir(self, path, relpath, depth):
+        """Return the listing of a directory, scheduling the listing
+        of its subdirectories."""
+        fs = self.fs
+        channel = self.cmd_channel
+        try:
+            names = fs.listdir(path)
+        except OSError, err:
+            if self.headers:
+                return '%s:\r\n%s.\r\n\r\n' %(fs.fs2ftp(path),
+                                                 _strerror(err))
+            return ''
+        if self.pattern is not None:
+            if self.pattern[0] != '.':
+                names = [x for x in names if x[0] != '.']
+            names = fnmatch.filter(names, self.pattern)
+        names.sort()
+        if self.maxentries and self.entries + len(names) > self.maxentries:
+            names = names[:self.maxentries - self.entries]
+            self.truncated = True
+            del self.stack[:]
+        self.entries += len(names)
+
+        if depth < self.maxdepth and not self.truncated:
+            subdirs = []
+            for name in names:
+                subdir = os.path.join(path, name)
+                if not fs.isdir(subdir) or not fs.validpath(subdir):
+                    continue
+                realpath = fs.realpath(subdir)
+                if realpath in self.visited:
+                    continue
+                self.visited[realpath] = None
+                if not channel.authorizer.r_perm(channel.username, subdir):
+                    continue
+                if relpath:
+                    subdirs.append((subdir, relpath + '/' + name, depth + 1))
+                else:
+                    subdirs.append((subdir, name, depth + 1))
+            subdirs.reverse()
+            self.stack.extend(subdirs)
+
+        if self.headers:
+            return '%s:\r\n%s\r\n' %(fs.fs2ftp(path),
+                                       self.format(path, names))
+        if relpath:
+            names = [relpath + '/' + name for name in names]
+        return self.format(self.top, names)
+
+
 # --- filesystem
 
+class _ListingMemo:
+    """Memoized fields of the directory listings: mode strings by
+    st_mode, user and group names by uid and gid and dates by minute
+    (modification times being mostly clustered, a directory usually
+    needs few of them).
+
+    Dates are formatted once per minute and the seconds, if needed,
+    appended by hand, which assumes that the offset of the local
+    timezone is a whole number of minutes.  Names and dates are
+    forgotten every max_age seconds (users may be renamed, the
+    timezone changed) and every table is emptied when it grows over
+    max_size entries.
+    """
+
+    max_age = 300
+    max_size = 10000
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.modes = {}
+        self.users = {}
+        self.groups = {}
+        self.list_times = {}
+        self.mlsx_times = {}
+        self.created = time.time()
+
+    def check(self):
+        """Forget everything if older than max_age seconds."""
+        if time.time() - self.created > self.max_age:
+            self.reset()
+
+    def _store(self, table, key, value):
+        if len(table) >= self.max_size:
+            table.clear()
+        table[key] = value
+        return value
+
+    def filemode(self, mode):
+        """Return the "ls -l" representation of st_mode."""
+        try:
+            return self.modes[mode]
+        except KeyError:
+            return self._store(self.modes, mode, filemode(mode))
+
+    def username(self, uid):
+        """Return the name of user uid or uid if unknown."""
+        try:
+            return self.users[uid]
+        except KeyError:
+            try:
+                name = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                name = uid
+            return self._store(self.users, uid, name)
+
+    def groupname(self, gid):
+        """Return the name of group gid or gid if unknown."""
+        try:
+            return self.groups[gid]
+        except KeyError:
+            try:
+                name = grp.getgrgid(gid).gr_name
+            except KeyError:
+                name = gid
+            return self._store(self.groups, gid, name)
+
+    def list_time(self, t):
+        """Format t as "%b %d %H:%M" (LIST) in local time; raise
+        ValueError if out of range."""
+        minute = int(t // 60)
+        try:
+            return self.list_times[minute]
+        except KeyError:
+            return self._store(self.list_times, minute,
+                               time.strftime("%b %d %H:%M",
+                                             time.localtime(minute * 60)))
+
+    def mlsx_time(self, t):
+        """Format t as "%Y%m%d%H%M%S" (MLST and MLSD) in local time;
+        raise ValueError if out of range."""
+        minute = int(t // 60)
+        try:
+            prefix = self.mlsx_times[minute]
+        except KeyError:
+            prefix = self._store(self.mlsx_times, minute,
+                                 time.strftime("%Y%m%d%H%M",
+                                               time.localtime(minute * 60)))
+        return '%s%02d' %(prefix, int(t - minute * 60))
+
+_listing_memo = _ListingMemo()
+
+
+class ResolvedPath(str):
+    """A "virtual" ftp pathname as received from the client (and
+    compared or formatted as such) remembering what ftpnorm() and
+    ftp2fs() return for it, so that the command it comes with can
+    translate it as many times as needed for free.
+
+    Both are used only while the current working directory and the
+    root directory it has been resolved against are unchanged (see
+    AbstractedFS.resolve).
+    """
+
+    cwd = root = ftppath = fspath = None
+
+
+
 class AbstractedFS:
     """A class used to interact with the file system, providing a high
     level, cross-platform interface compatible with both Windows and
@@ -815,10 +2442,17 @@ class AbstractedFS:
     moving files or removing directories.
     """
 
+    # a MetadataCache shared by all instances, None to disable caching
+    cache = None
+
     def __init__(self):
         self.root = None
         self.cwd = '/'
         self.rnfr = None
+        # (root, real path of root) (see validpath)
+        self._realroot = (None, None)
+        # the facts returned by format_mlsx (see OPTS MLST)
+        self.facts = self.get_available_facts()
 
     # --- Conversion utilities
 
@@ -832,6 +2466,8 @@ class AbstractedFS:
         Note: directory separators are system independent ("/").
         Pathname returned is always absolutized.
         """
+        if isinstance(ftppath, ResolvedPath) and ftppath.cwd == self.cwd:
+            return ftppath.ftppath
         if os.path.isabs(ftppath):
             p = os.path.normpath(ftppath)
         else:
@@ -861,6 +2497,9 @@ class AbstractedFS:
         
         Note: directory separators are system dependent.
         """
+        if isinstance(ftppath, ResolvedPath) and ftppath.fspath and \
+        ftppath.cwd == self.cwd and ftppath.root == self.root:
+            return ftppath.fspath
         # as far as I know, it should always be path traversal safe...
         if os.path.normpath(self.root) == os.sep:
             return os.path.normpath(self.ftpnorm(ftppath))
@@ -897,6 +2536,18 @@ class AbstractedFS:
     # alias for backward compatibility with 0.2.0
     normalize = ftpnorm
     translate = ftp2fs
+
+    def resolve(self, ftppath):
+        """Return ftppath as a ResolvedPath, translated once and for
+        all by ftpnorm() and ftp2fs() against the current working
+        directory and root directory.
+        """
+        path = ResolvedPath(ftppath)
+        path.cwd = self.cwd
+        path.root = self.root
+        path.ftppath = self.ftpnorm(ftppath)
+        path.fspath = self.ftp2fs(path)
+        return path
         
     # --- Wrapper methods around open() and tempfile.mkstemp
     
@@ -944,7 +2595,14 @@ class AbstractedFS:
 
     def listdir(self, path):
         """List the content of a directory."""
-        return os.listdir(path)
+        if self.cache is None:
+            return os.listdir(path)
+        listing = self.cache.get('listdir', path)
+        if listing is None:
+            listing = os.listdir(path)
+            self.cache.put('listdir', path, listing)
+        # callers are free to modify the list
+        return listing[:]
 
     def rmdir(self, path):
         """Remove the specified directory."""
@@ -960,14 +2618,30 @@ class AbstractedFS:
 
     def stat(self, path):
         """Perform a stat() system call on the given path."""
-        return os.stat(path)
+        if self.cache is None:
+            return os.stat(path)
+        st = self.cache.get('stat', path)
+        if st is None:
+            st = os.stat(path)
+            self.cache.put('stat', path, st)
+        return st
 
     def lstat(self, path):
         """Like stat but does not follow symbolic links."""
-        return os.lstat(path)
+        if self.cache is None:
+            return os.lstat(path)
+        st = self.cache.get('lstat', path)
+        if st is None:
+            st = os.lstat(path)
+            self.cache.put('lstat', path, st)
+        return st
 
     if not hasattr(os, 'lstat'):
         lstat = stat
+
+    def readlink(self, path):
+        """Return the path a symbolic link points to."""
+        return os.readlink(path)
         
     # --- Wrapper methods around os.path.*
 
@@ -1019,6 +2693,18 @@ class AbstractedFS:
     exists = lexists  # alias for backward compatibility with 0.2.0
 
     # --- Utility methods
+
+    def on_change(self, op, path):
+        """Called after path has been changed ("change") or removed
+        ("delete") through the server (see FTPHandler.record_change).
+        """
+        if self.cache is not None:
+            self.cache.on_event(op, path)
+
+    def close(self):
+        """Called when the session ends, to release any resource held
+        (e.g. descriptors).
+        """
     
     def validpath(self, path):
         """Check whether the path belongs to user's home directory.
@@ -1026,11 +2712,20 @@ class AbstractedFS:
         symbolic link it is resolved to check its real destination.
         Pathnames escaping from user's root directory are considered
         not valid.
+
+        The real path of the root directory is remembered from the
+        first check after root is assigned (i.e. at login): the home
+        stays where it was then, should a directory on its way be
+        replaced by a symbolic link.  path is resolved every time,
+        since any directory on its way may have been replaced by
+        another session or by another process.
         """
-        root = self.realpath(self.root)
+        if self._realroot[0] != self.root:
+            self._realroot = (self.root, self.realpath(self.root))
+        root = self._realroot[1]
         path = self.realpath(path)
-        if not self.root.endswith(os.sep):
-            root = self.root + os.sep
+        if not root.endswith(os.sep):
+            root = root + os.sep
         if not path.endswith(os.sep):
             path = path + os.sep
         if path[0:len(root)] == root:
@@ -1046,6 +2741,34 @@ class AbstractedFS:
         if pattern[0] != '.':
             names = filter(lambda x: x[0] != '.',names)
         return fnmatch.filter(names, pattern)
+
+    def glob_dirs(self, ftppath, limit=0):
+        """Return the directories matching ftppath, an absolute "virtual"
+        pathname which may contain wildcards in any of its components
+        (e.g. "/*/src"), sorted and up to limit (0 means unlimited).
+        Directories which can't be listed or point outside the user's
+        root directory are skipped.
+        """
+        dirs = [self.root]
+        for part in ftppath.split('/'):
+            if not part:
+                continue
+            found = []
+            for dirname in dirs:
+                if glob.has_magic(part):
+                    try:
+                        names = self.glob1(dirname, part)
+                    except OSError:
+                        continue
+                else:
+                    names = [part]
+                for name in names:
+                    path = os.path.join(dirname, name)
+                    if self.isdir(path) and self.validpath(path):
+                        found.append(path)
+            found.sort()
+            dirs = found[:limit or None]
+        return dirs
     
     # --- Listing utilities
     
@@ -1056,9 +2779,16 @@ class AbstractedFS:
     def get_list_dir(self, path):
         """Return a directory listing in a form suitable for LIST command."""
         if self.isdir(path):
+            if self.cache is not None:
+                data = self.cache.get('list', path)
+                if data is not None:
+                    return data
             listing = self.listdir(path)
             listing.sort()
-            return self.format_list(path, listing)
+            data = self.format_list(path, listing)
+            if self.cache is not None:
+                self.cache.put('list', path, data)
+            return data
         # if path is a file or a symlink we return information about it
         else:
             basedir, filename = os.path.split(path)
@@ -1080,7 +2810,13 @@ class AbstractedFS:
                 listing.sort()
                 data = self.format_list(basedir, listing)
             elif glob.has_magic(basedir):
-                return 'Directory recursion not supported.\r\n'
+                data = []
+                for dirname in self.glob_dirs(basedir):
+                    listing = self.glob1(dirname, basename)
+                    listing.sort()
+                    data.append('%s:\r\n%s\r\n' %(self.fs2ftp(dirname),
+                                self.format_list(dirname, listing)))
+                data = ''.join(data)
             else:
                 basedir = self.ftp2fs(basedir)
                 listing = self.glob1(basedir, basename)
@@ -1109,31 +2845,32 @@ class AbstractedFS:
         -rw-rw-rw-   1 owner   group    7045120 Sep 02  3:47 music.mp3
         drwxrwxrwx   1 owner   group          0 Aug 31 18:50 e-books
         -rw-rw-rw-   1 owner   group        380 Sep 02  3:40 module.py
+
+        Mode strings, owner names and dates are memoized (see
+        _ListingMemo) as they are shared by most entries.
         """
+        memo = _listing_memo
+        memo.check()
+        lstat = self.lstat
+        join = os.path.join
         result = []
         for basename in listing:
-            file = os.path.join(basedir, basename)
+            file = join(basedir, basename)
             try:
-                st = self.lstat(file)
+                st = lstat(file)
             except os.error:
                 if ignore_err:
                     continue
                 raise
-            perms = filemode(st.st_mode)  # permissions
+            perms = memo.filemode(st.st_mode)  # permissions
             nlinks = st.st_nlink  # number of links to inode
             if not nlinks:  # non-posix system, let's use a bogus value
                 nlinks = 1
             size = st.st_size  # file size
             if pwd and grp:
                 # get user and group name, else just use the raw uid/gid
-                try:
-                    uname = pwd.getpwuid(st.st_uid).pw_name
-                except KeyError:
-                    uname = st.st_uid
-                try:
-                    gname = grp.getgrgid(st.st_gid).gr_name
-                except KeyError:
-                    gname = st.st_gid
+                uname = memo.username(st.st_uid)
+                gname = memo.groupname(st.st_gid)
             else:
                 # on non-posix systems the only chance we use default
                 # bogus values for owner and group
@@ -1142,12 +2879,12 @@ class AbstractedFS:
             # stat.st_mtime could fail (-1) if last mtime is too old
             # in which case we return the local time as last mtime
             try:
-                mtime = time.strftime("%b %d %H:%M", time.localtime(st.st_mtime))
+                mtime = memo.list_time(st.st_mtime)
             except ValueError:
                 mtime = time.strftime("%b %d %H:%M")
             # if the file is a symlink, resolve it, e.g. "symlink -> realfile"
             if stat.S_ISLNK(st.st_mode):
-                basename = basename + " -> " + os.readlink(file)
+                basename = basename + " -> " + self.readlink(file)
                 
             # formatting is matched with proftpd ls output
             result.append("%s %3s %-8s %-8s %8s %s %s\r\n" %(perms, nlinks,
@@ -1155,6 +2892,50 @@ class AbstractedFS:
                                                              mtime, basename))
         return ''.join(result)
     
+    def get_available_facts(self):
+        """Return the list of the facts format_mlsx is able to provide
+        on this platform, in the order they are listed.
+        """
+        facts = ['type', 'size', 'modify']
+        if os.name == 'nt':
+            # on Windows we can provide also the creation time
+            facts.append('create')
+        # Provide uid, gid and mode facts if we're on a UNIX system.
+        # We assume that by checking if pwd and grp are imported.
+        # Theorically we could provide mode also on Windows but I'm
+        # not sure about its reliability.
+        if pwd and grp:
+            facts.extend(['UNIX.mode', 'UNIX.uid', 'UNIX.gid'])
+        # Provide unique fact (see RFC-3659, chapter 7.5.2) on
+        # posix platforms only; we get it by mixing st_dev and
+        # st_ino values which should be enough for granting an
+        # uniqueness for the file listed.
+        # The same approach is used by pure-ftpd.
+        # Implementors who want to provide unique fact on other
+        # platforms should use some platform-specific method (e.g.
+        # on Windows NTFS filesystems MTF records could be used).
+        if os.name == 'posix':
+            facts.append('unique')
+        return facts
+
+    def get_dir_types(self, path):
+        """Return a dictionary telling whether each entry of directory
+        path is a directory (symbolic links being followed), or None if
+        that can't be known without a stat() call per entry.
+
+        This uses scandir(), which gets the type of most entries along
+        with their names.
+        """
+        if scandir is None:
+            return None
+        types = {}
+        try:
+            for entry in scandir(path):
+                types[entry.name] = entry.is_dir()
+        except OSError:
+            return None
+        return types
+
     def format_mlsx(self, basedir, listing, ignore_err=True):
         """Return a directory listing in a form suitable with MLSD and
         MLST commands including a list of "facts" referring the listed
@@ -1167,9 +2948,10 @@ class AbstractedFS:
          - listing: a list containing the names of the entries in basedir
          - ignore_err: if False raise exception if os.stat() call fails
 
-        Note that "facts" returned may change depending on the platform
-        and on what user specified by using the OPTS command (if
-        implemented).
+        Only the facts in self.facts (as selected by using the OPTS
+        command) are returned; those not requested aren't computed at
+        all and if "type" is the only one the file type is taken from
+        get_dir_types() rather than from a stat() call, when possible.
 
         This is how output could appear to the client issuing
         a MLSD request:
@@ -1178,60 +2960,76 @@ class AbstractedFS:
         type=dir;size=4096;modify=20071127230206;unique=801e38e3; ebooks
         type=file;size=211;modify=20071103093626;unique=801e38e2; module.py
         """
-        ftype = size = modify = create = mode = uid = gid = unique = ""
+        facts = self.facts
+        show_type = 'type' in facts
+        show_size = 'size' in facts
+        show_modify = 'modify' in facts
+        show_create = 'create' in facts
+        show_mode = 'UNIX.mode' in facts
+        show_uid = 'UNIX.uid' in facts
+        show_gid = 'UNIX.gid' in facts
+        show_unique = 'unique' in facts
+        need_stat = not ignore_err or show_size or show_modify or \
+                    show_create or show_mode or show_uid or show_gid or \
+                    show_unique
+        memo = _listing_memo
+        memo.check()
+        # dirname -> get_dir_types() result (MLSD -R lists entries
+        # of subdirectories too, named after their relative path)
+        dir_types = {}
+        st = None
         result = []
         for basename in listing:
             file = os.path.join(basedir, basename)
-            try:
-                st = self.stat(file)
-            except OSError:
-                if ignore_err:
-                    continue
-                raise
+            isdir = None
+            if show_type and not need_stat:
+                dirname, name = os.path.split(file)
+                if dirname not in dir_types:
+                    dir_types[dirname] = self.get_dir_types(dirname)
+                if dir_types[dirname] is not None:
+                    isdir = dir_types[dirname].get(name)
+            if need_stat or (show_type and isdir is None):
+                try:
+                    st = self.stat(file)
+                except OSError:
+                    if ignore_err:
+                        continue
+                    raise
+                isdir = stat.S_ISDIR(st.st_mode)
+            ftype = size = modify = create = mode = uid = gid = unique = ""
             # file type
-            if stat.S_ISDIR(st.st_mode):
-                if basename == '.':
-                    ftype = 'type=cdir;'
-                elif basename == '..':
-                    ftype = 'type=pdir;'
+            if show_type:
+                if isdir:
+                    if basename == '.':
+                        ftype = 'type=cdir;'
+                    elif basename == '..':
+                        ftype = 'type=pdir;'
+                    else:
+                        ftype = 'type=dir;'
                 else:
-                    ftype = 'type=dir;'
-            else:
-                ftype = 'type=file;'
-            size = 'size=%s;' %st.st_size  # file size
+                    ftype = 'type=file;'
+            if show_size:
+                size = 'size=%s;' %st.st_size
             # last modification time
-            try:
-                modify = 'modify=%s;' %time.strftime("%Y%m%d%H%M%S",
-                                       time.localtime(st.st_mtime))
-            except ValueError:
-                # stat.st_mtime could fail (-1) if last mtime is too old
-                modify = ""
-            if os.name == 'nt':
-                # on Windows we can provide also the creation time
+            if show_modify:
                 try:
-                    create = 'create=%s;' %time.strftime("%Y%m%d%H%M%S",
-                                           time.localtime(st.st_ctime))
+                    modify = 'modify=%s;' %memo.mlsx_time(st.st_mtime)
                 except ValueError:
-                    create = ""
-            # Provide uid, gid and mode facts if we're on a UNIX system.
-            # We assume that by checking if pwd and grp are imported.
-            # Theorically we could provide mode also on Windows but I'm
-            # not sure about its reliability.
-            if pwd and grp:
+                    # stat.st_mtime could fail (-1) if last mtime is too old
+                    pass
+            if show_create:
+                try:
+                    create = 'create=%s;' %memo.mlsx_time(st.st_ctime)
+                except ValueError:
+                    pass
+            if show_mode:
                 mode = 'UNIX.mode=%s;' %oct(st.st_mode & 0777)
+            if show_uid:
                 uid = 'UNIX.uid=%s;' %st.st_uid
+            if show_gid:
                 gid = 'UNIX.gid=%s;' %st.st_gid
-            # Provide unique fact (see RFC-3659, chapter 7.5.2) on
-            # posix platforms only; we get it by mixing st_dev and
-            # st_ino values which should be enough for granting an
-            # uniqueness for the file listed.
-            # The same approach is used by pure-ftpd.
-            # Implementors who want to provide unique fact on other
-            # platforms should use some platform-specific method (e.g.
-            # on Windows NTFS filesystems MTF records could be used).
-            if os.name == 'posix':
-                unique = "unique=%x%x;" %(st.st_dev, st.st_ino)
-
+            if show_unique:
+                unique = 'unique=%x%x;' %(st.st_dev, st.st_ino)
             result.append("%s%s%s%s%s%s%s%s %s\r\n" %(ftype, size, modify,
                                                       create, mode, uid, gid,
                                                       unique, basename))
@@ -1292,6 +3090,31 @@ class FTPHandler(asynchat.async_chat):
     # random ports.
     passive_ports = None
 
+    # Set to False to leave the Nagle algorithm enabled on the control
+    # connection (TCP_NODELAY is set since replies are coalesced).
+    tcp_nodelay = True
+
+    # Maximum number of pipelined commands waiting for the preceding
+    # ones to complete; once reached the server stops reading from
+    # the control connection until the queue drains.
+    max_queued_cmds = 100
+
+    # Maximum number of pathnames accepted by SITE MSTAT.
+    max_mstat_paths = 10000
+
+    # Maximum number of pathnames returned by SITE FIND.
+    max_find_results = 1000
+
+    # Maximum depth of recursive listings (LIST -R, MLSD -R, STAT -R)
+    # and maximum number of entries returned by them and by STAT with
+    # wildcards (0 means unlimited).
+    max_list_depth = 16
+    max_list_entries = 100000
+
+    # Seconds a transfer waits for its data connection before failing
+    # with a 425 reply (0 == forever).
+    data_connection_timeout = 30
+
     def __init__(self, conn, ftpd_instance):
         asynchat.async_chat.__init__(self, conn=conn)
         self.ftpd_instance = ftpd_instance
@@ -1300,20 +3123,57 @@ class FTPHandler(asynchat.async_chat):
         self.in_buffer_len = 0
         self.set_terminator("\r\n")
 
+        # replies are buffered and sent once per loop iteration (see
+        # push()); since they are coalesced there's no need to wait
+        # for the ack of the previous segment (Nagle algorithm)
+        self.reply_buffer = []
+        if self.tcp_nodelay:
+            try:
+                self.socket.setsockopt(socket.IPPROTO_TCP,
+                                       socket.TCP_NODELAY, 1)
+            except (socket.error, AttributeError):
+                pass
+
         # session attributes
         self.fs = self.abstracted_fs()
         self.in_dtp_queue = None
         self.out_dtp_queue = None
         self.authenticated = False
+        # waiting for the verification of a password or, after a
+        # failed login, for the end of the delay (see delay_failure)
+        self.auth_pending = False
+        self.tarpit_call = None
         self.username = ""
         self.attempted_logins = 0
         self.current_type = 'a'
         self.restart_position = 0
         self.quit_pending = False
 
+        # token buckets used by data channels for bandwidth throttling
+        self.read_buckets = (ftpd_instance.read_bucket,)
+        self.write_buckets = (ftpd_instance.write_bucket,)
+
         # dtp attributes
         self.data_server = None
         self.data_channel = None
+        # ActiveDTP connecting to the client (PORT)
+        self.data_connector = None
+        # CallLater failing the transfer waiting for the data connection
+        self.dtp_wait_call = None
+
+        # admission control attributes: the storage root of the I/O
+        # slot held (or waited for) and the admission queue ticket
+        self.io_root = None
+        self.io_ticket = None
+
+        # commands received while the preceding ones are not completed
+        # (pipelining): (line, cmd, arg) tuples
+        self.cmd_queue = deque()
+        self.processing_queue = False
+
+        # file being uploaded, recorded in the change journal once
+        # the transfer is over
+        self.upload_path = None
 
     def __del__(self):
         debug("FTPHandler.__del__()")
@@ -1352,8 +3212,46 @@ class FTPHandler(asynchat.async_chat):
     # --- asyncore / asynchat overridden methods
 
     def readable(self):
-        # if there's a quit pending we stop reading data from socket
-        return not self.quit_pending
+        # if there's a quit pending we stop reading data from socket;
+        # same if too many commands are queued
+        return not self.quit_pending and \
+               len(self.cmd_queue) < self.max_queued_cmds
+
+    def writable(self):
+        return self.reply_buffer or asynchat.async_chat.writable(self)
+
+    def handle_write(self):
+        # replies not flushed by the polling loop (e.g. when running
+        # asyncore.loop() instead of FTPServer.serve_forever())
+        self.flush_replies()
+        asynchat.async_chat.handle_write(self)
+
+    def push(self, data):
+        """Buffer data (a reply) to be sent once the current iteration
+        of the polling loop is over, along with the other replies
+        pushed in the meantime.  This way pipelined commands and
+        multi-line replies result in a single send().
+        """
+        if not self.reply_buffer:
+            _replies.append(self)
+        self.reply_buffer.append(data)
+
+    def flush_replies(self):
+        """Hand the buffered replies to asynchat, which tries to send
+        them immediately."""
+        if self.reply_buffer:
+            data = ''.join(self.reply_buffer)
+            self.reply_buffer = []
+            if self.connected:
+                asynchat.async_chat.push(self, data)
+
+    def push_with_producer(self, producer):
+        self.flush_replies()
+        asynchat.async_chat.push_with_producer(self, producer)
+
+    def close_when_done(self):
+        self.flush_replies()
+        asynchat.async_chat.close_when_done(self)
 
     def collect_incoming_data(self, data):
         """Read incoming data and append to the input buffer."""
@@ -1369,16 +3267,24 @@ class FTPHandler(asynchat.async_chat):
             self.in_buffer = []
             self.in_buffer_len = 0
 
-    # commands accepted before authentication
-    unauth_cmds = ('FEAT','HELP','NOOP','PASS','QUIT','STAT','SYST','USER')
+    def get_cmd_table(self, prefix='ftp_', attrs=cmd_attrs):
+        """Return the dispatch table mapping the commands described
+        by attrs to the methods of this handler class whose name is
+        prefix + command, along with the command attributes.
 
-    # commands needing an argument
-    arg_cmds = ('ALLO','APPE','DELE','MDTM','MODE','MKD', 'PORT','REST','RETR','RMD',
-                'RNFR','RNTO','SIZE', 'STOR','STRU','TYPE','USER','XMKD','XRMD')
-
-    # commands needing no argument
-    unarg_cmds = ('ABOR','CDUP','FEAT','NOOP','PASV','PWD','QUIT','REIN','SYST',
-                  'XCUP','XPWD')
+        Tables are built once per handler class and cached.
+        """
+        key = (self.__class__, prefix)
+        try:
+            return _cmd_tables[key]
+        except KeyError:
+            table = {}
+            for cmd, cmd_attr in attrs.items():
+                method = getattr(self.__class__, prefix + cmd, None)
+                if method is not None:
+                    table[cmd] = (method,) + cmd_attr
+            _cmd_tables[key] = table
+            return table
 
     def found_terminator(self):
         r"""Called when the incoming data stream matches the \r\n terminator."""
@@ -1386,74 +3292,123 @@ class FTPHandler(asynchat.async_chat):
         self.in_buffer = []
         self.in_buffer_len = 0
 
-        cmd = line.split(' ')[0].upper()
         space = line.find(' ')
         if space != -1:
+            cmd = line[:space].upper()
             arg = line[space + 1:]
         else:
+            cmd = line.upper()
             arg = ""
 
+        if self.cmd_queue or self.commands_suspended():
+            # commands having "special semantics" are served at once,
+            # the others wait for the preceding ones to complete
+            if not ('ABOR' in cmd or 'STAT' in cmd):
+                self.cmd_queue.append((line, cmd, arg))
+                # ...but not for a data connection which may never
+                # come
+                if cmd in ('QUIT', 'REIN') and self.waiting_data_connection():
+                    self.on_dtp_failure("425 Can't open data connection.")
+                return
+        self.execute(line, cmd, arg)
+
+    def execute(self, line, cmd, arg):
+        """Execute a command received on the command channel."""
         if cmd != 'PASS':
             self.logline("<== %s" %line)
         else:
-            self.logline("<== %s %s" %(line.split(' ')[0], '*' * 6))
+            self.logline("<== %s %s" %(line[:4], '*' * 6))
+
+        entry = self.get_cmd_table().get(cmd)
+        if entry is not None:
+            self.run_command(cmd, entry, arg)
+        else:
+            # recognize those commands having "special semantics"
+            if 'ABOR' in cmd:
+                self.ftp_ABOR("")
+            elif 'STAT' in cmd:
+                self.ftp_STAT("")
+            # unknown command
+            else:
+                self.cmd_not_understood(line)
+
+    def commands_suspended(self):
+        """Return True if the execution of pipelined commands has to
+        be suspended, waiting for an event concerning the preceding
+        command (a data channel transfer, an I/O slot...).
+        """
+        return self.auth_pending or self.transfer_pending() or \
+               (self.io_ticket is not None and
+               not self.ftpd_instance.admission.granted(self.io_ticket))
+
+    def process_queue(self):
+        """Execute the queued commands, in order, until the queue is
+        empty or a command suspends the execution of the following
+        ones.  Called when the event a command was waiting for occurs.
+        """
+        if self.processing_queue:
+            return
+        self.processing_queue = True
+        try:
+            while self.cmd_queue and not self.commands_suspended():
+                line, cmd, arg = self.cmd_queue.popleft()
+                self.execute(line, cmd, arg)
+        finally:
+            self.processing_queue = False
+
+    def run_command(self, cmd, entry, arg):
+        """Check arg against the attributes of cmd found in its
+        dispatch table entry and, if everything is fine, call the
+        method implementing it.
+        """
+        method, needs_arg, auth, path, perm, io = entry
 
         # let's check if user provided an argument for those commands
-        # needing one
-        if not arg and cmd in self.arg_cmds:
+        # needing one, and the same for those requiring no argument
+        if needs_arg and not arg:
             self.cmd_missing_arg()
             return
-
-        # let's do the same for those commands requiring no argument.
-        elif arg and cmd in self.unarg_cmds:
+        elif arg and needs_arg is False:
             self.cmd_needs_no_arg()
             return
 
         # provide a limited set of commands if user isn't
         # authenticated yet
-        if (not self.authenticated):
-            if cmd in self.unauth_cmds:
-                # we permit STAT during this phase but we don't want
-                # STAT to return a directory LISTing if the user is
-                # not authenticated yet (this could happen if STAT
-                # is used with an argument)
-                if (cmd == 'STAT') and arg:
-                    self.respond("530 Log in with USER and PASS first.")
-                else:
-                    method = getattr(self, 'ftp_' + cmd)
-                    method(arg)  # call the proper ftp_* method
-            elif cmd in proto_cmds:
-                self.respond("530 Log in with USER and PASS first.")
-            else:
-                self.cmd_not_understood(line)
+        if auth and not self.authenticated:
+            self.respond("530 Log in with USER and PASS first.")
+            return
 
-        # provide full command set
-        elif (self.authenticated) and (cmd in proto_cmds):
-            # For the following commands we have to make sure that the
-            # real path destination belongs to the user's root
-            # directory.  If provided path is a symlink we follow its
-            # final destination to do so.
-            if cmd in ('APPE','CWD','DELE','MDTM','NLST','MLSD','MLST','RETR',
-                       'RMD','SIZE','STOR','XCWD','XRMD'):
-                if not self.fs.validpath(self.fs.ftp2fs(arg)):
-                    line = self.fs.ftpnorm(arg)
-                    err = '"%s" points to a path which is outside ' \
-                          "the user's root directory" %line
-                    self.respond("550 %s." %err)
-                    self.log('FAIL %s "%s". %s.' %(cmd, line, err))
-                    return
-            method = getattr(self, 'ftp_' + cmd)
-            method(arg)  # call the proper ftp_* method
+        if path or perm:
+            # translated once for all the uses of arg by this command
+            arg = self.fs.resolve(arg)
+            fspath = self.fs.ftp2fs(arg)
+            # For such commands we have to make sure that the real
+            # path destination belongs to the user's root directory.
+            # If provided path is a symlink we follow its final
+            # destination to do so.
+            if path and not self.fs.validpath(fspath):
+                line = self.fs.ftpnorm(arg)
+                err = '"%s" points to a path which is outside ' \
+                      "the user's root directory" %line
+                self.respond("550 %s." %err)
+                self.log('FAIL %s "%s". %s.' %(cmd, line, err))
+                return
+            if perm == 'r':
+                allowed = self.authorizer.r_perm(self.username, fspath)
+            elif perm == 'w':
+                allowed = self.authorizer.w_perm(self.username, fspath)
+            else:
+                allowed = True
+            if not allowed:
+                self.log('FAIL %s "%s". Not enough privileges.'
+                         %(cmd, self.fs.ftpnorm(arg)))
+                self.respond("550 Can't %s: not enough privileges." %cmd)
+                return
 
+        if io:
+            self.admit(method, arg)
         else:
-            # recognize those commands having "special semantics"
-            if 'ABOR' in cmd:
-                self.ftp_ABOR("")
-            elif 'STAT' in cmd:
-                self.ftp_STAT("")
-            # unknown command
-            else:
-                self.cmd_not_understood(line)
+            method(self, arg)  # call the proper ftp_* method
 
     def handle_expt(self):
         """Called when there is out of band (OOB) data for the socket
@@ -1485,6 +3440,20 @@ class FTPHandler(asynchat.async_chat):
     def close(self):
         """Close the current channel disconnecting the client."""
         self.debug("FTPHandler.close()")
+        # last replies (e.g. 421 or 530) are sent if possible
+        self.flush_replies()
+        # pipelined commands are discarded, and so is a transfer
+        # waiting for the data connection
+        self.cmd_queue.clear()
+        self.discard_dtp_queue()
+        self.auth_pending = False
+        if self.authenticated:
+            self.authenticated = False
+            self.authorizer.on_logout(self.username)
+            self.ftpd_instance.release_user_buckets(self.username)
+        if self.tarpit_call is not None:
+            self.tarpit_call.cancel()
+            self.tarpit_call = None
 
         if self.data_server:
             self.data_server.close()
@@ -1494,8 +3463,11 @@ class FTPHandler(asynchat.async_chat):
             self.data_channel.close()
             del self.data_channel
 
+        self.close_data_connector()
         del self.out_dtp_queue
         del self.in_dtp_queue
+        self.release_io_slot()
+        self.fs.close()
 
         # remove client IP address from ip map
         self.ftpd_instance.ip_map.remove(self.remote_ip)
@@ -1516,10 +3488,18 @@ class FTPHandler(asynchat.async_chat):
         if self.data_server:
             self.data_server.close()
         self.data_server = None
+        if self.dtp_wait_call is not None:
+            self.dtp_wait_call.cancel()
+            self.dtp_wait_call = None
+        # the preliminary reply must precede the data
+        self.flush_replies()
 
         # check for data to send
+        # (the queues are emptied first since the transfer may even
+        # complete before push() returns)
         if self.out_dtp_queue:
             data, isproducer, log = self.out_dtp_queue
+            self.out_dtp_queue = None
             if log:
                 self.log(log)
             if not isproducer:
@@ -1528,23 +3508,155 @@ class FTPHandler(asynchat.async_chat):
                 self.data_channel.push_with_producer(data)
             if self.data_channel:
                 self.data_channel.close_when_done()
-            self.out_dtp_queue = None
 
         # check for data to receive
         elif self.in_dtp_queue:
-            fd, log = self.in_dtp_queue
+            fd, log, on_complete = self.in_dtp_queue
+            self.in_dtp_queue = None
             if log:
                 self.log(log)
             self.data_channel.file_obj = fd
+            self.data_channel.on_complete = on_complete
             self.data_channel.enable_receiving(self.current_type)
-            self.in_dtp_queue = None
 
     def on_dtp_close(self):
         """Called on DTPHandler.close()."""
         self.debug("FTPHandler.on_dtp_close()")
         self.data_channel = None
+        if self.upload_path is not None:
+            self.record_change('change', self.upload_path)
+            self.upload_path = None
+        self.release_io_slot()
         if self.quit_pending:
             self.close_when_done()
+        else:
+            self.process_queue()
+
+    def on_dtp_failure(self, resp):
+        """Called when the data connection can't be made (connection
+        refused, timeout...): reply resp, give up the transfer waiting
+        for it, if any, and resume the pipelined commands.
+        """
+        self.debug("FTPHandler.on_dtp_failure()")
+        if self.data_server:
+            self.data_server.close()
+            self.data_server = None
+        self.respond(resp)
+        if self.in_dtp_queue or self.out_dtp_queue:
+            self.log("Transfer cancelled: %s" %resp[4:])
+        self.discard_dtp_queue()
+        self.process_queue()
+
+    def on_dtp_timeout(self):
+        self.dtp_wait_call = None
+        self.on_dtp_failure("425 Can't open data connection.")
+
+    def queue_transfer(self, out_dtp=None, in_dtp=None):
+        """Queue a transfer until the data connection is made (see
+        on_dtp_connection); it fails after data_connection_timeout
+        seconds.
+        """
+        self.out_dtp_queue = out_dtp
+        self.in_dtp_queue = in_dtp
+        if self.data_connection_timeout and self.dtp_wait_call is None:
+            self.dtp_wait_call = CallLater(self.data_connection_timeout,
+                                           self.on_dtp_timeout)
+
+    def discard_dtp_queue(self):
+        """Give up the transfer waiting for the data connection, if
+        any, and the I/O slot it holds."""
+        if self.dtp_wait_call is not None:
+            self.dtp_wait_call.cancel()
+            self.dtp_wait_call = None
+        if self.in_dtp_queue:
+            fd = self.in_dtp_queue[0]
+            self.in_dtp_queue = None
+            if not isinstance(fd, _Collector):
+                _close_file(fd)
+        self.out_dtp_queue = None
+        if not self.transfer_pending():
+            self.release_io_slot()
+
+    def close_data_connector(self):
+        """Stop connecting to the client (PORT), without reporting a
+        failure."""
+        connector = self.data_connector
+        if connector is not None:
+            self.data_connector = None
+            connector.close()
+
+    def waiting_data_connection(self):
+        """Return True if a transfer waits for the data connection."""
+        return bool(self.out_dtp_queue or self.in_dtp_queue)
+
+    # --- change journal
+
+    def record_change(self, op, path):
+        """Record a change of path in the change journal, if any, and
+        let the file system know about it."""
+        journal = self.ftpd_instance.journal
+        if journal is not None:
+            journal.record(op, path)
+        self.fs.on_change(op, path)
+
+    # --- admission control
+
+    def admit(self, method, arg):
+        """Call method (the unbound method implementing a disk-heavy
+        command) with arg as soon as the admission queue grants an I/O
+        slot for the storage root it refers to.
+        """
+        if self.io_ticket is not None:
+            # a previous command is still waiting (or its transfer is
+            # not over yet); reuse the slot, which is going to be
+            # released once the new command's transfer completes
+            if self.ftpd_instance.admission.granted(self.io_ticket):
+                self._run_admitted(method, arg)
+            else:
+                self.respond("450 Another request is waiting for the "
+                             "disk; try again later.")
+            return
+        admission = self.ftpd_instance.admission
+        self.io_root = admission.get_root(self.fs.ftp2fs(arg or self.fs.cwd),
+                                          self.fs.root)
+        self.io_ticket = admission.acquire(self.io_root, self._run_admitted,
+                                           method, arg)
+        if admission.granted(self.io_ticket):
+            self._run_admitted(method, arg)
+
+    def _run_admitted(self, method, arg):
+        method(self, arg)
+        # release the slot immediately unless a transfer is pending
+        if not self.transfer_pending():
+            self.release_io_slot()
+        self.process_queue()
+
+    def transfer_pending(self):
+        """Return True if a data transfer was requested and is not
+        over yet (waiting for the data connection, in progress or
+        waiting for the final reply).
+        """
+        if self.waiting_data_connection():
+            # unless no data connection is on its way (e.g. PORT was
+            # refused): the client may still send PORT or PASV
+            return bool(self.data_server or self.data_connector)
+        dc = self.data_channel
+        return bool(dc and (dc.producer_fifo or dc.receive or dc.file_obj or
+                            dc.transfer_finished))
+
+    def release_io_slot(self):
+        """Release the I/O slot held by the session or give up
+        waiting for it.
+        """
+        if self.io_ticket is None:
+            return
+        admission = self.ftpd_instance.admission
+        if admission.granted(self.io_ticket):
+            admission.release(self.io_root)
+        else:
+            admission.cancel(self.io_root, self.io_ticket)
+        self.io_root = None
+        self.io_ticket = None
 
     # --- utility
 
@@ -1565,6 +3677,8 @@ class FTPHandler(asynchat.async_chat):
         """
         if self.data_channel:
             self.respond("125 Data connection already open. Transfer starting.")
+            # the reply must precede the data
+            self.flush_replies()
             if log:
                 self.log(log)
             if not isproducer:
@@ -1575,7 +3689,36 @@ class FTPHandler(asynchat.async_chat):
                 self.data_channel.close_when_done()
         else:
             self.respond("150 File status okay. About to open data connection.")
-            self.out_dtp_queue = (data, isproducer, log)
+            self.queue_transfer(out_dtp=(data, isproducer, log))
+
+    def split_list_args(self, line):
+        """Split the argument of LIST, MLSD and STAT into /bin/ls-like
+        options (e.g. "-lR" -> "lR") and pathname.
+        """
+        if line.startswith('-'):
+            space = line.find(' ')
+            if space == -1:
+                flags, path = line[1:], ''
+            else:
+                flags, path = line[1:space], line[space + 1:]
+            if flags.isalpha():
+                return flags, path
+        return '', line
+
+    def push_tree(self, path, line, format, cmd, headers=True):
+        """Push the recursive listing of directory path (line is the
+        "virtual" pathname requested) into the data channel."""
+        if not self.fs.validpath(path):
+            err = "Not in the user's root directory"
+            self.log('FAIL %s "%s". %s.' %(cmd, line, err))
+            self.respond('550 %s.' %err)
+            return
+        producer = _TreeProducer(self, [path], format,
+                                 maxdepth=self.max_list_depth,
+                                 maxentries=self.max_list_entries,
+                                 headers=headers)
+        self.push_dtp_data(producer, isproducer=True,
+                           log='OK %s -R "%s". Transfer starting.' %(cmd, line))
 
     def cmd_not_understood(self, line):
         """Return a 'command not understood' message to the client."""
@@ -1605,6 +3748,9 @@ class FTPHandler(asynchat.async_chat):
         """Flush account information by clearing attributes that need
         to be reset on a REIN or new USER command.
         """
+        if self.authenticated:
+            self.authorizer.on_logout(self.username)
+            self.ftpd_instance.release_user_buckets(self.username)
         if self.data_channel:
             if not self.data_channel.transfer_in_progress():
                 self.data_channel.close()
@@ -1612,6 +3758,7 @@ class FTPHandler(asynchat.async_chat):
         if self.data_server:
             self.data_server.close()
             self.data_server = None
+        self.close_data_connector()
 
         self.fs.rnfr = None
         self.authenticated = False
@@ -1620,8 +3767,13 @@ class FTPHandler(asynchat.async_chat):
         self.current_type = 'a'
         self.restart_position = 0
         self.quit_pending = False
-        self.in_dtp_queue = None
-        self.out_dtp_queue = None
+        self.discard_dtp_queue()
+        self.upload_path = None
+        self.release_io_slot()
+        self.read_buckets = (self.ftpd_instance.read_bucket,)
+        self.write_buckets = (self.ftpd_instance.write_bucket,)
+        # back to the server's authorizer (see ftp_PASS)
+        self.authorizer = self.__class__.authorizer
 
 
         # --- connection
@@ -1668,6 +3820,8 @@ class FTPHandler(asynchat.async_chat):
             self.data_channel.close()
             self.data_channel = None
 
+        self.close_data_connector()
+
         # make sure we are not hitting the max connections limit
         if self.ftpd_instance.max_cons:
             if len(self._map) >= self.ftpd_instance.max_cons:
@@ -1690,6 +3844,8 @@ class FTPHandler(asynchat.async_chat):
             self.data_channel.close()
             self.data_channel = None
 
+        self.close_data_connector()
+
         # make sure we are not hitting the max connections limit
         if self.ftpd_instance.max_cons:
             if len(self._map) >= self.ftpd_instance.max_cons:
@@ -1732,12 +3888,16 @@ class FTPHandler(asynchat.async_chat):
         client.
         """
         # - If no argument, fall back on cwd as default.
-        # - Some older FTP clients erroneously issue /bin/ls-like LIST
-        #   formats in which case we fall back on cwd as default.
-        if not line or line.lower() in ('-a', '-l', '-al', '-la'):
+        # - Some FTP clients issue /bin/ls-like LIST options (e.g.
+        #   "-la"); all of them but "-R" (recursive) are ignored.
+        flags, line = self.split_list_args(line)
+        if not line:
             line = self.fs.cwd
         path = self.fs.ftp2fs(line)
         line = self.fs.ftpnorm(line)
+        if 'R' in flags and self.fs.isdir(path):
+            self.push_tree(path, line, self.fs.format_list, 'LIST')
+            return
         try:
             data = self.fs.get_list_dir(path)
         except OSError, err:
@@ -1811,6 +3971,8 @@ class FTPHandler(asynchat.async_chat):
         """Return contents of a directory in a machine-processable form
         as defined in RFC-3659.
         """
+        # "-R" option (not part of RFC-3659) lists subdirectories too
+        flags, line = self.split_list_args(line)
         # if no argument, fall back on cwd as default
         if not line:
             line = self.fs.cwd
@@ -1822,6 +3984,10 @@ class FTPHandler(asynchat.async_chat):
             self.log('FAIL MLSD "%s". %s.' %(line, err))
             self.respond("501 %s." %err)
             return
+        if 'R' in flags:
+            self.push_tree(path, line, self.fs.format_mlsx, 'MLSD',
+                           headers=False)
+            return
         try:
             listing = self.fs.listdir(path)
         except OSError, err:
@@ -1839,12 +4005,6 @@ class FTPHandler(asynchat.async_chat):
         """
         file = self.fs.ftp2fs(line)
 
-        if not self.authorizer.r_perm(self.username, file):
-            self.log('FAIL RETR "s". Not enough privileges.'
-                        %self.fs.ftpnorm(line))
-            self.respond("550 Can't RETR: not enough privileges.")
-            return
-
         try:
             fd = self.fs.open(file, 'rb')
         except IOError, err:
@@ -1929,6 +4089,8 @@ class FTPHandler(asynchat.async_chat):
                 self.log('FAIL %s "%s". %s.' %(cmd, self.fs.ftpnorm(line), why))
                 return
 
+        self.upload_path = file
+        self.record_change('change', file)
         log = 'OK %s "%s". Upload starting.' %(cmd, self.fs.ftpnorm(line))
         if self.data_channel:
             self.respond("125 Data connection already open. Transfer starting.")
@@ -1937,7 +4099,7 @@ class FTPHandler(asynchat.async_chat):
             self.data_channel.enable_receiving(self.current_type)
         else:
             self.respond("150 File status okay. About to open data connection.")
-            self.in_dtp_queue = (fd, log)
+            self.queue_transfer(in_dtp=(fd, log, None))
 
 
     def ftp_STOU(self, line):
@@ -1985,6 +4147,8 @@ class FTPHandler(asynchat.async_chat):
             return
 
         filename = os.path.basename(fd.name)
+        self.upload_path = fd.name
+        self.record_change('change', fd.name)
 
         # now just acts like STOR except that restarting isn't allowed
         log = 'OK STOU "%s". Upload starting.' %filename
@@ -1995,7 +4159,7 @@ class FTPHandler(asynchat.async_chat):
             self.data_channel.enable_receiving(self.current_type)
         else:
             self.respond("150 FILE: %s" %filename)
-            self.in_dtp_queue = (fd, log)
+            self.queue_transfer(in_dtp=(fd, log, None))
 
 
     def ftp_APPE(self, line):
@@ -2022,10 +4186,22 @@ class FTPHandler(asynchat.async_chat):
 
     def ftp_ABOR(self, line):
         """Abort the current data transfer."""
+        # give up waiting for an I/O slot
+        if self.io_ticket is not None and \
+        not self.ftpd_instance.admission.granted(self.io_ticket):
+            self.release_io_slot()
+            self.log("OK ABOR. Request waiting for the disk cancelled.")
+
+        # a PORT was received but connection wasn't made yet
+        connecting = self.data_connector is not None
+        self.close_data_connector()
 
         # ABOR received while no data channel exists
         if (self.data_server is None) and (self.data_channel is None):
-            resp = "225 No transfer to abort."
+            if connecting:
+                resp = "225 ABOR command successful; data channel closed."
+            else:
+                resp = "225 No transfer to abort."
         else:
             # a PASV was received but connection wasn't made yet
             if self.data_server:
@@ -2054,6 +4230,13 @@ class FTPHandler(asynchat.async_chat):
                     resp = "225 ABOR command successful; data channel closed."
         self.respond(resp)
 
+        # a transfer waiting for the data connection is given up
+        if self.waiting_data_connection():
+            self.log("OK ABOR. Transfer waiting for the data connection "
+                     "cancelled.")
+        self.discard_dtp_queue()
+        self.process_queue()
+
 
         # --- authentication
 
@@ -2094,45 +4277,142 @@ class FTPHandler(asynchat.async_chat):
 
         # username ok
         if self.authorizer.has_user(self.username):
-            if self.authorizer.validate_authentication(self.username, line) \
-            or self.username == 'anonymous':
-                msg_login = self.authorizer.get_msg_login(self.username)
-                if len(msg_login) <= 75:
-                    self.respond('230 %s' %msg_login)
-                else:
-                    self.push("230-%s\r\n" %msg_login)
-                    self.respond("230 ")
-
-                self.authenticated = True
-                self.attempted_logins = 0
-                self.fs.root = self.authorizer.get_home_dir(self.username)
-                self.log("User %s logged in." %self.username)
+            # the following commands wait for the verification, which
+            # may complete later (see validate_authentication_async)
+            self.auth_pending = True
+            if self.username == 'anonymous':
+                self.on_authentication(self.username, True)
             else:
-                self.attempted_logins += 1
-                if self.attempted_logins >= self.max_login_attempts:
-                    self.respond("530 Maximum login attempts. Disconnecting.")
-                    self.close()
-                else:
-                    self.respond("530 Authentication failed.")
-                    self.username = ""
-                self.log('Authentication failed (user: "%s").' %self.username)
+                username = self.username
+                self.authorizer.validate_authentication_async(username, line,
+                    lambda ok: self.on_authentication(username, ok))
 
-        # wrong username
+        # wrong username: answered as late as a wrong password would be
         else:
-            self.attempted_logins += 1
-            if self.attempted_logins >= self.max_login_attempts:
-                self.log('Authentication failed: unknown username "%s".'
-                            %self.username)
-                self.respond("530 Maximum login attempts. Disconnecting.")
-                self.close()
-            elif self.username.lower() == 'anonymous':
-                self.respond("530 Anonymous access not allowed.")
-                self.log('Authentication failed: anonymous access not allowed.')
-            else:
-                self.respond("530 Authentication failed.")
-                self.log('Authentication failed: unknown username "%s".'
-                            %self.username)
+            self.auth_pending = True
+            username = self.username
+            self.authorizer.reject_unknown_async(username, line,
+                lambda: self.on_unknown_username(username))
+
+    def on_unknown_username(self, username):
+        """Called once the PASS command of unknown username has taken
+        as long as a password verification."""
+        if not self.auth_pending:
+            # disconnected meanwhile
+            return
+        self.auth_pending = False
+        self.delay_failure(username, self.reject_username)
+        self.process_queue()
+
+    def reject_username(self):
+        """Reply to the PASS command of an unknown user."""
+        self.attempted_logins += 1
+        if self.attempted_logins >= self.max_login_attempts:
+            self.log('Authentication failed: unknown username "%s".'
+                        %self.username)
+            self.respond("530 Maximum login attempts. Disconnecting.")
+            self.close()
+        elif self.username.lower() == 'anonymous':
+            self.respond("530 Anonymous access not allowed.")
+            self.log('Authentication failed: anonymous access not allowed.')
+        else:
+            self.respond("530 Authentication failed.")
+            self.log('Authentication failed: unknown username "%s".'
+                        %self.username)
+            self.username = ""
+
+    def reject_password(self, username):
+        """Reply to the PASS command of username with a wrong
+        password."""
+        self.attempted_logins += 1
+        if self.attempted_logins >= self.max_login_attempts:
+            self.respond("530 Maximum login attempts. Disconnecting.")
+            self.close()
+        else:
+            self.respond("530 Authentication failed.")
+            self.username = ""
+        self.log('Authentication failed (user: "%s").' %username)
+
+    def delay_failure(self, username, reject, *args):
+        """Count a failed login of username and call reject(*args) to
+        reply once the delay the failure earns has elapsed (see
+        FTPServer.login_failed).  The following commands wait for it,
+        as for the verification of the password.
+        """
+        delay = self.ftpd_instance.login_failed(self.remote_ip, username)
+        if not delay:
+            reject(*args)
+            return
+        self.auth_pending = True
+        self.tarpit_call = CallLater(delay, self.end_tarpit, reject, args)
+
+    def end_tarpit(self, reject, args):
+        self.tarpit_call = None
+        if not self.auth_pending:
+            # disconnected meanwhile
+            return
+        self.auth_pending = False
+        reject(*args)
+        self.process_queue()
+
+    def on_authentication(self, username, ok):
+        """Called with the result of the verification of the password
+        of username (ok is True if it matched, False if it didn't and
+        None if the authorizer couldn't tell): log the user in or count
+        the failed attempt, then resume the pipelined commands.
+        """
+        if not self.auth_pending:
+            # disconnected meanwhile
+            return
+        self.auth_pending = False
+        if ok is None:
+            # not the client's fault: no failed attempt, no delay
+            self.respond("421 Service not available, closing control "
+                         "connection.")
+            self.log('Authentication not available (user: "%s").'
+                     %username)
+            self.close_when_done()
+            return
+        if ok:
+            home = self.authorizer.get_home_dir(self.username)
+            # users may be added without checking their home
+            # directory (e.g. userdb.UserTable)
+            if get_fs_backend(home) is None and not os.path.isdir(home):
+                self.respond("530 Home directory not available.")
+                logerror('No such home directory "%s" (user: "%s").'
+                         %(home, self.username))
                 self.username = ""
+                self.process_queue()
+                return
+            msg_login = self.authorizer.get_msg_login(self.username)
+            if len(msg_login) <= 75:
+                self.respond('230 %s' %msg_login)
+            else:
+                self.push("230-%s\r\n" %msg_login)
+                self.respond("230 ")
+
+            self.authenticated = True
+            self.attempted_logins = 0
+            self.ftpd_instance.login_succeeded(self.remote_ip, self.username)
+            # the session keeps the authorizer it logged in with,
+            # should the server's be replaced (e.g. users reloaded)
+            self.authorizer = self.authorizer
+            self.authorizer.on_login(self.username)
+            fs_class = get_fs_backend(home) or self.abstracted_fs
+            if self.fs.__class__ is not fs_class:
+                self.fs.close()
+                self.fs = fs_class()
+            self.fs.root = home
+            read_bucket, write_bucket = \
+                self.ftpd_instance.hold_user_buckets(self.username)
+            self.read_buckets = (self.ftpd_instance.read_bucket,
+                                 read_bucket)
+            self.write_buckets = (self.ftpd_instance.write_bucket,
+                                  write_bucket)
+            self.log("User %s logged in." %self.username)
+        else:
+            self.delay_failure(username, self.reject_password, username)
+        self.process_queue()
 
     def ftp_REIN(self, line):
         """Reinitialize user's current session."""
@@ -2199,17 +4479,18 @@ class FTPHandler(asynchat.async_chat):
         way as specified in RFC-3659.
         """
         path = self.fs.ftp2fs(line)
-        if self.fs.isdir(path):
-            self.respond("550 Could not get a directory size.")
-            return
+        # a single stat() call tells both the type and the size
         try:
-            size = self.fs.getsize(path)
+            st = self.fs.stat(path)
         except OSError, err:
             why = _strerror(err)
             self.log('FAIL SIZE "%s". %s' %(self.fs.ftpnorm(line), why))
             self.respond('550 %s.' %why)
+            return
+        if stat.S_ISDIR(st.st_mode):
+            self.respond("550 Could not get a directory size.")
         else:
-            self.respond("213 %s" %size)
+            self.respond("213 %s" %st.st_size)
             self.log('OK SIZE "%s".' %self.fs.ftpnorm(line))
 
     def ftp_MDTM(self, line):
@@ -2217,19 +4498,17 @@ class FTPHandler(asynchat.async_chat):
         3307 style timestamp (YYYYMMDDHHMMSS) as defined in RFC-3659.
         """
         path = self.fs.ftp2fs(line)
-        if not self.fs.isfile(path):
+        # a single stat() call tells both the type and the time
+        try:
+            st = self.fs.stat(path)
+        except OSError:
+            st = None
+        if st is None or not stat.S_ISREG(st.st_mode):
             self.respond("550 No such file.")
             return
-        try:
-            lmt = self.fs.getmtime(path)
-        except OSError, err:
-            why = _strerror(err)
-            self.log('FAIL MDTM "%s". %s' %(self.fs.ftpnorm(line), why))
-            self.respond('550 %s.' %why)
-        else:
-            lmt = time.strftime("%Y%m%d%H%M%S", time.localtime(lmt))
-            self.respond("213 %s" %lmt)
-            self.log('OK MDTM "%s".' %self.fs.ftpnorm(line))
+        lmt = time.strftime("%Y%m%d%H%M%S", time.localtime(st.st_mtime))
+        self.respond("213 %s" %lmt)
+        self.log('OK MDTM "%s".' %self.fs.ftpnorm(line))
             
     def ftp_MKD(self, line):
         """Create the specified directory."""
@@ -2248,6 +4527,7 @@ class FTPHandler(asynchat.async_chat):
             self.log('FAIL MKD "%s". %s.' %(self.fs.ftpnorm(line), why))
             self.respond('550 %s.' %why)
         else:
+            self.record_change('change', path)
             self.log('OK MKD "%s".' %self.fs.ftpnorm(line))
             self.respond("257 Directory created.")
 
@@ -2261,11 +4541,6 @@ class FTPHandler(asynchat.async_chat):
             self.log('FAIL MKD "/". %s' %msg)
             return
 
-        if not self.authorizer.w_perm(self.username, path):
-            self.log('FAIL RMD "%s". Not enough privileges.' %self.fs.ftpnorm(line))
-            self.respond("550 Can't RMD: not enough privileges.")
-            return
-
         try:
             self.fs.rmdir(path)
         except OSError, err:
@@ -2273,6 +4548,7 @@ class FTPHandler(asynchat.async_chat):
             self.log('FAIL RMD "%s". %s.' %(self.fs.ftpnorm(line), why))
             self.respond('550 %s.' %why)
         else:
+            self.record_change('delete', path)
             self.log('OK RMD "%s".' %self.fs.ftpnorm(line))
             self.respond("250 Directory removed.")
 
@@ -2280,12 +4556,6 @@ class FTPHandler(asynchat.async_chat):
         """Delete the specified file."""
         path = self.fs.ftp2fs(line)
 
-        if not self.authorizer.w_perm(self.username, path):
-            self.log('FAIL DELE "%s". Not enough privileges.'
-                        %self.fs.ftpnorm(line))
-            self.respond("550 Can't DELE: not enough privileges.")
-            return
-
         try:
             self.fs.remove(path)
         except OSError, err:
@@ -2293,6 +4563,7 @@ class FTPHandler(asynchat.async_chat):
             self.log('FAIL DELE "%s". %s.' %(self.fs.ftpnorm(line), why))
             self.respond('550 %s.' %why)
         else:
+            self.record_change('delete', path)
             self.log('OK DELE "%s".' %self.fs.ftpnorm(line))
             self.respond("250 File removed.")
 
@@ -2301,12 +4572,6 @@ class FTPHandler(asynchat.async_chat):
         here, see RNTO command)"""
         path = self.fs.ftp2fs(line)
 
-        if not self.authorizer.w_perm(self.username, path):
-            self.log('FAIL RNFR "%s". Not enough privileges for renaming.'
-                     %(self.fs.ftpnorm(line)))
-            self.respond("550 Can't RNRF: not enough privileges.")
-            return
-
         if self.fs.lexists(path):
             self.fs.rnfr = line
             self.respond("350 Ready for destination name.")
@@ -2341,6 +4606,8 @@ class FTPHandler(asynchat.async_chat):
                     %(self.fs.ftpnorm(self.fs.rnfr), self.fs.ftpnorm(line), why))
                 self.respond('550 %s.' %why)
             else:
+                self.record_change('delete', src)
+                self.record_change('change', dst)
                 self.log('OK RNFR/RNTO "%s ==> %s".'
                     %(self.fs.ftpnorm(self.fs.rnfr), self.fs.ftpnorm(line)))
                 self.respond("250 Renaming ok.")
@@ -2407,11 +4674,32 @@ class FTPHandler(asynchat.async_chat):
                 s.append('Total bytes received: %s' %dc.tot_bytes_received)
             else:
                 s.append('Data connection closed.')
+            if self.io_ticket is not None and \
+            not self.ftpd_instance.admission.granted(self.io_ticket):
+                s.append('Waiting for the disk (%d requests queued).'
+                         %self.ftpd_instance.admission.queue_depth(self.io_root))
+            if self.authenticated and self.fs.cache is not None:
+                stats = self.fs.cache.stats()
+                s.append('Metadata cache: %(entries)d entries, %(hits)d hits, '
+                         '%(misses)d misses, %(invalidations)d invalidations.'
+                         %stats)
+                if 'watches' in stats:
+                    if stats['overflowed']:
+                        state = 'overflowed, expiring after %ss' %stats['ttl']
+                    else:
+                        state = 'active'
+                    s.append('Inotify: %d watches, %.1f events/s (%s).'
+                             %(stats['watches'], stats['event_rate'], state))
 
             self.push('211-FTP server status:\r\n')
             self.push(''.join([' %s\r\n' %item for item in s]))
             self.respond('211 End of status.')
 
+        # we permit STAT before login but we don't want it to return
+        # a directory LISTing if the user is not authenticated yet
+        elif not self.authenticated:
+            self.respond("530 Log in with USER and PASS first.")
+
         # return directory LISTing over the command channel
         else:
             # When argument is provided along STAT we should return
@@ -2427,8 +4715,42 @@ class FTPHandler(asynchat.async_chat):
             # directories, examine each contained filename, and
             # build a list of matching files in memory.
             # Since this operation can be quite intensive, both CPU-
-            # and memory-wise, we limit the search to only one
-            # directory non-recursively, as LIST does.
+            # and memory-wise, recursive searches (wildcards in the
+            # directory part or "-R" option) are streamed and bounded
+            # by max_list_depth and max_list_entries.
+            flags, line = self.split_list_args(line)
+            if not line:
+                line = self.fs.cwd
+            path = self.fs.ftpnorm(line)
+            basedir, basename = posixpath.split(path)
+            if 'R' in flags and glob.has_magic(basename):
+                dirs = [self.fs.ftp2fs(basedir)]
+                pattern = basename
+            elif 'R' in flags and self.fs.isdir(self.fs.ftp2fs(line)):
+                dirs = [self.fs.ftp2fs(line)]
+                pattern = None
+            elif glob.has_magic(basedir):
+                dirs = self.fs.glob_dirs(basedir, self.max_list_entries)
+                pattern = basename
+            else:
+                dirs = None
+            if dirs is not None:
+                dirs = [x for x in dirs if self.fs.validpath(x)]
+                if 'R' in flags:
+                    maxdepth = self.max_list_depth
+                else:
+                    maxdepth = 0
+                self.push('213-Status of "%s":\r\n' %path)
+                if dirs:
+                    self.push_with_producer(_TreeProducer(self, dirs,
+                                self.fs.format_list, pattern, maxdepth,
+                                self.max_list_entries,
+                                trailer='213 End of status.\r\n'))
+                    self.logline('==> 213 End of status.')
+                else:
+                    self.push('No such file or directory.\r\n')
+                    self.respond('213 End of status.')
+                return
             try:
                 data = self.fs.get_stat_dir(line)
             except OSError, err:
@@ -2440,6 +4762,15 @@ class FTPHandler(asynchat.async_chat):
     def ftp_FEAT(self, line):
         """List all new features supported as defined in RFC-2398."""
         features = ['MDTM','REST STREAM','SIZE','TVFS']
+        # the facts MLST and MLSD can return, those currently selected
+        # being followed by a "*" (RFC-3659, chapter 7.8)
+        facts = []
+        for fact in self.fs.get_available_facts():
+            if fact in self.fs.facts:
+                facts.append(fact + '*;')
+            else:
+                facts.append(fact + ';')
+        features.append('MLST ' + ''.join(facts))
         features.sort()
         self.push("211-Features supported:\r\n")
         self.push("".join([" %s\r\n" %x for x in features]))
@@ -2486,6 +4817,188 @@ class FTPHandler(asynchat.async_chat):
             self.push(formatted_help())
             self.respond("214 Help command successful.")
 
+    def ftp_SITE(self, line):
+        """Dispatch a site specific command to the proper site_*
+        method."""
+        space = line.find(' ')
+        if space != -1:
+            cmd = line[:space].upper()
+            arg = line[space + 1:]
+        else:
+            cmd = line.upper()
+            arg = ""
+        entry = self.get_cmd_table('site_', site_attrs).get(cmd)
+        if entry is None:
+            self.respond("500 Command SITE %s not understood." %cmd)
+        else:
+            self.run_command('SITE ' + cmd, entry, arg)
+
+    def site_HELP(self, line):
+        """Return help text about SITE commands to the client."""
+        if line:
+            if line.upper() in site_cmds:
+                self.respond("214 %s" %site_cmds[line.upper()])
+            else:
+                self.respond("501 Unrecognized SITE command.")
+        else:
+            keys = site_cmds.keys()
+            keys.sort()
+            self.push("214-The following SITE commands are recognized:\r\n")
+            self.push(''.join([' %s\r\n' %key for key in keys]))
+            self.respond("214 Help SITE command successful.")
+
+    def site_MSTAT(self, line):
+        """Return information about many pathnames, in the form used
+        by MLST.  Pathnames are either provided on the command line
+        (quoted if containing spaces) or, if there are none, received
+        over the data channel, one per line.
+        """
+        if line:
+            try:
+                paths = shlex.split(line)
+            except ValueError, err:
+                self.respond("501 %s." %err)
+                return
+            self.push_mstat(paths)
+            return
+
+        collector = _Collector(self.max_mstat_paths * 256)
+        log = 'OK SITE MSTAT. Receiving pathnames.'
+        if self.data_channel:
+            self.respond("125 Data connection already open. Send pathnames.")
+            self.log(log)
+            self.data_channel.file_obj = collector
+            self.data_channel.on_complete = self.on_mstat_paths
+            self.data_channel.enable_receiving(self.current_type)
+        else:
+            self.respond("150 File status okay. About to open data connection.")
+            self.queue_transfer(in_dtp=(collector, log, self.on_mstat_paths))
+
+    def on_mstat_paths(self, collector):
+        """Called when the pathnames of SITE MSTAT have been received
+        over the data channel."""
+        paths = [path for path in collector.getvalue().splitlines() if path]
+        self.push_mstat(paths)
+
+    def push_mstat(self, paths):
+        """Stream the reply to SITE MSTAT for the pathnames in paths
+        over the command channel."""
+        if len(paths) > self.max_mstat_paths:
+            self.respond("501 Too many pathnames (max %d)."
+                         %self.max_mstat_paths)
+            return
+        paths = [(self.fs.ftp2fs(line), self.fs.ftpnorm(line))
+                 for line in paths]
+        self.push('250-Listing %d pathnames:\r\n' %len(paths))
+        self.push_with_producer(_MstatProducer(self, paths))
+        self.log('OK SITE MSTAT (%d pathnames).' %len(paths))
+
+    def site_FIND(self, line):
+        """Return the pathnames of the entries below pathname (the
+        current directory by default) whose name matches pattern, as
+        found by the file system index (see indexfs.IndexedFS).
+        """
+        try:
+            args = shlex.split(line)
+        except ValueError, err:
+            self.respond("501 %s." %err)
+            return
+        if len(args) > 2:
+            self.respond("501 Syntax error: too many arguments.")
+            return
+        pattern = args[0]
+        if len(args) == 2:
+            line = args[1]
+        else:
+            line = self.fs.cwd
+        path = self.fs.ftp2fs(line)
+        line = self.fs.ftpnorm(line)
+        find = getattr(self.fs, 'find', None)
+        if find is None:
+            self.respond("502 SITE FIND needs an indexed file system.")
+            return
+        if not self.fs.validpath(path):
+            err = "Not in the user's root directory"
+        elif not self.fs.isdir(path):
+            err = "No such directory"
+        elif not self.authorizer.r_perm(self.username, path):
+            err = "Can't search: permission denied"
+        else:
+            err = None
+        if err is not None:
+            self.log('FAIL SITE FIND "%s". %s.' %(line, err))
+            self.respond('550 %s.' %err)
+            return
+        try:
+            paths = find(path, pattern, self.max_find_results + 1)
+        except OSError, err:
+            why = _strerror(err)
+            self.log('FAIL SITE FIND "%s". %s.' %(line, why))
+            self.respond('550 %s.' %why)
+            return
+        if len(paths) > self.max_find_results:
+            del paths[self.max_find_results:]
+            end = '250 End FIND (truncated after %d matches).' %len(paths)
+        else:
+            end = '250 End FIND (%d matches).' %len(paths)
+        self.push('250-Matches of "%s" below "%s":\r\n' %(pattern, line))
+        self.push(''.join([' %s\r\n' %self.fs.fs2ftp(x) for x in paths]))
+        self.respond(end)
+        self.log('OK SITE FIND "%s" "%s" (%d matches).'
+                 %(pattern, line, len(paths)))
+
+    def site_CHANGES(self, line):
+        """List the changes made to the user's tree since the state
+        referred to by token (as returned by a previous SITE CHANGES),
+        one per line ("change" or "delete" followed by the pathname).
+        With no token just return the current one.
+        """
+        journal = self.ftpd_instance.journal
+        if journal is None:
+            self.respond("502 Change journal not enabled.")
+            return
+        token = journal.token()
+        if not line:
+            self.respond("250 %s" %token)
+            return
+        changes = journal.changes_since(line)
+        if changes is None:
+            self.log('FAIL SITE CHANGES "%s". Token expired.' %line)
+            self.respond("550 Token expired; a full listing is needed.")
+            return
+        self.push('250-Changes since %s:\r\n' %line)
+        self.push_with_producer(_ChangesProducer(self, changes,
+                                                 '250 %s\r\n' %token))
+        self.logline('==> 250 %s' %token)
+        self.log('OK SITE CHANGES "%s".' %line)
+
+    def ftp_OPTS(self, line):
+        """Set options for the specified command by dispatching them
+        to the proper opts_* method (RFC-2389)."""
+        space = line.find(' ')
+        if space != -1:
+            cmd = line[:space].upper()
+            arg = line[space + 1:]
+        else:
+            cmd = line.upper()
+            arg = ""
+        method = getattr(self, 'opts_' + cmd, None)
+        if cmd not in opts_cmds or method is None:
+            self.respond("501 Invalid argument.")
+        else:
+            method(arg)
+
+    def opts_MLST(self, line):
+        """Select the facts returned by MLST and MLSD (RFC-3659,
+        chapter 7.9).  Unsupported facts are ignored; an empty list
+        means that just the names are returned.
+        """
+        available = self.fs.get_available_facts()
+        wanted = [x.lower() for x in line.split(';')]
+        facts = [x for x in available if x.lower() in wanted]
+        self.fs.facts = facts
+        self.respond('200 MLST OPTS %s' %''.join([x + ';' for x in facts]))
+
 
         # --- support for deprecated cmds
 
@@ -2532,10 +5045,61 @@ class FTPServer(asyncore.dispatcher):
     # (0 == unlimited)
     max_cons_per_ip = 0
 
+    # global bandwidth limits in bytes per second shared by all the
+    # data channels for receiving and sending data (0 == unlimited)
+    read_limit = 0
+    write_limit = 0
+
+    # Load shedding: new connections are refused with a 421 response
+    # when the polling loop lags behind by more than max_loop_lag
+    # seconds or when more than max_inflight_bytes are buffered for
+    # sending on data channels (0 == disabled).  Connections are
+    # accepted again once both values fall below resume_ratio times
+    # their thresholds (hysteresis).
+    max_loop_lag = 0
+    max_inflight_bytes = 0
+    resume_ratio = 0.5
+
+    # how often (in seconds) the loop lag is sampled
+    lag_sample_interval = 0.1
+
+    # Brute-force throttling: the reply to a failed login is delayed
+    # by login_delay seconds, doubled for every other recent failure
+    # from the same IP address or for the same user, up to
+    # max_login_delay; the session doesn't process commands meanwhile.
+    # New connections from IP addresses with more than
+    # max_login_failures_per_ip recent failures are refused.  Failures
+    # fade away, their count halving every failure_half_life seconds
+    # (0 == disabled).
+    login_delay = 0
+    max_login_delay = 30.0
+    max_login_failures_per_ip = 0
+    failure_half_life = 300.0
+
     def __init__(self, address, handler):
         asyncore.dispatcher.__init__(self)
         self.handler = handler
         self.ip_map = []
+        self.read_bucket = TokenBucket(self.read_limit)
+        self.write_bucket = TokenBucket(self.write_limit)
+        self.transfer_scheduler = TransferScheduler()
+        self.admission = AdmissionQueue()
+        # ChangeJournal instance recording changes (None = disabled)
+        self.journal = None
+        # username -> (read_bucket, write_bucket), and the number of
+        # sessions of username holding them (see hold_user_buckets)
+        self.user_buckets = {}
+        self.user_sessions = {}
+        # load statistics
+        self.loop_lag = 0.0
+        self.max_lag_seen = 0.0
+        self.inflight_bytes = 0
+        self.overloaded = False
+        self.refused = 0
+        self._lag_call = None
+        # recent failed logins by IP address and by username
+        self.ip_failures = DecayingCounter(self.failure_half_life)
+        self.user_failures = DecayingCounter(self.failure_half_life)
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
         if os.name == 'posix':
             self.set_reuse_addr()
@@ -2547,7 +5111,7 @@ class FTPServer(asyncore.dispatcher):
 
     def serve_forever(self, **kwargs):
         """A wrap around asyncore.loop(); starts the asyncore polling
-        loop.
+        loop including running the functions scheduled by CallLater.
 
         The keyword arguments in kwargs are the same expected by
         asyncore.loop() function: timeout, use_poll, map and count.
@@ -2562,29 +5126,106 @@ class FTPServer(asyncore.dispatcher):
             else:
                 map = kwargs['map']
             self._map = self.handler._map = map
-            
+
+        timeout = kwargs.get('timeout', 1)
+        count = kwargs.get('count', None)
+        # FIX #16, #26
+        # use_poll specifies whether to use select module's poll()
+        # with asyncore or whether to use asyncore's own poll()
+        # method Python versions < 2.4 need use_poll set to False
+        # This breaks on OS X systems if use_poll is set to True.
+        # All systems seem to work fine with it set to False
+        # (tested on Linux, Windows, and OS X platforms)
+        # Note: asyncore's poll2() does not prioritize control channels.
+        if kwargs.get('use_poll') and hasattr(select, 'poll'):
+            poll_fun = asyncore.poll2
+        else:
+            poll_fun = _poll
+        self.schedule_load_sampling()
         try:
-            # FIX #16, #26
-            # use_poll specifies whether to use select module's poll()
-            # with asyncore or whether to use asyncore's own poll()
-            # method Python versions < 2.4 need use_poll set to False
-            # This breaks on OS X systems if use_poll is set to True.
-            # All systems seem to work fine with it set to False
-            # (tested on Linux, Windows, and OS X platforms)
-            if kwargs:
-                asyncore.loop(**kwargs)
-            else:
-                asyncore.loop(timeout=1, use_poll=False)
+            # the timeout passed to select() is shortened so that
+            # scheduled functions are called on time
+            while self._map and (count is None or count > 0):
+                self.transfer_scheduler.new_round()
+                poll_fun(_next_timeout(timeout), self._map)
+                _scheduler()
+                _flush_replies()
+                if count is not None:
+                    count -= 1
         except (KeyboardInterrupt, SystemExit, asyncore.ExitNow):
             log("Shutting down FTPd.")
             self.close_all()
 
+    def schedule_load_sampling(self):
+        """Start calling sample_load() periodically, if load shedding
+        is enabled (see max_loop_lag and max_inflight_bytes) and it's
+        not called already; it stops by itself once disabled."""
+        if self._lag_call is None and \
+        (self.max_loop_lag or self.max_inflight_bytes):
+            self._lag_call = CallLater(self.lag_sample_interval,
+                                       self.sample_load, time.time() +
+                                       self.lag_sample_interval)
+
+    def sample_load(self, expected):
+        """Called periodically to measure the event-loop lag (the delay
+        between the time this call was scheduled for and the time it
+        actually occurred) and the bytes in flight, updating the
+        overload state.
+        """
+        self._lag_call = None
+        if not (self.max_loop_lag or self.max_inflight_bytes):
+            # disabled meanwhile (e.g. by a reload)
+            if self.overloaded:
+                self.overloaded = False
+                log("Server load back to normal; accepting new connections.")
+            return
+        now = time.time()
+        lag = max(0.0, now - expected)
+        # exponentially weighted moving average smoothing out spikes
+        self.loop_lag = self.loop_lag * 0.7 + lag * 0.3
+        self.max_lag_seen = max(self.max_lag_seen, lag)
+        inflight = 0
+        for obj in self._map.values():
+            if isinstance(obj, DTPHandler):
+                inflight += obj.get_buffered_bytes()
+        self.inflight_bytes = inflight
+
+        lag_limit = self.max_loop_lag
+        bytes_limit = self.max_inflight_bytes
+        if not self.overloaded:
+            if (lag_limit and self.loop_lag > lag_limit) or \
+            (bytes_limit and inflight > bytes_limit):
+                self.overloaded = True
+                log("Server overloaded (loop lag %.3fs, %d bytes in flight); "
+                    "refusing new connections." %(self.loop_lag, inflight))
+        else:
+            if (not lag_limit or self.loop_lag < lag_limit * self.resume_ratio) \
+            and (not bytes_limit or inflight < bytes_limit * self.resume_ratio):
+                self.overloaded = False
+                log("Server load back to normal; accepting new connections.")
+        self._lag_call = CallLater(self.lag_sample_interval, self.sample_load,
+                                   now + self.lag_sample_interval)
+
     def handle_accept(self):
         """Called when remote client initiates a connection."""
         debug("FTPServer.handle_accept()")
         sock_obj, addr = self.accept()
         log("[]%s:%s Connected." %addr)
 
+        # Load shedding: refuse the connection as cheaply as possible,
+        # without even instantiating a handler.
+        if self.overloaded:
+            self.refused += 1
+            self.handle_overload(sock_obj, addr)
+            return
+
+        # so is a client guessing passwords
+        if self.max_login_failures_per_ip and \
+        self.ip_failures.get(addr[0]) > self.max_login_failures_per_ip:
+            self.refused += 1
+            self.handle_banned(sock_obj, addr)
+            return
+
         handler = self.handler(sock_obj, self)
         ip = addr[0]
         self.ip_map.append(ip)
@@ -2608,9 +5249,106 @@ class FTPServer(asyncore.dispatcher):
 
         handler.handle()
 
+    def handle_overload(self, sock_obj, addr):
+        """Called when a connection is refused because the server is
+        overloaded.
+        """
+        try:
+            try:
+                sock_obj.send("421 Server overloaded. Service temporary "
+                              "unavailable.\r\n")
+            except socket.error:
+                pass
+        finally:
+            sock_obj.close()
+        log("[]%s:%s Server overloaded; connection refused." %addr)
+
+    def handle_banned(self, sock_obj, addr):
+        """Called when a connection is refused because of too many
+        failed logins from its IP address.
+        """
+        try:
+            try:
+                sock_obj.send("421 Too many failed logins; try again "
+                              "later.\r\n")
+            except socket.error:
+                pass
+        finally:
+            sock_obj.close()
+        log("[]%s:%s Too many failed logins; connection refused." %addr)
+
+    def login_failed(self, ip, username):
+        """Record a failed login of username from ip.  Return the
+        number of seconds to wait before replying (see login_delay).
+        """
+        ip_count = self.ip_failures.add(ip)
+        user_count = self.user_failures.add(username)
+        limit = self.max_login_failures_per_ip
+        if limit and ip_count > limit >= ip_count - 1:
+            log("[]%s Too many failed logins; refusing new connections."
+                %ip)
+        if not self.login_delay:
+            return 0
+        # the exponent is capped not to overflow
+        n = min(max(ip_count, user_count), 64) - 1
+        return min(self.login_delay * 2 ** n, self.max_login_delay)
+
+    def login_succeeded(self, ip, username):
+        """Forget the failed logins of username (not of ip, or logging
+        in to one account would let guess the passwords of others).
+        """
+        self.user_failures.reset(username)
+
     def writable(self):
         return 0
 
+    def get_user_buckets(self, username):
+        """Return the (read, write) token buckets shared by all the
+        sessions of username, creating them from the limits provided
+        by the authorizer if needed.
+        """
+        if username not in self.user_buckets:
+            authorizer = self.handler.authorizer
+            self.user_buckets[username] = (
+                TokenBucket(authorizer.get_read_limit(username)),
+                TokenBucket(authorizer.get_write_limit(username)))
+        return self.user_buckets[username]
+
+    def hold_user_buckets(self, username):
+        """Like get_user_buckets() for a session of username logging
+        in; the buckets are kept until the matching
+        release_user_buckets() call."""
+        self.user_sessions[username] = self.user_sessions.get(username, 0) + 1
+        return self.get_user_buckets(username)
+
+    def release_user_buckets(self, username):
+        """Called when a session of username logs out or ends; the
+        buckets of username are dropped along with its last session."""
+        count = self.user_sessions.get(username, 0) - 1
+        if count > 0:
+            self.user_sessions[username] = count
+            return
+        self.user_sessions.pop(username, None)
+        self.user_buckets.pop(username, None)
+
+    def set_limits(self, read_limit, write_limit):
+        """Change the global bandwidth limits at runtime."""
+        self.read_limit = read_limit
+        self.write_limit = write_limit
+        self.read_bucket.set_rate(read_limit)
+        self.write_bucket.set_rate(write_limit)
+
+    def set_user_limits(self, username, read_limit, write_limit):
+        """Change the bandwidth limits of username at runtime, for the
+        sessions already logged in (the next ones get theirs from the
+        authorizer).
+        """
+        if username not in self.user_buckets:
+            return
+        read_bucket, write_bucket = self.user_buckets[username]
+        read_bucket.set_rate(read_limit)
+        write_bucket.set_rate(write_limit)
+
     def handle_error(self):
         """Called to handle any uncaught exceptions."""
         debug("FTPServer.handle_error()")
@@ -0,0 +1,576 @@
+#!/usr/bin/env python
+# indexfs.py
+
+"""A file system answering metadata queries from a prebuilt SQLite
+index instead of the disk, meant for very large trees which rarely
+change (archives).
+
+    [MetadataIndex] - an SQLite database of the paths, sizes, times and
+    modes found below a root directory; built and refreshed offline by
+    the easyftpd-index script and by the server's own changes, which
+    are applied in batches.
+
+    [IndexedFS] - an AbstractedFS whose directories listed in the
+    indexes attribute are looked up in their MetadataIndex: LIST, MLSD,
+    NLST, SIZE, MDTM, STAT and globbing need no disk access there but
+    for the root containment check, and SITE FIND searches file names.
+
+The index is authoritative: a file created or removed below an indexed
+root by something else than the server is not seen until the index is
+refreshed.  It is not trusted for security though: whether a path lies
+below the user's root is always decided on disk, by
+AbstractedFS.realpath().
+
+sqlite3 is needed (Python 2.5 or later); importing this module raises
+ImportError if it's missing.
+"""
+
+import errno
+import os
+import posixpath
+import stat
+import sys
+import time
+
+import sqlite3
+
+from easy_ftpd.lib.ftpserver import AbstractedFS, CallLater
+
+__all__ = ['MetadataIndex', 'IndexedFS']
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS entries (
+    dir TEXT NOT NULL,
+    name TEXT NOT NULL,
+    mode INTEGER, ino INTEGER, dev INTEGER, nlink INTEGER,
+    uid INTEGER, gid INTEGER, size INTEGER,
+    mtime REAL, ctime REAL,
+    target TEXT,
+    PRIMARY KEY (dir, name)
+);
+CREATE INDEX IF NOT EXISTS entries_name ON entries (name);
+"""
+
+_COLUMNS = "mode, ino, dev, nlink, uid, gid, size, mtime, ctime, target"
+
+
+def _split(relpath):
+    """Split an index path ("/" being the root) into the (dir, name)
+    key of its row; the root's is ("", "")."""
+    if relpath == '/':
+        return '', ''
+    return posixpath.split(relpath)
+
+def _subtree(relpath):
+    """Return a WHERE clause and its parameters matching the rows of
+    the entries below relpath (not included)."""
+    if relpath == '/':
+        return "dir != ''", ()
+    # "0" follows "/" in ASCII, hence the range holds the "relpath/"
+    # prefix only (and can be answered by the primary key)
+    return "(dir = ? OR (dir >= ? AND dir < ?))", \
+           (relpath, relpath + '/', relpath + '0')
+
+def _stat_result(row):
+    """Build an os.stat_result from an entries row (atime is not
+    recorded; mtime is returned)."""
+    mode, ino, dev, nlink, uid, gid, size, mtime, ctime = row[:9]
+    return os.stat_result((mode, ino, dev, nlink, uid, gid, size,
+                           mtime, mtime, ctime))
+
+
+class MetadataIndex:
+    """An SQLite index of the metadata of the entries below root.
+
+    Paths are recorded relative to root, "/" being root itself, along
+    with the result of lstat() and, for symbolic links, their target.
+    """
+
+    # rows inserted per executemany() call while scanning
+    batch_size = 1000
+
+    # seconds during which the changes made through the server are
+    # collected before being applied in a single transaction (they
+    # are applied earlier if the index is queried in the meantime)
+    flush_delay = 1.0
+
+    def __init__(self, dbpath, root=None):
+        self.dbpath = dbpath
+        # incremented whenever the server changes the index, so that
+        # the rows copied from it can be told stale
+        self.generation = 0
+        self.pending = []
+        self._flush_call = None
+        self.db = sqlite3.connect(dbpath)
+        self.db.text_factory = str
+        try:
+            # let easyftpd-index refresh the index while the server
+            # reads it
+            self.db.execute("PRAGMA journal_mode=WAL")
+        except sqlite3.DatabaseError:
+            pass
+        self.db.executescript(_SCHEMA)
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'root'") \
+                     .fetchone()
+        if root is None:
+            if row is None:
+                raise ValueError("%s: no root directory recorded" %dbpath)
+            root = row[0]
+        elif row is None or row[0] != root:
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('root', ?)",
+                            (root,))
+            self.db.commit()
+        self.root = os.path.normpath(root)
+
+    def relpath(self, path):
+        """Return the index path of the file system path path, None if
+        not below root."""
+        path = os.path.normpath(path)
+        if path == self.root:
+            return '/'
+        root = self.root
+        if not root.endswith(os.sep):
+            root = root + os.sep
+        if not path.startswith(root):
+            return None
+        return '/' + path[len(root):].replace(os.sep, '/')
+
+    def fspath(self, relpath):
+        """The opposite of relpath()."""
+        if relpath == '/':
+            return self.root
+        return os.path.join(self.root, relpath[1:].replace('/', os.sep))
+
+    # --- queries
+
+    def lookup(self, relpath):
+        """Return the row of relpath (see _COLUMNS), None if missing."""
+        if self.pending:
+            self.flush()
+        return self._lookup(relpath)
+
+    def _lookup(self, relpath):
+        return self.db.execute("SELECT %s FROM entries WHERE dir = ? "
+                               "AND name = ?" %_COLUMNS,
+                               _split(relpath)).fetchone()
+
+    def listdir(self, relpath):
+        """Return a dictionary mapping the names of the entries of
+        directory relpath to their rows."""
+        if self.pending:
+            self.flush()
+        rows = {}
+        for row in self.db.execute("SELECT name, %s FROM entries "
+                                   "WHERE dir = ?" %_COLUMNS, (relpath,)):
+            rows[row[0]] = row[1:]
+        return rows
+
+    def find(self, relpath, pattern, limit=0):
+        """Return the index paths of the entries below relpath whose
+        name matches pattern (fnmatch-style, case-sensitive), up to
+        limit (0 means unlimited), sorted by directory then name."""
+        if self.pending:
+            self.flush()
+        where, params = _subtree(relpath)
+        # SQLite doesn't use the index of names for a GLOB parameter:
+        # search the range of its literal prefix, if any, explicitly
+        # (and keep the planner from using the primary key instead)
+        prefix = pattern
+        for char in '*?[':
+            prefix = prefix.split(char, 1)[0]
+        if prefix and prefix[-1] != '\xff':
+            where = "name >= ? AND name < ? AND " + \
+                    where.replace("dir", "+dir")
+            params = (prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)) \
+                     + params
+        query = "SELECT dir, name FROM entries WHERE name GLOB ? AND " \
+                + where
+        # sorted before being limited, so that the first matches are
+        # returned
+        query += " ORDER BY dir, name"
+        if limit:
+            query += " LIMIT %d" %limit
+        result = []
+        for dir, name in self.db.execute(query, (pattern,) + params):
+            result.append(posixpath.join(dir, name))
+        return result
+
+    def count(self):
+        if self.pending:
+            self.flush()
+        return self.db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    # --- updates
+
+    def _row(self, path, relpath):
+        """lstat() path and return its (dir, name, ...) row."""
+        st = os.lstat(path)
+        target = None
+        if stat.S_ISLNK(st.st_mode):
+            target = os.readlink(path)
+        return _split(relpath) + (st.st_mode, st.st_ino, st.st_dev,
+                                  st.st_nlink, st.st_uid, st.st_gid,
+                                  st.st_size, st.st_mtime, st.st_ctime,
+                                  target)
+
+    def _insert(self, rows):
+        self.db.executemany("INSERT OR REPLACE INTO entries VALUES "
+                            "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def _delete(self, relpath):
+        where, params = _subtree(relpath)
+        self.db.execute("DELETE FROM entries WHERE " + where, params)
+        if relpath != '/':
+            self.db.execute("DELETE FROM entries WHERE dir = ? AND name = ?",
+                            _split(relpath))
+
+    def scan(self, relpath='/', progress=None):
+        """Replace the rows of relpath and of everything below it with
+        what is found on disk; symbolic links are not followed.
+        progress, if given, is called with the number of entries
+        scanned so far after every batch.  Return that number.
+        """
+        if self.pending:
+            self.flush()
+        count = self._scan(relpath, progress)
+        self.db.commit()
+        self.generation += 1
+        if count:
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES "
+                            "('scanned', ?)", (str(time.time()),))
+            self.db.commit()
+        return count
+
+    def _scan(self, relpath, progress=None):
+        """scan() without committing."""
+        self._delete(relpath)
+        try:
+            row = self._row(self.fspath(relpath), relpath)
+        except OSError:
+            return 0
+        count = 0
+        rows = [row]
+        stack = []
+        if stat.S_ISDIR(row[2]):
+            stack.append(relpath)
+        while stack:
+            dir = stack.pop()
+            path = self.fspath(dir)
+            try:
+                names = os.listdir(path)
+            except OSError:
+                continue
+            for name in names:
+                child = posixpath.join(dir, name)
+                try:
+                    row = self._row(os.path.join(path, name), child)
+                except OSError:
+                    # vanished in the meantime
+                    continue
+                rows.append(row)
+                if stat.S_ISDIR(row[2]):
+                    stack.append(child)
+                if len(rows) >= self.batch_size:
+                    count += len(rows)
+                    self._insert(rows)
+                    rows = []
+                    if progress is not None:
+                        progress(count)
+        count += len(rows)
+        self._insert(rows)
+        return count
+
+    def update(self, relpath):
+        """Refresh the row of relpath and of its parent directory
+        (whose times changed); a directory is rescanned as a whole
+        (it may have been moved in), a missing path removed along
+        with its content.
+        """
+        if self.pending:
+            self.flush()
+        self._update(relpath)
+        self.db.commit()
+        self.generation += 1
+
+    def _update(self, relpath):
+        """update() without committing."""
+        path = self.fspath(relpath)
+        try:
+            row = self._row(path, relpath)
+        except OSError:
+            self._delete(relpath)
+        else:
+            if stat.S_ISDIR(row[2]):
+                self._scan(relpath)
+            else:
+                self._insert([row])
+        self._update_parent(relpath)
+
+    def _update_parent(self, relpath):
+        if relpath != '/':
+            parent = posixpath.dirname(relpath)
+            try:
+                self._insert([self._row(self.fspath(parent), parent)])
+            except OSError:
+                pass
+
+    def _move(self, src, dst):
+        """Move the rows of directory src and of its content to dst if
+        dst is that very directory renamed, instead of rescanning it;
+        return whether it was.
+        """
+        row = self._lookup(src)
+        if row is None or not stat.S_ISDIR(row[0]) or src == '/' \
+        or dst.startswith(src + '/'):
+            return False
+        try:
+            new = self._row(self.fspath(dst), dst)
+        except OSError:
+            return False
+        if not stat.S_ISDIR(new[2]) or new[3:5] != row[1:3]:
+            return False
+        # dst may have replaced an empty directory
+        self._delete(dst)
+        where, params = _subtree(src)
+        self.db.execute("UPDATE entries SET dir = ? || substr(dir, ?) "
+                        "WHERE " + where, (dst, len(src) + 1) + params)
+        self.db.execute("DELETE FROM entries WHERE dir = ? AND name = ?",
+                        _split(src))
+        self._insert([new])
+        self._update_parent(src)
+        self._update_parent(dst)
+        return True
+
+    def queue(self, op, relpath):
+        """Like update() but deferred: relpath has been changed
+        ("change") or removed ("delete") through the server.  The
+        changes queued are applied by flush(), in a single transaction,
+        flush_delay seconds later or before the next query.
+        """
+        if self.pending and self.pending[-1] == (op, relpath):
+            return
+        self.pending.append((op, relpath))
+        if self._flush_call is None:
+            self._flush_call = CallLater(self.flush_delay, self.flush)
+
+    def flush(self):
+        """Apply the changes queued by queue()."""
+        if self._flush_call is not None:
+            if not self._flush_call.cancelled:
+                self._flush_call.cancel()
+            self._flush_call = None
+        pending = self.pending
+        self.pending = []
+        i = 0
+        while i < len(pending):
+            op, relpath = pending[i]
+            i += 1
+            # RNTO records the removal of the source then the change
+            # of the destination
+            if op == 'delete' and i < len(pending) and \
+            pending[i][0] == 'change' and self._move(relpath, pending[i][1]):
+                i += 1
+                continue
+            self._update(relpath)
+        if pending:
+            self.db.commit()
+            self.generation += 1
+
+    def close(self):
+        if self.pending:
+            self.flush()
+        self.db.close()
+
+
+class IndexedFS(AbstractedFS):
+    """An AbstractedFS answering the metadata queries about the paths
+    below the roots of the MetadataIndex objects in indexes from those
+    instead of the disk.  Files are still read and written on disk;
+    the changes made through the server update the index.
+    """
+
+    # MetadataIndex objects shared by all instances
+    indexes = []
+
+    # seconds during which the rows of the directory listed last are
+    # reused, unless the server changes its index in the meantime
+    # (refreshes made by easyftpd-index can't be told)
+    listed_ttl = 2.0
+
+    def __init__(self):
+        AbstractedFS.__init__(self)
+        # (path, rows, index, generation, expiry) of the directory
+        # listed last: listing commands lstat() every entry right after
+        # listdir()
+        self._rows = None
+
+    def get_index(self, path):
+        """Return the (index, index path) couple of path, (None, None)
+        if not indexed."""
+        for index in self.indexes:
+            relpath = index.relpath(path)
+            if relpath is not None:
+                return index, relpath
+        return None, None
+
+    def _lookup(self, path):
+        """Return the (found, row) couple of path, found being False if
+        path is not indexed; row is None if missing."""
+        dirname, name = os.path.split(path)
+        listed = self._rows
+        if listed is not None and dirname == listed[0] and name:
+            index = listed[2]
+            if index.pending:
+                index.flush()
+            if index.generation == listed[3] and time.time() < listed[4]:
+                return True, listed[1].get(name)
+            self._rows = None
+        index, relpath = self.get_index(path)
+        if index is None:
+            return False, None
+        return True, index.lookup(relpath)
+
+    def _row(self, path, follow):
+        found, row = self._lookup(path)
+        if found and follow and row is not None and \
+        stat.S_ISLNK(row[0]):
+            return self._lookup(self._resolve(path))
+        return found, row
+
+    def stat(self, path):
+        found, row = self._row(path, True)
+        if not found:
+            return AbstractedFS.stat(self, path)
+        if row is None:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        return _stat_result(row)
+
+    def lstat(self, path):
+        found, row = self._row(path, False)
+        if not found:
+            return AbstractedFS.lstat(self, path)
+        if row is None:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        return _stat_result(row)
+
+    def listdir(self, path):
+        index, relpath = self.get_index(path)
+        if index is None:
+            return AbstractedFS.listdir(self, path)
+        row = index.lookup(relpath)
+        if row is None:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        if stat.S_ISLNK(row[0]):
+            return self.listdir(self._resolve(path))
+        if not stat.S_ISDIR(row[0]):
+            raise OSError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), path)
+        rows = index.listdir(relpath)
+        self._rows = (os.path.normpath(path), rows, index, index.generation,
+                      time.time() + self.listed_ttl)
+        return rows.keys()
+
+    def _test(self, path, follow, test):
+        found, row = self._row(path, follow)
+        if not found:
+            return None
+        return row is not None and test(row[0])
+
+    def isfile(self, path):
+        result = self._test(path, True, stat.S_ISREG)
+        if result is None:
+            return AbstractedFS.isfile(self, path)
+        return result
+
+    def isdir(self, path):
+        result = self._test(path, True, stat.S_ISDIR)
+        if result is None:
+            return AbstractedFS.isdir(self, path)
+        return result
+
+    def islink(self, path):
+        result = self._test(path, False, stat.S_ISLNK)
+        if result is None:
+            return AbstractedFS.islink(self, path)
+        return result
+
+    def lexists(self, path):
+        found, row = self._lookup(path)
+        if not found:
+            return AbstractedFS.lexists(self, path)
+        return row is not None
+
+    exists = lexists
+
+    def getsize(self, path):
+        return self.stat(path).st_size
+
+    def getmtime(self, path):
+        return self.stat(path).st_mtime
+
+    def readlink(self, path):
+        found, row = self._lookup(path)
+        if not found:
+            return AbstractedFS.readlink(self, path)
+        if row is None or row[9] is None:
+            raise OSError(errno.EINVAL, os.strerror(errno.EINVAL), path)
+        return row[9]
+
+    # realpath() is not overridden: validpath() decides on root
+    # containment from the disk, which is what open() follows, whereas
+    # the index may be stale
+
+    def _resolve(self, path):
+        """Like AbstractedFS.realpath() but resolving the symbolic
+        links below indexed roots through the index; only used to
+        answer metadata queries."""
+        index, relpath = self.get_index(path)
+        if index is None:
+            return AbstractedFS.realpath(self, path)
+        resolved = index.root
+        parts = relpath.split('/')
+        links = 0
+        while parts:
+            name = parts.pop(0)
+            if name in ('', '.'):
+                continue
+            if name == '..':
+                resolved = os.path.dirname(resolved)
+            else:
+                resolved = os.path.join(resolved, name)
+            index, relpath = self.get_index(resolved)
+            if index is None:
+                # escaped from the indexed tree
+                return AbstractedFS.realpath(self,
+                                    os.path.join(resolved, *parts))
+            row = index.lookup(relpath)
+            if row is None or row[9] is None:
+                continue
+            links += 1
+            if links > 40:
+                # symbolic link loop: stop resolving like
+                # os.path.realpath does
+                return os.path.join(resolved, *parts)
+            target = row[9].replace('/', os.sep)
+            resolved = os.path.dirname(resolved)
+            if os.path.isabs(target):
+                return self._resolve(os.path.join(target, *parts))
+            parts = target.split(os.sep) + parts
+        return resolved
+
+    def on_change(self, op, path):
+        AbstractedFS.on_change(self, op, path)
+        index, relpath = self.get_index(path)
+        if index is not None:
+            index.queue(op, relpath)
+
+    def find(self, path, pattern, limit=0):
+        """Return the pathnames of the entries below directory path
+        whose name matches pattern, sorted by directory then name and
+        up to limit (0 means unlimited).
+        """
+        index, relpath = self.get_index(path)
+        if index is None:
+            raise OSError(errno.EOPNOTSUPP, "Not an indexed directory")
+        return [index.fspath(x) for x in index.find(relpath, pattern, limit)]
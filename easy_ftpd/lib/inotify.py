@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# inotify.py
+
+"""Minimal binding of the Linux inotify(7) API by using ctypes, plus
+an asyncore dispatcher watching whole directory trees.
+
+    [Inotify] - a thin wrapper around an inotify file descriptor.
+
+    [TreeWatcher] - asyncore dispatcher watching every directory below
+    a set of roots, reporting changes to a list of callbacks.
+
+ctypes is needed (Python 2.6 or later); on other platforms or when
+ctypes is missing, importing this module raises ImportError.
+"""
+
+import asyncore
+import errno
+import os
+import struct
+import sys
+import time
+
+if not sys.platform.startswith('linux'):
+    raise ImportError("inotify is only available on Linux")
+
+import ctypes
+import ctypes.util
+
+__all__ = ['Inotify', 'TreeWatcher']
+
+
+# event masks (from <sys/inotify.h>)
+IN_ACCESS = 0x00000001
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_OPEN = 0x00000020
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = 04000
+IN_CLOEXEC = 02000000
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                    use_errno=True)
+if not hasattr(_libc, 'inotify_init'):
+    raise ImportError("inotify is not supported by the C library")
+
+# struct inotify_event {int wd; uint32_t mask, cookie, len; char name[]}
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+def _error():
+    err = ctypes.get_errno()
+    return OSError(err, os.strerror(err))
+
+
+class Inotify:
+    """A thin wrapper around an inotify file descriptor."""
+
+    def __init__(self):
+        if hasattr(_libc, 'inotify_init1'):
+            self.fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        else:
+            self.fd = _libc.inotify_init()
+        if self.fd == -1:
+            raise _error()
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        """Watch path for the events in mask; return the watch
+        descriptor.  Raise OSError on failure (ENOSPC meaning that the
+        limit of watches per user has been reached).
+        """
+        wd = _libc.inotify_add_watch(self.fd, path, mask)
+        if wd == -1:
+            raise _error()
+        return wd
+
+    def rm_watch(self, wd):
+        if _libc.inotify_rm_watch(self.fd, wd) == -1:
+            raise _error()
+
+    def read(self, bufsize=65536):
+        """Return the pending events as a list of (wd, mask, cookie,
+        name) tuples; [] if there's none.
+        """
+        try:
+            data = os.read(self.fd, bufsize)
+        except OSError, err:
+            if err.errno == errno.EAGAIN:
+                return []
+            raise
+        events = []
+        pos = 0
+        size = _EVENT_HEADER.size
+        while pos + size <= len(data):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, pos)
+            pos += size
+            name = data[pos:pos + length].rstrip('\0')
+            pos += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        if self.fd != -1:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class TreeWatcher(asyncore.file_dispatcher):
+    """Watch every directory below roots, calling each of the callbacks
+    with (op, path) when something changes:
+
+     - "change": path has been created or modified (if it's a
+       directory, its content may have changed as a whole, e.g. when
+       moved in)
+     - "delete": path (and anything below it) no longer exists
+     - "overflow": events have been lost (path is None); everything
+       may have changed
+
+    When the limit of watches per user is reached (ENOSPC) new
+    directories are no longer watched and the overflowed attribute is
+    set; callers relying on the notifications should fall back on
+    something else (e.g. expiration) for the rest of the tree.
+
+    The watches of a directory moved within the tree follow it (their
+    paths are updated); those of a directory moved out of it, roots
+    included, are removed.
+    """
+
+    mask = IN_CREATE | IN_DELETE | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+           IN_MOVED_TO | IN_ATTRIB | IN_DELETE_SELF | IN_MOVE_SELF | \
+           IN_ONLYDIR | IN_DONT_FOLLOW
+
+    def __init__(self, roots, callbacks=None, map=None):
+        self.inotify = Inotify()
+        asyncore.file_dispatcher.__init__(self, self.inotify.fileno(), map)
+        self.callbacks = list(callbacks or [])
+        # watch descriptor -> watched directory
+        self.paths = {}
+        self.roots = [os.path.normpath(root) for root in roots]
+        self.overflowed = False
+        self.events = 0
+        # events counted over the current and the previous window
+        self.window = 10.0
+        self.window_start = time.time()
+        self.window_events = 0
+        self.last_rate = 0.0
+        for root in roots:
+            self.watch(root)
+
+    def watch(self, top):
+        """Watch top and the directories below it."""
+        for dirpath, dirnames, filenames in os.walk(top):
+            if self.overflowed:
+                return
+            try:
+                wd = self.inotify.add_watch(dirpath, self.mask)
+            except OSError, err:
+                if err.errno == errno.ENOSPC:
+                    self.overflowed = True
+                    return
+                # vanished in the meantime or not accessible
+                continue
+            self.paths[wd] = dirpath
+
+    def unwatch(self, top):
+        """Stop watching top and the directories below it."""
+        prefix = top.rstrip(os.sep) + os.sep
+        for wd, path in self.paths.items():
+            if path == top or path.startswith(prefix):
+                del self.paths[wd]
+                try:
+                    self.inotify.rm_watch(wd)
+                except OSError:
+                    # already gone
+                    pass
+
+    def _moved(self, src, dst):
+        """Update the paths of the watches below directory src, which
+        has been renamed dst."""
+        prefix = src.rstrip(os.sep) + os.sep
+        for wd, path in self.paths.items():
+            if path == src or path.startswith(prefix):
+                self.paths[wd] = dst + path[len(src):]
+
+    def watch_count(self):
+        return len(self.paths)
+
+    def event_rate(self):
+        """Return the number of events per second received over the
+        last window seconds."""
+        self._roll()
+        elapsed = time.time() - self.window_start
+        if elapsed < 1.0:
+            return self.last_rate
+        return self.window_events / elapsed
+
+    def _roll(self):
+        now = time.time()
+        if now - self.window_start >= self.window:
+            elapsed = now - self.window_start
+            self.last_rate = self.window_events / elapsed
+            self.window_start = now
+            self.window_events = 0
+
+    def notify(self, op, path):
+        for callback in self.callbacks:
+            callback(op, path)
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        events = self.inotify.read()
+        self._roll()
+        self.events += len(events)
+        self.window_events += len(events)
+        # cookie -> path of the directories moved from, until the
+        # matching IN_MOVED_TO
+        moved = {}
+        for wd, mask, cookie, name in events:
+            if mask & IN_Q_OVERFLOW:
+                self.notify('overflow', None)
+                continue
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            dirpath = self.paths.get(wd)
+            if dirpath is None:
+                continue
+            if name:
+                path = os.path.join(dirpath, name)
+            else:
+                path = dirpath
+            if mask & IN_MOVE_SELF:
+                # directories moved within the tree are dealt with
+                # through their parent's events; a root has none
+                if os.path.normpath(path) in self.roots:
+                    self.unwatch(path)
+                    self.notify('delete', path)
+                continue
+            if mask & (IN_DELETE | IN_MOVED_FROM | IN_DELETE_SELF):
+                if mask & IN_ISDIR and mask & IN_MOVED_FROM:
+                    moved[cookie] = path
+                self.notify('delete', path)
+            else:
+                if mask & IN_ISDIR and mask & IN_MOVED_TO and \
+                cookie in moved:
+                    self._moved(moved.pop(cookie), path)
+                elif mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    self.watch(path)
+                self.notify('change', path)
+        # moved out of the tree (or the IN_MOVED_TO event is yet to be
+        # read, in which case the directory is watched anew)
+        for path in moved.values():
+            self.unwatch(path)
+
+    def handle_close(self):
+        self.close()
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        self.inotify.close()
@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+# memfs.py
+
+"""A file system keeping its files in memory, for ephemeral drop-boxes
+and for measuring the protocol overhead without any disk access.
+
+    [MemoryStore] - the in-memory trees, by name, with a cap on the
+    memory they take as a whole.
+
+    [MemoryFS] - an AbstractedFS serving one of the trees; it's used
+    for the users whose home directory is written as "mem:<name>"
+    (e.g. "mem:dropbox"), the users sharing a name sharing the tree.
+
+Nothing is kept across restarts.  There are no symbolic links and all
+the files belong to the user running the server.
+"""
+
+import errno
+import os
+import random
+import stat
+import time
+
+try:
+    import cStringIO as StringIO
+except ImportError:
+    import StringIO
+
+from easy_ftpd.lib.ftpserver import AbstractedFS, register_fs_backend
+
+__all__ = ['MemoryStore', 'MemoryFS']
+
+
+def _error(err, path):
+    return OSError(err, os.strerror(err), path)
+
+
+class _Node:
+    """A file (data being its content) or a directory (entries being a
+    dictionary of its children by name)."""
+
+    def __init__(self, mode, ino):
+        self.mode = mode
+        self.ino = ino
+        self.nlink = 1
+        self.mtime = self.ctime = time.time()
+        # bytes of the store accounted for this node
+        self.size = 0
+        if stat.S_ISDIR(mode):
+            self.entries = {}
+            self.data = None
+        else:
+            self.entries = None
+            self.data = ''
+
+
+class MemoryStore:
+    """The in-memory trees served by MemoryFS, by name.  The memory
+    taken by the file contents, plus node_overhead bytes per file and
+    directory, can't exceed max_size bytes (0 means unlimited): what
+    would exceed it fails with ENOSPC ("No space left on device").
+    """
+
+    node_overhead = 256
+
+    def __init__(self, max_size=0):
+        self.max_size = max_size
+        self.size = 0
+        self.trees = {}
+        self._ino = 0
+        if hasattr(os, 'getuid'):
+            self.uid, self.gid = os.getuid(), os.getgid()
+        else:
+            self.uid = self.gid = 0
+
+    def get_tree(self, name):
+        """Return the root directory of tree name, created if needed."""
+        root = self.trees.get(name)
+        if root is None:
+            root = self.trees[name] = self.new_node(stat.S_IFDIR | 0755)
+        return root
+
+    def new_node(self, mode):
+        if self.max_size and self.size + self.node_overhead > self.max_size:
+            raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+        self.size += self.node_overhead
+        self._ino += 1
+        return _Node(mode, self._ino)
+
+    def reserve(self, size, path=None):
+        """Account size more bytes; raise IOError if max_size would be
+        exceeded."""
+        if self.max_size and self.size + size > self.max_size:
+            raise IOError(errno.ENOSPC, os.strerror(errno.ENOSPC), path)
+        self.size += size
+
+    def release(self, size):
+        self.size -= size
+
+    def unlink(self, node):
+        """Release the memory taken by node and by what's below it."""
+        if node.entries is not None:
+            for child in node.entries.values():
+                self.unlink(child)
+        self.release(node.size + self.node_overhead)
+        node.size = 0
+        node.nlink = 0
+
+
+class _MemoryFile:
+    """A file object over the content of a _Node.  Readers get the
+    content as it was when opened; what's written replaces the content
+    when closed.
+    """
+
+    def __init__(self, store, node, name, mode):
+        self.store = store
+        self.node = node
+        self.name = name
+        self.mode = mode
+        self.closed = False
+        self.writable = mode[0] in 'wa' or '+' in mode
+        if self.writable:
+            self.buf = StringIO.StringIO()
+            self.buf.write(node.data)
+            if mode[0] != 'a':
+                self.buf.seek(0)
+            self.length = len(node.data)
+        else:
+            self.buf = StringIO.StringIO(node.data)
+
+    def read(self, size=-1):
+        return self.buf.read(size)
+
+    def write(self, data):
+        if not self.writable:
+            raise IOError(errno.EBADF, os.strerror(errno.EBADF), self.name)
+        if self.mode[0] == 'a':
+            self.buf.seek(0, 2)
+        end = self.buf.tell() + len(data)
+        if end > self.length:
+            self.store.reserve(end - self.length, self.name)
+            self.node.size += end - self.length
+            self.length = end
+        self.buf.write(data)
+
+    def seek(self, pos, whence=0):
+        self.buf.seek(pos, whence)
+
+    def tell(self):
+        return self.buf.tell()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.writable:
+            node = self.node
+            if node.nlink:
+                node.data = self.buf.getvalue()
+                self.store.size += len(node.data) - node.size
+                node.size = len(node.data)
+                node.mtime = time.time()
+            else:
+                # removed meanwhile
+                self.store.release(node.size)
+                node.size = 0
+        self.buf.close()
+
+
+class MemoryFS(AbstractedFS):
+    """An AbstractedFS serving the tree of store named after the root
+    directory ("mem:<name>").  File system paths are the root followed
+    by the "virtual" path, e.g. "mem:dropbox/incoming/x.txt".
+    """
+
+    # the MemoryStore shared by all instances
+    store = MemoryStore()
+    # nothing to gain from caching
+    cache = None
+
+    # --- Tree utilities
+
+    def _parts(self, path):
+        """Return the components of path below the root directory."""
+        root = self.root
+        path = os.path.normpath(path)
+        if path == root:
+            return []
+        if not path.startswith(root + '/'):
+            raise _error(errno.EACCES, path)
+        return [x for x in path[len(root) + 1:].split('/') if x]
+
+    def _lookup(self, path):
+        node = self.store.get_tree(self.root.split(':', 1)[1])
+        for name in self._parts(path):
+            if node.entries is None:
+                raise _error(errno.ENOTDIR, path)
+            node = node.entries.get(name)
+            if node is None:
+                raise _error(errno.ENOENT, path)
+        return node
+
+    def _lookup_parent(self, path):
+        """Return the directory node containing path and the name of
+        path in it."""
+        dirname, name = os.path.split(os.path.normpath(path))
+        if not name or not self._parts(path):
+            raise _error(errno.EBUSY, path)
+        parent = self._lookup(dirname)
+        if parent.entries is None:
+            raise _error(errno.ENOTDIR, path)
+        return parent, name
+
+    def _create(self, path, mode):
+        parent, name = self._lookup_parent(path)
+        if name in parent.entries:
+            raise _error(errno.EEXIST, path)
+        node = parent.entries[name] = self.store.new_node(mode)
+        parent.mtime = node.mtime
+        return node
+
+    # --- Wrapper methods around open() and tempfile.mkstemp
+
+    def open(self, filename, mode):
+        try:
+            if mode[0] == 'r':
+                node = self._lookup(filename)
+            else:
+                try:
+                    node = self._lookup(filename)
+                except OSError, err:
+                    if err.errno != errno.ENOENT:
+                        raise
+                    node = self._create(filename, stat.S_IFREG | 0644)
+            if node.entries is not None:
+                raise _error(errno.EISDIR, filename)
+        except OSError, err:
+            raise IOError(err.errno, err.strerror, filename)
+        if mode[0] == 'w':
+            self.store.release(node.size)
+            node.size = 0
+            node.data = ''
+            node.mtime = time.time()
+        return _MemoryFile(self.store, node, filename, mode)
+
+    def mkstemp(self, suffix='', prefix='', dir=None, mode='wb'):
+        chars = 'abcdefghijklmnopqrstuvwxyz0123456789_'
+        for attempt in range(50):
+            name = prefix + ''.join(random.sample(chars, 6)) + suffix
+            path = os.path.join(dir, name)
+            try:
+                node = self._create(path, stat.S_IFREG | 0600)
+            except OSError, err:
+                if err.errno == errno.EEXIST:
+                    continue
+                raise
+            return _MemoryFile(self.store, node, path, mode)
+        raise IOError(errno.EEXIST, "No usable temporary file name found")
+
+    # --- Wrapper methods around os.*
+
+    def chdir(self, path):
+        if self._lookup(path).entries is None:
+            raise _error(errno.ENOTDIR, path)
+        self.cwd = self.fs2ftp(path)
+
+    def mkdir(self, path):
+        self._create(path, stat.S_IFDIR | 0755)
+
+    def listdir(self, path):
+        node = self._lookup(path)
+        if node.entries is None:
+            raise _error(errno.ENOTDIR, path)
+        return node.entries.keys()
+
+    def rmdir(self, path):
+        parent, name = self._lookup_parent(path)
+        node = parent.entries.get(name)
+        if node is None:
+            raise _error(errno.ENOENT, path)
+        if node.entries is None:
+            raise _error(errno.ENOTDIR, path)
+        if node.entries:
+            raise _error(errno.ENOTEMPTY, path)
+        del parent.entries[name]
+        parent.mtime = time.time()
+        self.store.unlink(node)
+
+    def remove(self, path):
+        parent, name = self._lookup_parent(path)
+        node = parent.entries.get(name)
+        if node is None:
+            raise _error(errno.ENOENT, path)
+        if node.entries is not None:
+            raise _error(errno.EISDIR, path)
+        del parent.entries[name]
+        parent.mtime = time.time()
+        self.store.unlink(node)
+
+    def rename(self, src, dst):
+        srcdir, srcname = self._lookup_parent(src)
+        node = srcdir.entries.get(srcname)
+        if node is None:
+            raise _error(errno.ENOENT, src)
+        dstdir, dstname = self._lookup_parent(dst)
+        if node.entries is not None and \
+        os.path.normpath(dst).startswith(os.path.normpath(src) + '/'):
+            # a directory into itself
+            raise _error(errno.EINVAL, dst)
+        old = dstdir.entries.get(dstname)
+        if old is node:
+            return
+        if old is not None:
+            if old.entries is not None and node.entries is None:
+                raise _error(errno.EISDIR, dst)
+            if old.entries is None and node.entries is not None:
+                raise _error(errno.ENOTDIR, dst)
+            if old.entries:
+                raise _error(errno.ENOTEMPTY, dst)
+            self.store.unlink(old)
+        del srcdir.entries[srcname]
+        dstdir.entries[dstname] = node
+        srcdir.mtime = dstdir.mtime = node.ctime = time.time()
+
+    def stat(self, path):
+        node = self._lookup(path)
+        if node.entries is None:
+            size, nlink = len(node.data), node.nlink
+        else:
+            size, nlink = 0, 2
+        return os.stat_result((node.mode, node.ino, 0, nlink,
+                               self.store.uid, self.store.gid, size,
+                               node.mtime, node.mtime, node.ctime))
+
+    lstat = stat
+
+    def readlink(self, path):
+        self._lookup(path)
+        raise _error(errno.EINVAL, path)
+
+    # --- Wrapper methods around os.path.*
+
+    def isfile(self, path):
+        try:
+            return self._lookup(path).entries is None
+        except OSError:
+            return False
+
+    def islink(self, path):
+        return False
+
+    def isdir(self, path):
+        try:
+            return self._lookup(path).entries is not None
+        except OSError:
+            return False
+
+    def getsize(self, path):
+        return self.stat(path).st_size
+
+    def getmtime(self, path):
+        return self._lookup(path).mtime
+
+    def realpath(self, path):
+        return os.path.normpath(path)
+
+    def lexists(self, path):
+        try:
+            self._lookup(path)
+        except OSError:
+            return False
+        return True
+
+    exists = lexists
+
+    # --- Utility methods
+
+    def fs2ftp(self, fspath):
+        # the root is not an absolute path
+        p = os.path.normpath(fspath)
+        if not self.validpath(p):
+            return '/'
+        return '/' + p[len(self.root):].lstrip('/')
+
+    def validpath(self, path):
+        path = os.path.normpath(path)
+        return path == self.root or path.startswith(self.root + '/')
+
+    def get_dir_types(self, path):
+        try:
+            node = self._lookup(path)
+        except OSError:
+            return None
+        if node.entries is None:
+            return None
+        types = {}
+        for name, child in node.entries.items():
+            types[name] = child.entries is not None
+        return types
+
+
+register_fs_backend('mem', MemoryFS)
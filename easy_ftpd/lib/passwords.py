@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# passwords.py
+
+"""Password hashes stored in the users file, and their verification
+outside of the polling loop.
+
+The format of a stored password tells how it's checked:
+
+    $pbkdf2-sha256$<iterations>$<salt>$<hex digest>
+        PBKDF2-HMAC-SHA256 of the password (make_hash() default).
+
+    <salt>!<hex digest>
+        a single salted SHA-1 round (older easyftpd-pwhash versions).
+
+    anything else
+        the password in plain text.
+
+    [PasswordVerifier] - runs check_password() for the expensive
+    formats in a pool of worker processes, so that logging users in
+    doesn't stall the other sessions; results are handed back from
+    within the polling loop, as GroupCommitFlusher does.
+
+PBKDF2 needs hashlib (Python 2.5 or later) and the worker pool needs
+multiprocessing (Python 2.6 or later); without them PBKDF2 hashes never
+match, respectively passwords are checked in the polling loop.
+"""
+
+import binascii
+import os
+import signal
+import time
+import traceback
+
+try:
+    import hashlib
+except ImportError:
+    hashlib = None
+try:
+    import hmac
+except ImportError:
+    hmac = None
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+from easy_ftpd.lib import ftpserver
+
+__all__ = ['make_hash', 'check_password', 'is_expensive',
+           'PasswordVerifier']
+
+PBKDF2_PREFIX = '$pbkdf2-sha256$'
+
+# PBKDF2 iterations of the hashes made by make_hash()
+DEFAULT_ITERATIONS = 100000
+
+# a hash no password matches, checked for unknown users so that they
+# are rejected as slowly as known ones
+DUMMY_HASH = '%s%d$%s$%s' % (PBKDF2_PREFIX, DEFAULT_ITERATIONS, '0' * 32,
+                             '0' * 64)
+
+
+def _pbkdf2(password, salt, iterations):
+    if hasattr(hashlib, 'pbkdf2_hmac'):
+        return hashlib.pbkdf2_hmac('sha256', password, salt, iterations)
+    # Python < 2.7.8
+    mac = hmac.new(password, None, hashlib.sha256)
+    def prf(data):
+        h = mac.copy()
+        h.update(data)
+        return h.digest()
+    u = prf(salt + '\x00\x00\x00\x01')
+    result = [ord(c) for c in u]
+    for i in xrange(iterations - 1):
+        u = prf(u)
+        for j in range(len(u)):
+            result[j] ^= ord(u[j])
+    return ''.join([chr(x) for x in result])
+
+def _equal(a, b):
+    """Compare a and b in a time not depending on where they differ."""
+    if hmac is not None and hasattr(hmac, 'compare_digest'):
+        return hmac.compare_digest(a, b)
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+def make_hash(password, iterations=DEFAULT_ITERATIONS):
+    """Return the PBKDF2 hash of password to store in the users file."""
+    salt = binascii.hexlify(os.urandom(16))
+    digest = binascii.hexlify(_pbkdf2(password, salt, iterations))
+    return '%s%d$%s$%s' % (PBKDF2_PREFIX, iterations, salt, digest)
+
+def is_expensive(stored):
+    """Whether checking a password against stored takes long."""
+    return stored.startswith(PBKDF2_PREFIX)
+
+def check_password(stored, password):
+    """Return True if password matches stored, in any of the formats
+    described above."""
+    if stored.startswith(PBKDF2_PREFIX):
+        try:
+            iterations, salt, digest = \
+                stored[len(PBKDF2_PREFIX):].split('$')
+            iterations = int(iterations)
+        except ValueError:
+            return False
+        if hashlib is None:
+            return False
+        return _equal(binascii.hexlify(_pbkdf2(password, salt, iterations)),
+                      digest)
+    if len(stored) > 40 and '!' in stored:
+        salt, digest = stored.split('!', 1)
+        if hashlib is not None:
+            sha = hashlib.sha1(password + salt)
+        else:
+            import sha
+            sha = sha.new(password + salt)
+        return _equal(sha.hexdigest(), digest)
+    return _equal(stored, password)
+
+
+def _init_worker():
+    # signals are for the server process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+def _check(stored, password):
+    """Called in a worker process."""
+    try:
+        return check_password(stored, password)
+    except Exception:
+        return False
+
+
+class PasswordVerifier:
+    """Checks passwords against expensive hashes (see is_expensive) in
+    a pool of processes workers (none: in the polling loop); the
+    others are checked right away.  Callbacks are called from within
+    the polling loop.
+
+    A verification not completed within timeout seconds (e.g. a
+    worker hung or the pool is swamped) is given up: its callback is
+    called with None, for which the client is told to retry later
+    (see DummyAuthorizer.validate_authentication_async).  The worker
+    still finishes it; its result is then ignored.
+    """
+
+    # how often the polling loop checks for completed verifications
+    reap_interval = 0.005
+
+    def __init__(self, processes, timeout=30):
+        self.pool = None
+        if multiprocessing is not None and processes > 0:
+            self.pool = multiprocessing.Pool(processes, _init_worker)
+        self.timeout = timeout
+        # [deadline, callback, AsyncResult] of the verifications in
+        # progress, oldest first
+        self._pending = []
+        self._in_flight = 0
+        self._reap_call = None
+        # statistics
+        self.timeouts = 0
+
+    def check(self, stored, password, callback):
+        """Call callback with True if password matches stored, False
+        otherwise, None if it couldn't be verified in time."""
+        if self.pool is None or not is_expensive(stored):
+            callback(check_password(stored, password))
+            return
+        self._in_flight += 1
+        result = self.pool.apply_async(_check, (stored, password))
+        self._pending.append((time.time() + self.timeout, callback, result))
+        if self._reap_call is None:
+            self._reap_call = ftpserver.CallLater(self.reap_interval,
+                                                  self._reap)
+
+    def _reap(self):
+        """Called in the polling loop; run the callbacks of completed
+        and of timed out verifications."""
+        self._reap_call = None
+        now = time.time()
+        pending = []
+        for item in self._pending:
+            deadline, callback, result = item
+            if result.ready():
+                try:
+                    ok = result.get()
+                except Exception:
+                    ok = False
+            elif now >= deadline:
+                self.timeouts += 1
+                ftpserver.logerror("Password verification timed out "
+                                   "after %s seconds." %self.timeout)
+                ok = None
+            else:
+                pending.append(item)
+                continue
+            self._in_flight -= 1
+            try:
+                callback(ok)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                ftpserver.logerror(traceback.format_exc())
+        self._pending = pending
+        if self._in_flight:
+            self._reap_call = ftpserver.CallLater(self.reap_interval,
+                                                  self._reap)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+# remoteauth.py
+
+"""Authentication of the users by a remote user service instead of the
+users file.
+
+    [AuthClient] - asynchronous client of the user service, keeping a
+    small pool of persistent connections on which requests are
+    pipelined, and failing fast (circuit breaker) while the service
+    is unreachable.
+
+    [RemoteAuthorizer] - a DummyAuthorizer asking an AuthClient to
+    verify passwords (see validate_authentication_async) and caching
+    the positive answers for a while.
+
+    [AuthServer] - a minimal user service answering from a users file,
+    to stand in for the real one (see the easyftpd-authd script).
+
+The protocol is line based: every request is answered by a line
+starting with the request's id, answers coming in any order.  Fields
+are separated by spaces and %-quoted (urllib.quote):
+
+    AUTH <id> <username> <password>
+        <id> OK <home directory> <permissions> <read limit> <write limit>
+        <id> DENY
+        <id> ERR <message>
+
+Permissions are "r", "w", "rw" or "-" (none); limits are in bytes per
+second (0 == unlimited).
+"""
+
+import asyncore
+import asynchat
+import socket
+import sys
+import time
+import urllib
+
+try:
+    from hashlib import sha256 as _hash
+except ImportError:
+    import sha
+    _hash = sha.new
+
+from easy_ftpd.lib import ftpserver
+
+__all__ = ['AuthClient', 'RemoteAuthorizer', 'AuthServer']
+
+
+def _encode(*fields):
+    return ' '.join([urllib.quote(str(x), safe='') for x in fields]) + '\r\n'
+
+def _decode(line):
+    return [urllib.unquote(x) for x in line.split(' ')]
+
+
+class _AuthConnection(asynchat.async_chat):
+    """A connection of an AuthClient to the user service."""
+
+    def __init__(self, client):
+        asynchat.async_chat.__init__(self)
+        self.client = client
+        self.in_buffer = []
+        self.set_terminator('\r\n')
+        # id -> (callback, CallLater of the timeout)
+        self.pending = {}
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(client.address)
+
+    def request(self, id, username, password, callback):
+        timer = ftpserver.CallLater(self.client.timeout, self.handle_timeout)
+        self.pending[id] = (callback, timer)
+        self.push(_encode('AUTH', id, username, password))
+
+    def collect_incoming_data(self, data):
+        self.in_buffer.append(data)
+
+    def found_terminator(self):
+        line = ''.join(self.in_buffer)
+        self.in_buffer = []
+        fields = _decode(line)
+        entry = self.pending.pop(fields[0], None)
+        if entry is None:
+            # timed out meanwhile
+            return
+        callback, timer = entry
+        timer.cancel()
+        if len(fields) == 6 and fields[1] == 'OK':
+            home, perm, read_limit, write_limit = fields[2:]
+            try:
+                result = (home, perm.replace('-', ''), int(read_limit),
+                          int(write_limit))
+            except ValueError:
+                result = None
+        elif len(fields) == 2 and fields[1] == 'DENY':
+            result = False
+        else:
+            result = None
+        if result is None:
+            ftpserver.logerror('User service error: %r.' %line)
+            self.client.on_failure()
+        else:
+            self.client.on_success()
+        callback(result)
+
+    def handle_connect(self):
+        pass
+
+    def handle_timeout(self):
+        ftpserver.logerror('User service %s:%d timed out.' %self.client.address)
+        self.close()
+
+    def handle_error(self):
+        ftpserver.logerror('User service %s:%d: %s.'
+                           %(self.client.address + (sys.exc_info()[1],)))
+        self.close()
+
+    def handle_close(self):
+        self.close()
+
+    def close(self):
+        asynchat.async_chat.close(self)
+        if self in self.client.connections:
+            self.client.connections.remove(self)
+        pending = self.pending.values()
+        self.pending = {}
+        if pending:
+            self.client.on_failure()
+        for callback, timer in pending:
+            if not timer.cancelled:
+                timer.cancel()
+            callback(None)
+
+
+class AuthClient:
+    """Sends the requests of the RemoteAuthorizer objects to the user
+    service at address (a (host, port) tuple).
+
+    Up to pool_size connections are opened, when the open ones are
+    busy, and kept open; beyond that requests are pipelined on the
+    least busy connection.  A request fails if not answered within
+    timeout seconds.  After max_failures failures in a row (errors,
+    timeouts, lost connections) the service is deemed down and
+    requests fail at once for retry_after seconds; then the next
+    request tries again.
+    """
+
+    pool_size = 4
+    timeout = 5.0
+    max_failures = 5
+    retry_after = 30.0
+
+    def __init__(self, address):
+        self.address = address
+        self.connections = []
+        self.failures = 0
+        # requests fail at once until then (circuit open)
+        self.down_until = 0
+        self._id = 0
+
+    def authenticate(self, username, password, callback):
+        """Call callback with the (home, perm, read_limit, write_limit)
+        of username if password is right, False if it's not, None if
+        the service can't tell (unreachable, error)."""
+        if time.time() < self.down_until:
+            callback(None)
+            return
+        busy = [(len(conn.pending), conn) for conn in self.connections]
+        busy.sort()
+        if busy and (busy[0][0] == 0 or
+                     len(self.connections) >= self.pool_size):
+            conn = busy[0][1]
+        else:
+            try:
+                conn = _AuthConnection(self)
+            except socket.error, err:
+                ftpserver.logerror('User service %s:%d: %s.'
+                                   %(self.address + (err,)))
+                self.on_failure()
+                callback(None)
+                return
+            self.connections.append(conn)
+        self._id += 1
+        conn.request(str(self._id), username, password, callback)
+
+    def on_success(self):
+        self.failures = 0
+        self.down_until = 0
+
+    def on_failure(self):
+        self.failures += 1
+        if self.failures >= self.max_failures:
+            if not self.down_until:
+                ftpserver.logerror('User service %s:%d is down; retrying '
+                                   'in %d seconds.'
+                                   %(self.address + (self.retry_after,)))
+            self.down_until = time.time() + self.retry_after
+
+    def close(self):
+        for conn in self.connections[:]:
+            conn.close()
+
+
+class RemoteAuthorizer(ftpserver.DummyAuthorizer):
+    """An authorizer whose users are authenticated by the AuthClient
+    client; the users added with add_user() (e.g. anonymous) are
+    local as usual.
+
+    Since the service is only asked at login time every user name is
+    accepted by has_user(); once logged in, a user's home directory,
+    permissions and limits are those answered by the service.  A
+    positive answer is reused for logins with the same password
+    within cache_ttl seconds, including while the service is down;
+    at most max_cached answers are kept.  The records of the users
+    in user_table are dropped with their answer, unless they are
+    logged in.
+    """
+
+    cache_ttl = 60.0
+    max_cached = 10000
+
+    def __init__(self, client, msg_login="Login successful.",
+                 msg_quit="Goodbye."):
+        ftpserver.DummyAuthorizer.__init__(self)
+        self.client = client
+        self.msg_login = msg_login
+        self.msg_quit = msg_quit
+        # names of the users added with add_user()
+        self.local = {}
+        # username -> (expiration time, password digest)
+        self.cache = {}
+        # username -> number of sessions logged in
+        self.sessions = {}
+        self._salt = str(time.time()) + str(id(self))
+
+    def _digest(self, password):
+        return _hash(self._salt + password).digest()
+
+    def add_user(self, username, *args, **kwargs):
+        ftpserver.DummyAuthorizer.add_user(self, username, *args, **kwargs)
+        self.local[username] = True
+
+    def add_anonymous(self, homedir, **kwargs):
+        ftpserver.DummyAuthorizer.add_anonymous(self, homedir, **kwargs)
+        self.local['anonymous'] = True
+
+    def remove_user(self, username):
+        ftpserver.DummyAuthorizer.remove_user(self, username)
+        self.local.pop(username, None)
+        self.cache.pop(username, None)
+
+    def on_login(self, username):
+        if username not in self.local:
+            self.sessions[username] = self.sessions.get(username, 0) + 1
+
+    def on_logout(self, username):
+        count = self.sessions.get(username, 0) - 1
+        if count > 0:
+            self.sessions[username] = count
+            return
+        self.sessions.pop(username, None)
+        if username not in self.cache:
+            self._forget(username)
+
+    def _forget(self, username):
+        """Drop the record of remote user username unless logged
+        in."""
+        if username not in self.sessions and username not in self.local:
+            self.user_table.pop(username, None)
+
+    def has_user(self, username):
+        if username in self.local:
+            return True
+        # anonymous is not allowed unless added
+        return username != 'anonymous'
+
+    def validate_authentication(self, username, password):
+        """Only tell about local users and cached answers (checking
+        with the service needs validate_authentication_async)."""
+        if username in self.local:
+            return ftpserver.DummyAuthorizer.validate_authentication(
+                self, username, password)
+        return self._cached(username, password)
+
+    def _cached(self, username, password):
+        entry = self.cache.get(username)
+        if entry is None or username not in self.user_table:
+            return False
+        if entry[0] < time.time():
+            del self.cache[username]
+            self._forget(username)
+            return False
+        return entry[1] == self._digest(password)
+
+    def validate_authentication_async(self, username, password, callback):
+        if username in self.local or self._cached(username, password):
+            callback(self.validate_authentication(username, password))
+            return
+        def on_result(result):
+            if result:
+                self._add_remote(username, password, result)
+                callback(True)
+            elif result is False:
+                self.cache.pop(username, None)
+                self._forget(username)
+                callback(False)
+            else:
+                # the service can't tell
+                callback(None)
+        self.client.authenticate(username, password, on_result)
+
+    def _add_remote(self, username, password, result):
+        home, perm, read_limit, write_limit = result
+        self.user_table[username] = {'pwd': '', 'home': home, 'perm': perm,
+                                     'msg_login': self.msg_login,
+                                     'msg_quit': self.msg_quit,
+                                     'read_limit': read_limit,
+                                     'write_limit': write_limit}
+        if len(self.cache) >= self.max_cached:
+            now = time.time()
+            dropped = [name for name, entry in self.cache.items()
+                       if entry[0] < now]
+            if len(self.cache) - len(dropped) >= self.max_cached:
+                dropped = self.cache.keys()
+            for name in dropped:
+                del self.cache[name]
+                if name != username:
+                    self._forget(name)
+        self.cache[username] = (time.time() + self.cache_ttl,
+                                self._digest(password))
+
+
+# --- stand-in user service
+
+class _AuthServerChannel(asynchat.async_chat):
+
+    def __init__(self, sock, server):
+        asynchat.async_chat.__init__(self, sock)
+        self.server = server
+        self.in_buffer = []
+        self.set_terminator('\r\n')
+
+    def collect_incoming_data(self, data):
+        self.in_buffer.append(data)
+
+    def found_terminator(self):
+        line = ''.join(self.in_buffer)
+        self.in_buffer = []
+        fields = _decode(line)
+        if len(fields) != 4 or fields[0] != 'AUTH':
+            self.push(_encode(fields[0], 'ERR', 'bad request'))
+            return
+        id, username, password = fields[1:]
+        try:
+            user = self.server.check(username, password)
+        except Exception, err:
+            self.push(_encode(id, 'ERR', err))
+            return
+        if user is None:
+            self.push(_encode(id, 'DENY'))
+        else:
+            home, perm, read_limit, write_limit = user
+            self.push(_encode(id, 'OK', home, perm or '-', read_limit,
+                              write_limit))
+
+
+class AuthServer(asyncore.dispatcher):
+    """A user service listening on address, whose answers are those of
+    the check(username, password) callable: the (home, perm,
+    read_limit, write_limit) of the user if password is right, None
+    otherwise.
+    """
+
+    def __init__(self, address, check):
+        asyncore.dispatcher.__init__(self)
+        self.check = check
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(address)
+        self.listen(64)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            _AuthServerChannel(pair[0], self)
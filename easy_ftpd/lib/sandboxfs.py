@@ -0,0 +1,506 @@
+#!/usr/bin/env python
+# sandboxfs.py
+
+"""A file system confining every access below the user's root
+directory by resolving paths relative to a directory file descriptor,
+with no string-based checks and no process-wide chdir().
+
+    [SandboxFS] - an AbstractedFS holding a descriptor of the root
+    directory per session and opening every path through
+    openat2(RESOLVE_BENEATH) (Linux 5.6 or later) or, where missing,
+    through an openat(O_NOFOLLOW) walk of its components.
+
+Symbolic links are followed as long as they stay below the root, as
+AbstractedFS.validpath() allows, absolute ones included (openat2()
+refuses those: paths going through them are resolved by the openat()
+walk, which maps their target below the root descriptor); since the
+kernel resolves paths against an open descriptor, a directory renamed
+or replaced by a symbolic link meanwhile can't be used to escape (no
+time-of-check to time-of-use race).  Nothing depends on the process'
+current directory either, hence the methods may be called from worker
+threads.
+
+This needs Linux, ctypes (Python 2.6 or later) and /proc; importing
+this module raises ImportError otherwise.
+"""
+
+import errno
+import os
+import random
+import stat
+import sys
+import time
+
+if not sys.platform.startswith('linux'):
+    raise ImportError("sandboxfs is only available on Linux")
+if not os.path.isdir('/proc/self/fd'):
+    raise ImportError("sandboxfs needs /proc")
+
+import ctypes
+import ctypes.util
+
+from easy_ftpd.lib.ftpserver import AbstractedFS
+
+__all__ = ['SandboxFS']
+
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                    use_errno=True)
+
+# from <fcntl.h> and <linux/openat2.h>
+O_PATH = 010000000
+O_CLOEXEC = 02000000
+AT_REMOVEDIR = 0x200
+RESOLVE_NO_MAGICLINKS = 0x02
+RESOLVE_BENEATH = 0x08
+SYS_openat2 = 437
+
+
+class _OpenHow(ctypes.Structure):
+    _fields_ = [('flags', ctypes.c_uint64),
+                ('mode', ctypes.c_uint64),
+                ('resolve', ctypes.c_uint64)]
+
+# cleared on the first ENOSYS
+_have_openat2 = True
+# (flags, mode) -> reference to an _OpenHow, never changed once built
+_hows = {}
+_HOW_SIZE = ctypes.sizeof(_OpenHow)
+
+
+class _Escape(OSError):
+    """Raised when a path leads outside the root directory."""
+
+    def __init__(self, path):
+        OSError.__init__(self, errno.EACCES, os.strerror(errno.EACCES), path)
+
+
+def _error(path=None):
+    err = ctypes.get_errno()
+    if path is None:
+        return OSError(err, os.strerror(err))
+    return OSError(err, os.strerror(err), path)
+
+def _proc(fd):
+    """Return the /proc path of descriptor fd."""
+    return '/proc/self/fd/%d' %fd
+
+def _readlinkat(dirfd, name):
+    buf = ctypes.create_string_buffer(4096)
+    size = _libc.readlinkat(dirfd, name, buf, len(buf))
+    if size == -1:
+        raise _error(name)
+    return buf.raw[:size]
+
+
+class _File:
+    """A file object whose name attribute is the file system path it
+    has been opened with (os.fdopen() names it "<fdopen>")."""
+
+    def __init__(self, file, name):
+        self.file = file
+        self.name = name
+
+    def __getattr__(self, attr):
+        return getattr(self.file, attr)
+
+
+class SandboxFS(AbstractedFS):
+    """An AbstractedFS opening every path relative to a descriptor of
+    the user's root directory, the kernel refusing to leave it.
+    """
+
+    # max number of symbolic links followed by the openat() walk
+    max_links = 40
+
+    # how long the descriptor of the directory listed last is used
+    listed_ttl = 2.0
+
+    def __init__(self):
+        AbstractedFS.__init__(self)
+        self._rootfd = None
+        self._rootfd_path = None
+        # (path prefix, descriptor, expiration time, /proc prefix) of
+        # the directory listed last: listing commands lstat() every
+        # entry right after listdir(), which is done relative to it
+        self._listed = None
+
+    def close(self):
+        AbstractedFS.close(self)
+        self._forget_listed()
+        if self._rootfd is not None:
+            os.close(self._rootfd)
+            self._rootfd = None
+
+    # --- resolution
+
+    def _get_rootfd(self):
+        if self._rootfd is None or self._rootfd_path != self.root:
+            if self._rootfd is not None:
+                os.close(self._rootfd)
+                self._rootfd = None
+            self._rootfd = os.open(self.root, O_PATH | os.O_DIRECTORY |
+                                              O_CLOEXEC)
+            self._rootfd_path = self.root
+        return self._rootfd
+
+    def _relpath(self, path):
+        """Return path relative to the root directory.  ".." components
+        are left to the resolution, which doesn't let them climb above
+        the root.
+        """
+        root = self.root
+        if path == root:
+            return '.'
+        if not root.endswith(os.sep):
+            root = root + os.sep
+        if not path.startswith(root):
+            path = os.path.normpath(path)
+            root = os.path.normpath(self.root)
+            if path == root:
+                return '.'
+            if not root.endswith(os.sep):
+                root = root + os.sep
+            if not path.startswith(root):
+                raise _Escape(path)
+        return path[len(root):] or '.'
+
+    def _open(self, path, flags, mode=0, follow=True):
+        """Open path (a file system path below the root directory) and
+        return the descriptor; raise _Escape if it leads outside the
+        root directory, OSError on other errors."""
+        global _have_openat2
+        relpath = self._relpath(path)
+        rootfd = self._rootfd
+        if rootfd is None or self._rootfd_path != self.root:
+            rootfd = self._get_rootfd()
+        flags = flags | O_CLOEXEC
+        if not follow:
+            flags = flags | os.O_NOFOLLOW
+        if _have_openat2:
+            if not flags & os.O_CREAT:
+                mode = 0
+            how = _hows.get((flags, mode))
+            if how is None:
+                how = ctypes.byref(_OpenHow(flags, mode, RESOLVE_BENEATH |
+                                            RESOLVE_NO_MAGICLINKS))
+                _hows[(flags, mode)] = how
+            fd = _libc.syscall(SYS_openat2, rootfd, relpath, how,
+                               _HOW_SIZE)
+            if fd != -1:
+                return fd
+            err = ctypes.get_errno()
+            # a concurrent rename raced with the lookup
+            attempts = 2
+            while err == errno.EAGAIN and attempts:
+                fd = _libc.syscall(SYS_openat2, rootfd, relpath, how,
+                                   _HOW_SIZE)
+                if fd != -1:
+                    return fd
+                err = ctypes.get_errno()
+                attempts -= 1
+            if err == errno.EXDEV:
+                # an absolute symbolic link may still lead below the
+                # root: let the walk tell
+                return self._walk(rootfd, relpath, path, flags, mode,
+                                  follow)
+            if err != errno.ENOSYS:
+                raise OSError(err, os.strerror(err), path)
+            _have_openat2 = False
+        return self._walk(rootfd, relpath, path, flags, mode, follow)
+
+    def _walk(self, rootfd, relpath, path, flags, mode, follow):
+        """Like _open() by opening one component at a time with
+        O_NOFOLLOW, resolving symbolic links by hand."""
+        parts = [x for x in relpath.split(os.sep) if x not in ('', '.')]
+        if not parts:
+            return os.dup(rootfd)
+        # descriptors of the directories walked so far but the root
+        stack = []
+        links = 0
+        try:
+            while True:
+                name = parts.pop(0)
+                if stack:
+                    dirfd = stack[-1]
+                else:
+                    dirfd = rootfd
+                if name == '..':
+                    if not stack:
+                        raise _Escape(path)
+                    os.close(stack.pop())
+                    if not parts:
+                        return os.dup(stack and stack[-1] or rootfd)
+                    continue
+                if not parts and not follow:
+                    fd = _libc.openat(dirfd, name, flags, mode)
+                    if fd == -1:
+                        raise _error(path)
+                    return fd
+                fd = _libc.openat(dirfd, name, O_PATH | os.O_NOFOLLOW |
+                                               O_CLOEXEC, 0)
+                if fd == -1:
+                    if parts or ctypes.get_errno() != errno.ENOENT or \
+                    not flags & os.O_CREAT:
+                        raise _error(path)
+                    st_mode = 0
+                else:
+                    st_mode = os.fstat(fd).st_mode
+                if stat.S_ISLNK(st_mode):
+                    try:
+                        target = _readlinkat(fd, '')
+                    finally:
+                        os.close(fd)
+                    links += 1
+                    if links > self.max_links:
+                        raise OSError(errno.ELOOP, os.strerror(errno.ELOOP),
+                                      path)
+                    if target.startswith('/'):
+                        target = self._beneath(rootfd, target)
+                        if target is None:
+                            raise _Escape(path)
+                        # start over from the root
+                        while stack:
+                            os.close(stack.pop())
+                        dirfd = rootfd
+                    else:
+                        target = [x for x in target.split('/')
+                                  if x not in ('', '.')]
+                    parts = target + parts
+                    if not parts:
+                        return os.dup(dirfd)
+                    continue
+                if parts:
+                    stack.append(fd)
+                    continue
+                # the last component; O_NOFOLLOW in case a symbolic
+                # link replaced it meanwhile
+                if fd != -1:
+                    os.close(fd)
+                fd = _libc.openat(dirfd, name, flags | os.O_NOFOLLOW, mode)
+                if fd == -1:
+                    raise _error(path)
+                return fd
+        finally:
+            for fd in stack:
+                os.close(fd)
+
+    def _beneath(self, rootfd, target):
+        """Return the components of the absolute symbolic link target
+        relative to the root directory, None if it's not below it."""
+        target = [x for x in target.split('/') if x not in ('', '.')]
+        for root in self.root, os.readlink(_proc(rootfd)):
+            root = [x for x in os.path.normpath(root).split(os.sep) if x]
+            if target[:len(root)] == root:
+                return target[len(root):]
+        return None
+
+    def _open_parent(self, path):
+        """Return the descriptor of the directory containing path and
+        the name of path in it."""
+        dirname, name = os.path.split(os.path.normpath(path))
+        if name in ('', '.', '..'):
+            raise OSError(errno.EINVAL, os.strerror(errno.EINVAL), path)
+        return self._open(dirname, O_PATH | os.O_DIRECTORY), name
+
+    def _forget_listed(self):
+        if self._listed is not None:
+            os.close(self._listed[1])
+            self._listed = None
+
+    # --- Wrapper methods around open() and tempfile.mkstemp
+
+    def open(self, filename, mode):
+        if mode.startswith('r'):
+            flags = os.O_RDONLY
+        elif mode.startswith('w'):
+            flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        else:
+            flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+        if '+' in mode:
+            flags = flags & ~os.O_WRONLY | os.O_RDWR
+        try:
+            fd = self._open(filename, flags, 0666)
+        except OSError, err:
+            raise IOError(err.errno, err.strerror, filename)
+        return _File(os.fdopen(fd, mode), filename)
+
+    def mkstemp(self, suffix='', prefix='', dir=None, mode='wb'):
+        chars = 'abcdefghijklmnopqrstuvwxyz0123456789_'
+        for attempt in range(50):
+            name = prefix + ''.join(random.sample(chars, 6)) + suffix
+            path = os.path.join(dir, name)
+            try:
+                fd = self._open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL,
+                                0600)
+            except OSError, err:
+                if err.errno == errno.EEXIST:
+                    continue
+                raise
+            return _File(os.fdopen(fd, mode), path)
+        raise IOError(errno.EEXIST, "No usable temporary file name found")
+
+    # --- Wrapper methods around os.*
+
+    def chdir(self, path):
+        fd = self._open(path, O_PATH | os.O_DIRECTORY)
+        try:
+            if not os.access(_proc(fd), os.X_OK):
+                raise OSError(errno.EACCES, os.strerror(errno.EACCES), path)
+        finally:
+            os.close(fd)
+        self.cwd = self.fs2ftp(path)
+
+    def mkdir(self, path):
+        fd, name = self._open_parent(path)
+        try:
+            if _libc.mkdirat(fd, name, 0777) == -1:
+                raise _error(path)
+        finally:
+            os.close(fd)
+
+    def listdir(self, path):
+        fd = self._open(path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            names = os.listdir(_proc(fd))
+        except OSError:
+            os.close(fd)
+            raise
+        self._forget_listed()
+        prefix = os.path.normpath(path)
+        if not prefix.endswith(os.sep):
+            prefix = prefix + os.sep
+        self._listed = (prefix, fd, time.time() + self.listed_ttl,
+                        _proc(fd) + '/')
+        return names
+
+    def _unlink(self, path, flags):
+        fd, name = self._open_parent(path)
+        try:
+            if _libc.unlinkat(fd, name, flags) == -1:
+                raise _error(path)
+        finally:
+            os.close(fd)
+
+    def rmdir(self, path):
+        self._unlink(path, AT_REMOVEDIR)
+
+    def remove(self, path):
+        self._unlink(path, 0)
+
+    def rename(self, src, dst):
+        srcfd, srcname = self._open_parent(src)
+        try:
+            dstfd, dstname = self._open_parent(dst)
+            try:
+                if _libc.renameat(srcfd, srcname, dstfd, dstname) == -1:
+                    raise _error(src)
+            finally:
+                os.close(dstfd)
+        finally:
+            os.close(srcfd)
+
+    def stat(self, path):
+        fd = self._open(path, O_PATH)
+        try:
+            return os.fstat(fd)
+        finally:
+            os.close(fd)
+
+    def lstat(self, path):
+        listed = self._listed
+        if listed is not None and path.startswith(listed[0]):
+            name = path[len(listed[0]):]
+            if name not in ('', '.', '..') and os.sep not in name and \
+            time.time() < listed[2]:
+                # the last component is looked up in the directory
+                # listed, already known to be below the root
+                return os.lstat(listed[3] + name)
+        fd = self._open(path, O_PATH, follow=False)
+        try:
+            return os.fstat(fd)
+        finally:
+            os.close(fd)
+
+    def readlink(self, path):
+        fd = self._open(path, O_PATH, follow=False)
+        try:
+            return _readlinkat(fd, '')
+        finally:
+            os.close(fd)
+
+    # --- Wrapper methods around os.path.*
+
+    def _test(self, path, test, follow=True):
+        try:
+            if follow:
+                st = self.stat(path)
+            else:
+                st = self.lstat(path)
+        except OSError:
+            return False
+        return test(st.st_mode)
+
+    def isfile(self, path):
+        return self._test(path, stat.S_ISREG)
+
+    def islink(self, path):
+        return self._test(path, stat.S_ISLNK, follow=False)
+
+    def isdir(self, path):
+        return self._test(path, stat.S_ISDIR)
+
+    def getsize(self, path):
+        return self.stat(path).st_size
+
+    def getmtime(self, path):
+        return self.stat(path).st_mtime
+
+    def lexists(self, path):
+        return self._test(path, lambda mode: True, follow=False)
+
+    exists = lexists
+
+    def realpath(self, path):
+        try:
+            fd = self._open(path, O_PATH)
+        except _Escape:
+            return AbstractedFS.realpath(self, path)
+        except OSError:
+            # not existing (yet): resolve what does
+            dirname, name = os.path.split(path)
+            if not name or dirname == path:
+                return AbstractedFS.realpath(self, path)
+            return os.path.join(self.realpath(dirname), name)
+        try:
+            return os.readlink(_proc(fd))
+        finally:
+            os.close(fd)
+
+    # --- Utility methods
+
+    def on_change(self, op, path):
+        AbstractedFS.on_change(self, op, path)
+        self._forget_listed()
+
+    def validpath(self, path):
+        """Check whether the path belongs to user's home directory by
+        letting the kernel resolve it below the root directory.
+        """
+        try:
+            fd = self._open(path, O_PATH)
+        except _Escape:
+            return False
+        except OSError, err:
+            if err.errno != errno.ENOENT:
+                # e.g. ELOOP or EACCES: not resolved, hence not known
+                # to be below the root
+                return False
+            # a missing file (e.g. an upload's) is valid if its
+            # directory is
+            dirname = os.path.dirname(path)
+            if dirname == path:
+                return False
+            return self.validpath(dirname)
+        os.close(fd)
+        return True
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# userdb.py
+
+"""Virtual users kept in an SQLite database rather than in memory, for
+servers with very many accounts.
+
+    [UserDatabase] - the database of the users, built offline (from a
+    users file by the easyftpd-userdb script).
+
+    [UserTable] - a drop-in replacement of the user_table dictionary of
+    DummyAuthorizer, reading the users from a UserDatabase the first
+    time they're needed and keeping the most recently used ones.
+
+Nothing is read at startup: a user's record is loaded when the user
+logs in, and the home directory is checked then (see
+FTPHandler.ftp_PASS) rather than when the user is added.
+
+sqlite3 is needed (Python 2.5 or later); importing this module raises
+ImportError if it's missing.
+"""
+
+import time
+
+import sqlite3
+
+__all__ = ['UserDatabase', 'UserTable']
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    name TEXT PRIMARY KEY,
+    pwd TEXT NOT NULL,
+    perm TEXT NOT NULL,
+    home TEXT NOT NULL,
+    read_limit INTEGER NOT NULL DEFAULT 0,
+    write_limit INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+_COLUMNS = "pwd, perm, home, read_limit, write_limit"
+
+
+class UserDatabase:
+    """An SQLite database of users: name, password (as found in the
+    users file), permissions ("r", "w", "rw" or ""), home directory and
+    bandwidth limits in bytes per second.
+    """
+
+    # rows inserted per executemany() call while importing
+    batch_size = 1000
+
+    def __init__(self, dbpath):
+        self.dbpath = dbpath
+        self.db = sqlite3.connect(dbpath)
+        self.db.text_factory = str
+        try:
+            # let easyftpd-userdb rebuild the database while the server
+            # reads it
+            self.db.execute("PRAGMA journal_mode=WAL")
+        except sqlite3.DatabaseError:
+            pass
+        self.db.executescript(_SCHEMA)
+
+    def lookup(self, name):
+        """Return the row of user name (see _COLUMNS), None if
+        missing."""
+        return self.db.execute("SELECT %s FROM users WHERE name = ?"
+                               %_COLUMNS, (name,)).fetchone()
+
+    def count(self):
+        return self.db.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def homes(self):
+        """Return the distinct home directories."""
+        return [row[0] for row in
+                self.db.execute("SELECT DISTINCT home FROM users")]
+
+    def replace_all(self, users, progress=None):
+        """Replace the content of the database with users, an iterable
+        of (name, pwd, perm, home, read_limit, write_limit) tuples, in
+        a single transaction; return the number of users.  progress, if
+        given, is called with the number of users imported so far."""
+        count = 0
+        batch = []
+        self.db.execute("DELETE FROM users")
+        for user in users:
+            batch.append(user)
+            if len(batch) >= self.batch_size:
+                self._insert(batch)
+                count += len(batch)
+                batch = []
+                if progress is not None:
+                    progress(count)
+        self._insert(batch)
+        count += len(batch)
+        self.db.commit()
+        return count
+
+    def _insert(self, rows):
+        self.db.executemany("INSERT OR REPLACE INTO users VALUES "
+                            "(?, ?, ?, ?, ?, ?)", rows)
+
+    def close(self):
+        self.db.close()
+
+
+class _UserRecord(object):
+    """The entry of a user in a UserTable, standing for the dictionary
+    DummyAuthorizer.add_user() would have built."""
+
+    __slots__ = ('pwd', 'home', 'perm', 'msg_login', 'msg_quit',
+                 'read_limit', 'write_limit', 'loaded', 'used', 'deleted')
+
+    def __init__(self, row, msg_login, msg_quit):
+        self.pwd, self.perm, self.home, self.read_limit, \
+            self.write_limit = row
+        self.msg_login = msg_login
+        self.msg_quit = msg_quit
+        self.loaded = self.used = time.time()
+        # removed from the database while its user was logged in
+        self.deleted = False
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+
+class UserTable:
+    """A mapping of user names to user records (see
+    DummyAuthorizer.user_table) whose records come from the
+    UserDatabase db, the users added by add_user() (e.g. anonymous)
+    taking precedence.
+
+    Up to max_entries records are kept in memory; when more are
+    needed the least recently used half is dropped.  A record is
+    reloaded after ttl seconds, so that a rebuilt database is taken
+    into account.  All the users share the msg_login and msg_quit
+    messages.
+
+    The records of the users logged in are pinned (see pin()): they
+    are never dropped, and a user removed from the database keeps its
+    record until its last session ends, only new logins being
+    refused.
+    """
+
+    max_entries = 10000
+    ttl = 60.0
+
+    def __init__(self, db, msg_login="Login successful.", msg_quit="Goodbye."):
+        self.db = db
+        self.msg_login = msg_login
+        self.msg_quit = msg_quit
+        # users added by add_user()
+        self.static = {}
+        self.records = {}
+        # user name -> number of sessions logged in
+        self.pinned = {}
+
+    def _get(self, name):
+        """Return the record of name, None if there's no such user."""
+        if name in self.static:
+            return self.static[name]
+        now = time.time()
+        record = self.records.get(name)
+        if record is not None and now - record.loaded < self.ttl:
+            record.used = now
+            return record
+        row = self.db.lookup(name)
+        if row is None:
+            if record is None:
+                return None
+            if name in self.pinned:
+                record.deleted = True
+                record.loaded = record.used = now
+                return record
+            del self.records[name]
+            return None
+        if len(self.records) >= self.max_entries:
+            self.evict()
+        record = self.records[name] = \
+            _UserRecord(row, self.msg_login, self.msg_quit)
+        return record
+
+    def evict(self):
+        """Drop the least recently used half of the records which are
+        not pinned."""
+        records = [(record.used, name) for name, record
+                   in self.records.items() if name not in self.pinned]
+        records.sort()
+        for used, name in records[:len(records) / 2 + 1]:
+            del self.records[name]
+
+    def clear(self):
+        """Forget the records loaded so far (e.g. after the database
+        has been rebuilt), except the pinned ones."""
+        for name in self.records.keys():
+            if name not in self.pinned:
+                del self.records[name]
+
+    def pin(self, name):
+        """Keep the record of name until the matching unpin() call (a
+        session of name logged in)."""
+        self.pinned[name] = self.pinned.get(name, 0) + 1
+
+    def unpin(self, name):
+        count = self.pinned.get(name, 0) - 1
+        if count > 0:
+            self.pinned[name] = count
+            return
+        self.pinned.pop(name, None)
+        record = self.records.get(name)
+        if record is not None and record.deleted:
+            del self.records[name]
+
+    def __getitem__(self, name):
+        record = self._get(name)
+        if record is None:
+            raise KeyError(name)
+        return record
+
+    def __contains__(self, name):
+        # users removed from the database can't log in anymore
+        record = self._get(name)
+        return record is not None and not getattr(record, 'deleted', False)
+
+    def __setitem__(self, name, record):
+        self.static[name] = record
+
+    def __delitem__(self, name):
+        del self.static[name]
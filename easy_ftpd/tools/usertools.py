@@ -5,11 +5,14 @@ def is_hash(pw):
         return False
 
 class User(object):
-    def __init__(self, name, pw, perms, root):
+    def __init__(self, name, pw, perms, root, down_rate=0, up_rate=0):
         self.name = name
         self.pw = pw
         self.perms = perms
         self.root = root
+        # bandwidth limits in KB/s (0 means unlimited)
+        self.down_rate = down_rate
+        self.up_rate = up_rate
 
     def change_pass(self, pw, plaintext=False):
         if plaintext:
@@ -18,8 +21,11 @@ class User(object):
             self.pw = User.get_hash(self.name, pw)
 
     def __str__(self):
-        return self.name + ":" + self.pwhash + ":" + self.perms + \
+        line = self.name + ":" + self.pw + ":" + self.perms + \
                ":" + self.root
+        if self.down_rate or self.up_rate:
+            line += ":%d:%d" % (self.down_rate, self.up_rate)
+        return line
 
     #@staticmethod #not used due to pesky 2.3
     def get_hash(name, pw):
@@ -28,17 +34,29 @@ class User(object):
 
     get_hash = staticmethod(get_hash)
 
-def load(userfile):
-    users = {}
-    
+def parse(userfile):
+    """Yield the users of userfile one at a time."""
     for line in userfile:
         # empty line or comment. ignore
         if not line.strip() or line.startswith("#"): 
             continue
         name,pw,perms,root = line.split(":",3)
         root = root.rstrip("\n")
+        down_rate = up_rate = 0
+
+        # optional trailing download and upload rates
+        fields = root.split(":")
+        if len(fields) >= 3 and fields[-1].isdigit() and fields[-2].isdigit():
+            root = ":".join(fields[:-2])
+            down_rate, up_rate = int(fields[-2]), int(fields[-1])
 
-        users[name] = User(name, pw, perms, root)
+        yield User(name, pw, perms, root, down_rate, up_rate)
+
+def load(userfile):
+    users = {}
+    
+    for user in parse(userfile):
+        users[user.name] = user
 
     userfile.close()
     return users
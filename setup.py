@@ -9,7 +9,8 @@ setup(name='EasyFTPd',
       author_email='bjorn.kempen@gmail.com',
       url='http://buffis.com',
       packages=['easy_ftpd','easy_ftpd.lib','easy_ftpd.tools'],
-      scripts=['easyftpd', 'easyftpd-pwhash'],
+      scripts=['easyftpd', 'easyftpd-pwhash', 'easyftpd-index',
+               'easyftpd-blobgc', 'easyftpd-userdb', 'easyftpd-authd'],
       data_files=[
     ('/etc/easyftpd', ['configs/config', 'configs/users']),
     ('/var/log/easyftpd', ['logs/access', 'logs/error'])